@@ -4,7 +4,7 @@ import { useState, useEffect, useRef } from 'react'
 import { createClient } from '@/lib/supabase/client'
 import { useRouter } from 'next/navigation'
 import type { User } from '@supabase/supabase-js'
-import type { BotConfig, ConversationMemory, UserRole, GuildInfo, KnowledgeDocument } from '@/lib/types'
+import type { BotConfig, ConversationMemory, UserRole, GuildInfo, KnowledgeDocument, KnowledgeSource } from '@/lib/types'
 import { 
   Bot, 
   Settings, 
@@ -39,6 +39,9 @@ interface Props {
   selectedGuildId: string
 }
 
+// Documents fetched per page in the Knowledge tab
+const KNOWLEDGE_PAGE_SIZE = 50
+
 export default function DashboardClient({ user, initialConfig, initialMemories, initialUserRoles, guilds, selectedGuildId }: Props) {
   const router = useRouter()
   const supabase = createClient()
@@ -66,17 +69,43 @@ Key behaviors:
   const [allowedChannels, setAllowedChannels] = useState(
     initialConfig?.allowed_channels?.join('\n') || ''
   )
+  const [rateLimits, setRateLimits] = useState({
+    guild_rate_limit: initialConfig?.guild_rate_limit ?? 0,
+    channel_rate_limit: initialConfig?.channel_rate_limit ?? 0,
+    user_rate_limit: initialConfig?.user_rate_limit ?? 0
+  })
+  const [retentionDays, setRetentionDays] = useState<number | null>(
+    initialConfig?.message_retention_days ?? null
+  )
+  const [llmBackend, setLlmBackend] = useState<BotConfig['llm_backend']>(
+    initialConfig?.llm_backend ?? null
+  )
+  const [answerCache, setAnswerCache] = useState(initialConfig?.answer_cache ?? false)
   const [memories, setMemories] = useState(initialMemories)
   const [userRoles, setUserRoles] = useState(initialUserRoles)
   
   // Knowledge state
-  const [knowledgeDocs, setKnowledgeDocs] = useState<KnowledgeDocument[]>([])
-  const [selectedDoc, setSelectedDoc] = useState<KnowledgeDocument | null>(null)
+  const [knowledgeDocs, setKnowledgeDocs] = useState<KnowledgeSource[]>([])
+  const [hasMoreDocs, setHasMoreDocs] = useState(false)
+  const [selectedDoc, setSelectedDoc] = useState<Pick<KnowledgeDocument, 'title' | 'filename' | 'content'> | null>(null)
   const [showDocModal, setShowDocModal] = useState(false)
   const [newDocTitle, setNewDocTitle] = useState('')
   const [newDocContent, setNewDocContent] = useState('')
   const [uploadingFile, setUploadingFile] = useState(false)
 
+  // Documents are listed from knowledge_sources, newest first, one keyset page at a time
+  const loadKnowledgePage = async (guildId: string, after?: KnowledgeSource) => {
+    const { data } = await supabase.rpc('list_knowledge_sources', {
+      p_guild_id: guildId,
+      p_limit: KNOWLEDGE_PAGE_SIZE,
+      p_before_created_at: after?.created_at ?? null,
+      p_before_id: after?.id ?? null
+    })
+    const page: KnowledgeSource[] = data || []
+    setKnowledgeDocs(prev => after ? [...prev, ...page] : page)
+    setHasMoreDocs(page.length === KNOWLEDGE_PAGE_SIZE)
+  }
+
   // Load data for selected guild
   const loadGuildData = async (guildId: string) => {
     setSaving(true)
@@ -93,6 +122,14 @@ Key behaviors:
       setBotName(guildConfig.bot_name || 'DasAI Assistant')
       setSystemInstructions(guildConfig.system_instructions || '')
       setAllowedChannels(guildConfig.allowed_channels?.join('\n') || '')
+      setRateLimits({
+        guild_rate_limit: guildConfig.guild_rate_limit ?? 0,
+        channel_rate_limit: guildConfig.channel_rate_limit ?? 0,
+        user_rate_limit: guildConfig.user_rate_limit ?? 0
+      })
+      setRetentionDays(guildConfig.message_retention_days ?? null)
+      setLlmBackend(guildConfig.llm_backend ?? null)
+      setAnswerCache(guildConfig.answer_cache ?? false)
     }
 
     // Fetch memories for this guild
@@ -115,30 +152,15 @@ Key behaviors:
     setUserRoles(guildRoles || [])
 
     // Fetch knowledge documents for this guild
-    const { data: guildDocs } = await supabase
-      .from('knowledge_documents')
-      .select('*')
-      .eq('guild_id', guildId)
-      .order('created_at', { ascending: false })
-      .limit(50)
-    
-    setKnowledgeDocs(guildDocs || [])
+    await loadKnowledgePage(guildId)
     
     setSaving(false)
   }
 
   // Load knowledge on mount
   useEffect(() => {
-    const loadKnowledge = async () => {
-      const { data } = await supabase
-        .from('knowledge_documents')
-        .select('*')
-        .eq('guild_id', currentGuildId)
-        .order('created_at', { ascending: false })
-        .limit(50)
-      setKnowledgeDocs(data || [])
-    }
-    loadKnowledge()
+    loadKnowledgePage(currentGuildId)
+    // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [currentGuildId, supabase])
 
   const handleGuildChange = async (guildId: string) => {
@@ -166,6 +188,10 @@ Key behaviors:
       bot_name: botName,
       system_instructions: systemInstructions,
       allowed_channels: channels,
+      ...rateLimits,
+      message_retention_days: retentionDays,
+      llm_backend: llmBackend,
+      answer_cache: answerCache,
       updated_at: new Date().toISOString()
     }
 
@@ -286,13 +312,9 @@ Key behaviors:
       setNewDocTitle('')
       setNewDocContent('')
       // Reload docs
-      const { data } = await supabase
-        .from('knowledge_documents')
-        .select('*')
-        .eq('guild_id', currentGuildId)
-        .order('created_at', { ascending: false })
-        .limit(50)
-      setKnowledgeDocs(data || [])
+      await loadKnowledgePage(currentGuildId)
+    } else if (error.code === '23505') {
+      showMessage('error', `A document titled "${newDocTitle}" already exists`)
     } else {
       showMessage('error', 'Failed to add document')
     }
@@ -300,18 +322,17 @@ Key behaviors:
     setSaving(false)
   }
 
-  const handleDeleteDocument = async (docId: string, docTitle: string) => {
+  const handleDeleteDocument = async (sourceId: string) => {
     setSaving(true)
 
-    // Delete all chunks with matching title
+    // Deleting the source removes all of its chunks (ON DELETE CASCADE)
     const { error } = await supabase
-      .from('knowledge_documents')
+      .from('knowledge_sources')
       .delete()
-      .eq('guild_id', currentGuildId)
-      .ilike('title', `${docTitle}%`)
+      .eq('id', sourceId)
 
     if (!error) {
-      setKnowledgeDocs(knowledgeDocs.filter(d => !d.title.startsWith(docTitle.replace(/ \(Part \d+\)$/, ''))))
+      setKnowledgeDocs(knowledgeDocs.filter(d => d.id !== sourceId))
       showMessage('success', 'Document deleted')
     } else {
       showMessage('error', 'Failed to delete document')
@@ -320,19 +341,17 @@ Key behaviors:
     setSaving(false)
   }
 
-  const handleViewDocument = async (doc: KnowledgeDocument) => {
-    // Fetch full document content (all chunks)
-    const baseTitle = doc.title.replace(/ \(Part \d+\)$/, '')
+  const handleViewDocument = async (doc: KnowledgeSource) => {
+    // Fetch full document content (text only, never the embeddings)
     const { data } = await supabase
       .from('knowledge_documents')
-      .select('*')
-      .eq('guild_id', currentGuildId)
-      .ilike('title', `${baseTitle}%`)
+      .select('content')
+      .eq('source_id', doc.id)
       .order('chunk_index')
     
     if (data && data.length > 0) {
       const fullContent = data.map(d => d.content).join('\n\n')
-      setSelectedDoc({ ...data[0], content: fullContent })
+      setSelectedDoc({ title: doc.title, filename: doc.filename, content: fullContent })
       setShowDocModal(true)
     }
   }
@@ -387,13 +406,9 @@ Key behaviors:
       if (!error) {
         showMessage('success', `Uploaded: ${file.name}`)
         // Reload docs
-        const { data } = await supabase
-          .from('knowledge_documents')
-          .select('*')
-          .eq('guild_id', currentGuildId)
-          .order('created_at', { ascending: false })
-          .limit(50)
-        setKnowledgeDocs(data || [])
+        await loadKnowledgePage(currentGuildId)
+      } else if (error.code === '23505') {
+        showMessage('error', `A document titled "${title}" already exists`)
       } else {
         showMessage('error', 'Failed to upload file')
       }
@@ -608,6 +623,40 @@ Key behaviors:
                     />
                   </div>
 
+                  <div className="space-y-2">
+                    <label className="block text-sm font-medium text-zinc-400">
+                      Model Backend
+                    </label>
+                    <select
+                      value={llmBackend ?? ''}
+                      onChange={(e) => setLlmBackend((e.target.value || null) as BotConfig['llm_backend'])}
+                      className="w-full px-4 py-3 input-elegant rounded-xl text-white focus:outline-none"
+                      aria-label="Model backend"
+                    >
+                      <option value="" className="bg-zinc-900">Server default</option>
+                      <option value="hf" className="bg-zinc-900">Hugging Face Inference</option>
+                      <option value="openai" className="bg-zinc-900">Self-hosted (OpenAI-compatible)</option>
+                    </select>
+                    <p className="text-xs text-zinc-600">
+                      Tried first for this server; the bot falls back to its other backends if it fails.
+                    </p>
+                  </div>
+
+                  <div className="space-y-2">
+                    <label className="flex items-center gap-3 text-sm font-medium text-zinc-400 cursor-pointer">
+                      <input
+                        type="checkbox"
+                        checked={answerCache}
+                        onChange={(e) => setAnswerCache(e.target.checked)}
+                        className="w-4 h-4 accent-blue-600"
+                      />
+                      Reuse answers to repeated questions
+                    </label>
+                    <p className="text-xs text-zinc-600">
+                      Questions very similar to a recent one get the same answer instantly. Cleared whenever the knowledge base or these instructions change.
+                    </p>
+                  </div>
+
                   <div className="space-y-2">
                     <label className="block text-sm font-medium text-zinc-400">
                       Instructions
@@ -665,6 +714,50 @@ Key behaviors:
                     </p>
                   </div>
 
+                  <div className="space-y-2">
+                    <label className="block text-sm font-medium text-zinc-400">
+                      Rate Limits (AI replies per minute, 0 = unlimited)
+                    </label>
+                    <div className="grid grid-cols-3 gap-4">
+                      {([
+                        ['guild_rate_limit', 'Per server'],
+                        ['channel_rate_limit', 'Per channel'],
+                        ['user_rate_limit', 'Per user']
+                      ] as const).map(([key, label]) => (
+                        <div key={key} className="space-y-1">
+                          <span className="block text-xs text-zinc-500">{label}</span>
+                          <input
+                            type="number"
+                            min={0}
+                            value={rateLimits[key]}
+                            onChange={(e) => setRateLimits({ ...rateLimits, [key]: Math.max(0, parseInt(e.target.value) || 0) })}
+                            className="w-full px-4 py-3 input-elegant rounded-xl text-white font-mono text-sm focus:outline-none"
+                          />
+                        </div>
+                      ))}
+                    </div>
+                    <p className="text-xs text-zinc-600">
+                      Messages over the limit get no reply; the bot reacts with ⏳ at most once a minute per limit.
+                    </p>
+                  </div>
+
+                  <div className="space-y-2">
+                    <label className="block text-sm font-medium text-zinc-400">
+                      Message History Retention (days)
+                    </label>
+                    <input
+                      type="number"
+                      min={1}
+                      value={retentionDays ?? ''}
+                      onChange={(e) => setRetentionDays(parseInt(e.target.value) > 0 ? parseInt(e.target.value) : null)}
+                      placeholder="Server default"
+                      className="w-full px-4 py-3 input-elegant rounded-xl text-white font-mono text-sm focus:outline-none"
+                    />
+                    <p className="text-xs text-zinc-600">
+                      Older messages are archived and removed from the database when the bot has an archive directory configured. Leave empty to use the server default (keep everything unless MESSAGE_RETENTION_DAYS is set).
+                    </p>
+                  </div>
+
                   <button
                     onClick={handleSaveConfig}
                     disabled={saving}
@@ -939,17 +1032,9 @@ Key behaviors:
                   {/* Document List */}
                   <div className="space-y-4">
                     <div className="flex items-center justify-between">
-                      <h3 className="text-sm font-medium text-zinc-300">Documents ({knowledgeDocs.length})</h3>
+                      <h3 className="text-sm font-medium text-zinc-300">Documents ({knowledgeDocs.length}{hasMoreDocs ? '+' : ''})</h3>
                       <button
-                        onClick={async () => {
-                          const { data } = await supabase
-                            .from('knowledge_documents')
-                            .select('*')
-                            .eq('guild_id', currentGuildId)
-                            .order('created_at', { ascending: false })
-                            .limit(50)
-                          setKnowledgeDocs(data || [])
-                        }}
+                        onClick={() => loadKnowledgePage(currentGuildId)}
                         className="flex items-center gap-2 px-3 py-1.5 text-xs text-zinc-400 hover:text-white hover:bg-white/5 rounded-lg transition-all duration-200"
                       >
                         <RefreshCw className="w-3 h-3" />
@@ -965,15 +1050,12 @@ Key behaviors:
                       </div>
                     ) : (
                       <div className="space-y-3">
-                        {/* Group by title (remove part numbers for grouping) */}
-                        {Array.from(new Set(knowledgeDocs.map(d => d.title.replace(/ \(Part \d+\)$/, '')))).map((baseTitle) => {
-                          const docs = knowledgeDocs.filter(d => d.title.startsWith(baseTitle))
-                          const firstDoc = docs[0]
-                          const totalChunks = docs.length
+                        {knowledgeDocs.map((doc) => {
+                          const totalChunks = doc.chunk_count
                           
                           return (
                             <div 
-                              key={baseTitle}
+                              key={doc.id}
                               className="p-4 glass-card rounded-xl flex items-center justify-between hover-lift"
                             >
                               <div className="flex items-center gap-4">
@@ -981,24 +1063,24 @@ Key behaviors:
                                   <FileText className="w-5 h-5 text-blue-400" />
                                 </div>
                                 <div>
-                                  <p className="text-white font-medium">{baseTitle}</p>
+                                  <p className="text-white font-medium">{doc.title}</p>
                                   <div className="flex items-center gap-3 text-xs text-zinc-600">
-                                    {firstDoc.filename && <span>{firstDoc.filename}</span>}
+                                    {doc.filename && <span>{doc.filename}</span>}
                                     <span>{totalChunks} chunk{totalChunks > 1 ? 's' : ''}</span>
-                                    <span>{new Date(firstDoc.created_at).toLocaleDateString()}</span>
+                                    <span>{new Date(doc.created_at).toLocaleDateString()}</span>
                                   </div>
                                 </div>
                               </div>
                               <div className="flex items-center gap-2">
                                 <button
-                                  onClick={() => handleViewDocument(firstDoc)}
+                                  onClick={() => handleViewDocument(doc)}
                                   className="p-2 text-zinc-500 hover:text-blue-400 hover:bg-blue-500/10 rounded-lg transition-all duration-200"
                                   title="View document"
                                 >
                                   <Eye className="w-4 h-4" />
                                 </button>
                                 <button
-                                  onClick={() => handleDeleteDocument(firstDoc.id, baseTitle)}
+                                  onClick={() => handleDeleteDocument(doc.id)}
                                   className="p-2 text-zinc-500 hover:text-red-400 hover:bg-red-500/10 rounded-lg transition-all duration-200"
                                   title="Delete document"
                                   disabled={saving}
@@ -1009,6 +1091,14 @@ Key behaviors:
                             </div>
                           )
                         })}
+                        {hasMoreDocs && (
+                          <button
+                            onClick={() => loadKnowledgePage(currentGuildId, knowledgeDocs[knowledgeDocs.length - 1])}
+                            className="w-full py-2 text-xs text-zinc-400 hover:text-white hover:bg-white/5 rounded-lg transition-all duration-200"
+                          >
+                            Load more
+                          </button>
+                        )}
                       </div>
                     )}
                   </div>
@@ -7,6 +7,12 @@ export interface BotConfig {
   system_instructions: string
   allowed_channels: string[]
   bot_name: string
+  guild_rate_limit: number
+  channel_rate_limit: number
+  user_rate_limit: number
+  message_retention_days: number | null
+  llm_backend: 'hf' | 'openai' | null
+  answer_cache: boolean
   created_at: string
   updated_at: string
 }
@@ -35,6 +41,7 @@ export interface Message {
 export interface KnowledgeDocument {
   id: string
   guild_id: string
+  source_id: string | null
   title: string
   filename: string | null
   content: string
@@ -44,6 +51,17 @@ export interface KnowledgeDocument {
   created_at: string
 }
 
+// One row per document; chunks in knowledge_documents point at it via source_id
+export interface KnowledgeSource {
+  id: string
+  guild_id: string
+  title: string
+  filename: string | null
+  chunk_count: number
+  char_count: number
+  created_at: string
+}
+
 export interface UserRole {
   id: string
   guild_id: string
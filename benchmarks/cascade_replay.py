@@ -0,0 +1,195 @@
+"""Replay stored messages through the model cascade and compare latency and cost.
+
+Each message is answered twice: once with everything on the large model (the
+behaviour without SMALL_MODEL) and once routed by bot.route_query(), with
+escalation to the large model for a share of small-model answers.
+
+Messages come from --archive (a MESSAGE_ARCHIVE_DIR .jsonl.gz export or any
+JSONL of messages rows), from the messages table (--supabase-url/--supabase-key,
+optionally --guild-id), or a built-in synthetic mix. Stored rows don't say
+whether the reply used knowledge or web context, so --context-rate of them are
+treated as having it (routed to the large model).
+
+Offline, latency and cost are modelled from token counts (prompt overhead plus
+the message; the stored bot_response length as output) with per-model prefill,
+decode and price settings. With --endpoint, each reply is actually generated by
+an OpenAI-compatible server hosting --small-model and --large-model, and the
+reported usage is used instead.
+
+Usage:
+    python benchmarks/cascade_replay.py
+    python benchmarks/cascade_replay.py --archive archive/messages_p2026_01.jsonl.gz
+    python benchmarks/cascade_replay.py --endpoint http://localhost:8000/v1 --small-model qwen2.5-1.5b --large-model llama-3.1-8b
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+
+SYNTHETIC = [
+    ('hi', 'Hey! How can I help?'),
+    ('thanks!', "You're welcome!"),
+    ('good morning', 'Good morning everyone!'),
+    ('lol', '😄'),
+    ('what time is the event today?', 'The event starts at 6pm server time.'),
+    ('who runs this server?', 'The server is run by the moderation team.'),
+    ('is the bot online?', 'Yes, I am online and ready to help.'),
+    ('where do I post bug reports', 'Please use the #bug-reports channel.'),
+    ('can you explain how the ranking system works and why my rank dropped after the last season reset?',
+     'Ranks are calculated from ' + 'your recent match results and decay over time. ' * 12),
+    ('my build fails with this error: ```ImportError: cannot import name x``` how do I debug it?',
+     'This usually means ' + 'a circular import or a missing module version. ' * 15),
+    ('compare the two subscription tiers and summarize the differences step by step',
+     'Here is a comparison: ' + 'the premium tier adds priority support and extra storage. ' * 14),
+    ('write a python function that parses the log format we use and explain the regex',
+     '```python\ndef parse(line):\n    ...\n```\n' + 'The regex matches timestamps and levels. ' * 12),
+]
+
+
+def load_rows(args: argparse.Namespace) -> List[Dict[str, str]]:
+    if args.archive:
+        opener = gzip.open if args.archive.endswith('.gz') else open
+        with opener(args.archive, 'rt', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    elif args.supabase_url:
+        from supabase import create_client
+        query = create_client(args.supabase_url, args.supabase_key).table('messages').select('content, bot_response')
+        if args.guild_id:
+            query = query.eq('guild_id', args.guild_id)
+        rows = query.order('created_at', desc=True).limit(args.limit).execute().data
+    else:
+        rng = random.Random(args.seed)
+        rows = [dict(zip(('content', 'bot_response'), rng.choice(SYNTHETIC))) for _ in range(args.limit)]
+    return [r for r in rows if r.get('content') and r.get('bot_response')][:args.limit]
+
+
+def fraction(key: str, salt: str) -> float:
+    """Deterministic pseudo-random number in [0, 1) per message."""
+    return int.from_bytes(hashlib.sha1(f'{salt}:{key}'.encode()).digest()[:4], 'little') / 2**32
+
+
+def modelled_call(args: argparse.Namespace, tier: str, row: Dict[str, str]) -> Dict[str, float]:
+    prompt_tokens = args.prompt_tokens + bot.count_tokens(row['content'])
+    completion_tokens = bot.count_tokens(row['bot_response'])
+    if tier == 'small':
+        completion_tokens = min(completion_tokens, bot.SMALL_MAX_TOKENS)
+    prefill, decode, price = {
+        'small': (args.small_prefill_ms, args.small_decode_ms, args.small_price),
+        'large': (args.large_prefill_ms, args.large_decode_ms, args.large_price),
+    }[tier]
+    return {
+        'latency': (prompt_tokens * prefill + completion_tokens * decode) / 1000,
+        'cost': (prompt_tokens + completion_tokens) * price / 1e6,
+        'tokens': prompt_tokens + completion_tokens,
+    }
+
+
+async def served_call(args: argparse.Namespace, backend: Any, tier: str, row: Dict[str, str]) -> Dict[str, float]:
+    messages = [{'role': 'system', 'content': 'You are a helpful AI assistant for a Discord server.'},
+                {'role': 'user', 'content': row['content']}]
+    model = args.small_model if tier == 'small' else args.large_model
+    start = time.perf_counter()
+    result = await backend.chat(messages, model, bot.SMALL_MAX_TOKENS if tier == 'small' else 1000, 0.7)
+    price = args.small_price if tier == 'small' else args.large_price
+    tokens = result['prompt_tokens'] + result['completion_tokens']
+    return {'latency': time.perf_counter() - start, 'cost': tokens * price / 1e6, 'tokens': tokens,
+            'weak': bot.is_weak_answer(result['content'])}
+
+
+async def replay(args: argparse.Namespace, rows: List[Dict[str, str]]) -> List[Tuple[str, Dict[str, Any]]]:
+    bot.SMALL_MODEL = args.small_model
+    backend = bot.OpenAIBackend(args.endpoint) if args.endpoint else None
+
+    async def call(tier: str, row: Dict[str, str]) -> Dict[str, float]:
+        if backend is not None:
+            return await served_call(args, backend, tier, row)
+        return modelled_call(args, tier, row)
+
+    strategies: Dict[str, List[Dict[str, float]]] = {'all large': [], 'cascade': []}
+    tiers = {'small': 0, 'escalated': 0}
+    try:
+        for i, row in enumerate(rows):
+            strategies['all large'].append(await call('large', row))
+            has_context = fraction(f"{i}:{row['content']}", 'context') < args.context_rate
+            tier, _, _ = bot.route_query(row['content'], has_context)
+            outcome = await call(tier, row)
+            if tier == 'small':
+                tiers['small'] += 1
+                weak = outcome.get('weak') if backend is not None else fraction(f"{i}:{row['content']}", 'escalate') < args.escalation_rate
+                if weak and args.escalate:
+                    tiers['escalated'] += 1
+                    retry = await call('large', row)
+                    outcome = {k: outcome[k] + retry[k] for k in ('latency', 'cost', 'tokens')}
+            strategies['cascade'].append(outcome)
+    finally:
+        if backend is not None:
+            await backend.close()
+
+    results = []
+    for name, calls in strategies.items():
+        latencies = sorted(c['latency'] for c in calls)
+        results.append((name, {
+            'small_share': tiers['small'] / len(rows) if name == 'cascade' else 0.0,
+            'escalated': tiers['escalated'] if name == 'cascade' else 0,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'cost': sum(c['cost'] for c in calls),
+            'tokens': sum(c['tokens'] for c in calls),
+        }))
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive', default='', help='JSONL(.gz) of messages rows')
+    parser.add_argument('--supabase-url', default='')
+    parser.add_argument('--supabase-key', default='')
+    parser.add_argument('--guild-id', default='')
+    parser.add_argument('--limit', type=int, default=500, help='messages to replay')
+    parser.add_argument('--context-rate', type=float, default=0.3, help='share of messages assumed to have RAG/web context')
+    parser.add_argument('--escalation-rate', type=float, default=0.1, help='share of small-model answers treated as weak (offline)')
+    parser.add_argument('--no-escalate', dest='escalate', action='store_false', help='replay without CASCADE_ESCALATE')
+    parser.add_argument('--prompt-tokens', type=int, default=800, help='system prompt and history tokens per reply (offline)')
+    parser.add_argument('--small-model', default=bot.SMALL_MODEL or 'small')
+    parser.add_argument('--large-model', default=bot.HF_MODEL)
+    parser.add_argument('--small-prefill-ms', type=float, default=0.05)
+    parser.add_argument('--small-decode-ms', type=float, default=6.0)
+    parser.add_argument('--large-prefill-ms', type=float, default=0.3)
+    parser.add_argument('--large-decode-ms', type=float, default=25.0)
+    parser.add_argument('--small-price', type=float, default=0.04, help='$ per 1M tokens')
+    parser.add_argument('--large-price', type=float, default=0.20, help='$ per 1M tokens')
+    parser.add_argument('--endpoint', default='', help='OpenAI-compatible base URL serving both models')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    rows = load_rows(args)
+    if not rows:
+        print('No messages with a bot response to replay.')
+        return 1
+    results = asyncio.run(replay(args, rows))
+    print(f'{len(rows)} messages, threshold {bot.CASCADE_THRESHOLD}, '
+          f"{'served by ' + args.endpoint if args.endpoint else 'modelled latency/cost'}")
+    print(f"{'strategy':<12}{'small %':>9}{'escalated':>11}{'p50 ms':>9}{'p95 ms':>9}{'tokens':>11}{'cost $':>10}")
+    for name, r in results:
+        print(f"{name:<12}{r['small_share']:>9.0%}{r['escalated']:>11}{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+              f"{r['tokens']:>11,}{r['cost']:>10.4f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
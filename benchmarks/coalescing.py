@@ -0,0 +1,163 @@
+"""LLM calls and answer latency for bursts of channel messages, with and without coalescing.
+
+Replays bursts through on_message against the fake Hugging Face and Supabase
+backends (fakes.py) in --channels channels at once. Most bursts are one user
+typing a question as 1-4 quick messages; --multi-user of them are several
+users talking at once. Messages in a burst are --min-gap to --max-gap seconds
+apart, and bursts are separated by a few quiet seconds. Gaps longer than the
+window, or messages arriving mid-generation, exercise cancellation.
+
+Runs once with COALESCE_WINDOW=0 (a reply per message) and once with
+--window. Reports LLM chat calls (per channel and per burst), replies sent,
+the coalesce.merged and coalesce.cancelled counters, and the time from each
+burst's last message to its reply.
+
+Usage:
+    python benchmarks/coalescing.py
+    python benchmarks/coalescing.py --channels 20 --bursts 8 --window 2
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeChannel, FakeGuild, FakeInferenceClient, FakeMessage, FakeSupabase, FakeUser,
+    install_fakes, next_snowflake,
+)
+
+PARTS = [
+    ['hey', 'quick question', 'how do I reset my password?'],
+    ['so the deploy failed again', 'what does the pipeline do after tests?'],
+    ['What are the office hours?'],
+    ['I read the onboarding doc', 'it mentions laptops', 'which model do new hires get?', 'and who orders it?'],
+    ['Where is the style guide?', 'the new one I mean'],
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_mode(args: argparse.Namespace, window: float) -> Dict[str, Any]:
+    bot.COALESCE_WINDOW = window
+    bot.metrics.clear()
+    bot.channel_bursts.clear()
+    hf = FakeInferenceClient(chat_latency=args.chat_latency, embed_latency=0.02, jitter=0.3)
+    db = FakeSupabase(latency=args.db_latency, jitter=0.3)
+    install_fakes(bot, hf=hf, db=db)
+    rng = random.Random(args.seed)
+
+    guild = FakeGuild(next_snowflake(), 'coalesce-guild')
+    guild_id = str(guild.id)
+    db.seed_knowledge(guild_id, 40)
+    db.table('bot_config').insert({
+        'guild_id': guild_id, 'guild_name': guild.name, 'bot_name': 'DasAI Assistant',
+        'system_instructions': 'You are a helpful assistant.', 'allowed_channels': [],
+        'guild_rate_limit': 0, 'channel_rate_limit': 0, 'user_rate_limit': 0,
+    }).execute()
+
+    # The same scripted traffic in both modes
+    scripts = []
+    for c in range(args.channels):
+        users = [FakeUser(next_snowflake(), f'user-{c}-{u}') for u in range(3)]
+        bursts = []
+        for _ in range(args.bursts):
+            if rng.random() < args.multi_user:
+                lines = [(rng.choice(users), rng.choice(sum(PARTS, []))) for _ in range(rng.randint(2, 3))]
+            else:
+                user = rng.choice(users)
+                lines = [(user, text) for text in rng.choice(PARTS)]
+            gaps = [rng.uniform(args.min_gap, args.max_gap) for _ in lines[1:]]
+            bursts.append((lines, gaps, rng.uniform(4.0, 6.0)))
+        scripts.append(bursts)
+
+    answer_latency: List[float] = []
+    unanswered = 0
+    handlers: List['asyncio.Task[None]'] = []
+    sent: List[FakeMessage] = []
+
+    async def channel_traffic(bursts: List[Any]):
+        nonlocal unanswered
+        channel = FakeChannel(next_snowflake(), guild)
+        await asyncio.sleep(rng.uniform(0, 1.0))
+        for lines, gaps, quiet in bursts:
+            last = None
+            for i, (user, text) in enumerate(lines):
+                if i:
+                    await asyncio.sleep(gaps[i - 1])
+                last = FakeMessage(text, user, channel)
+                last.sent_at = time.perf_counter()
+                channel.messages.append(last)
+                sent.append(last)
+                handlers.append(asyncio.create_task(bot.on_message(last)))
+            await asyncio.sleep(quiet)
+            if last.first_reply_at is None:
+                unanswered += 1
+            else:
+                answer_latency.append(last.first_reply_at - last.sent_at)
+
+    await asyncio.gather(*(channel_traffic(bursts) for bursts in scripts))
+    await asyncio.gather(*handlers)
+    bursts_sent = args.channels * args.bursts
+    return {
+        'window': window,
+        'messages': len(sent),
+        'bursts': bursts_sent,
+        'chats': hf.chat_calls,
+        'per_channel': hf.chat_calls / args.channels,
+        'per_burst': hf.chat_calls / bursts_sent,
+        'replies': sum(len(m.replies) for m in sent),
+        'merged': bot.metrics.get('coalesce.merged', 0),
+        'cancelled': bot.metrics.get('coalesce.cancelled', 0),
+        'p50': percentile(answer_latency, 50) * 1000,
+        'p95': percentile(answer_latency, 95) * 1000,
+        'unanswered': unanswered,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    return [await run_mode(args, window) for window in (0.0, args.window)]
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--bursts', type=int, default=5, help='bursts per channel')
+    parser.add_argument('--window', type=float, default=1.5, help='COALESCE_WINDOW for the coalesced run (s)')
+    parser.add_argument('--min-gap', type=float, default=0.2, help='shortest gap between messages in a burst (s)')
+    parser.add_argument('--max-gap', type=float, default=2.0, help='longest gap between messages in a burst (s)')
+    parser.add_argument('--multi-user', type=float, default=0.3, help='fraction of bursts from several users')
+    parser.add_argument('--chat-latency', type=float, default=0.5, help='mean chat completion latency (s)')
+    parser.add_argument('--db-latency', type=float, default=0.02, help='Supabase round trip (s)')
+    parser.add_argument('--seed', type=int, default=11)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f'{args.channels} channels x {args.bursts} bursts, gaps {args.min_gap:g}-{args.max_gap:g}s, '
+          f'chat latency {args.chat_latency:g}s')
+    print(f"{'window':<8}{'msgs':>6}{'LLM calls':>11}{'/channel':>10}{'/burst':>8}{'replies':>9}"
+          f"{'merged':>8}{'cancelled':>11}{'answer p50':>12}{'p95':>8}{'unanswered':>12}")
+    for r in results:
+        print(f"{r['window']:<8g}{r['messages']:>6}{r['chats']:>11}{r['per_channel']:>10.1f}{r['per_burst']:>8.2f}"
+              f"{r['replies']:>9}{r['merged']:>8}{r['cancelled']:>11}{r['p50']:>10.0f}ms{r['p95']:>6.0f}ms"
+              f"{r['unanswered']:>12}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
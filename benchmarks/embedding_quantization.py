@@ -0,0 +1,203 @@
+"""Compare float32, halfvec and binary-quantized embedding search layouts.
+
+Offline (default): builds a clustered synthetic corpus of 384-dim unit vectors
+(shaped like sentence embeddings: a shared mean direction plus topic clusters),
+runs the same two-stage search as search_documents_halfvec / _binary (quantized
+candidate scan, exact float re-rank of --candidates rows) with NumPy, and
+reports recall@5 against exact float32 search, the size of the vectors each
+index has to hold, an estimated on-disk index size, and per-query latency.
+In-process latency only shows relative scan cost; pgvector's SIMD distance
+kernels and HNSW graph traversal behave differently, so use --database-url for
+real numbers.
+
+Against Postgres (--database-url, --guild-id): samples stored embeddings from
+one guild as queries, computes exact top-5 with index scans disabled, then calls
+search_documents, search_documents_halfvec and search_documents_binary and
+reports recall@5, median latency and the actual size of each index (n/a when
+it has not been built; see EMBEDDING_INDEX).
+
+Usage:
+    python benchmarks/embedding_quantization.py
+    python benchmarks/embedding_quantization.py --corpus 200000 --candidates 80
+    python benchmarks/embedding_quantization.py --database-url postgresql://... --guild-id 123
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import EMBED_DIM, hamming_distances, quantize_binary  # noqa: E402
+
+TOP_K = 5
+HNSW_M = 16  # pgvector default
+# (search function, index name) per layout; keep in sync with EMBEDDING_INDEXES in bot.py
+LAYOUTS = {
+    'vector': ('search_documents', 'idx_knowledge_embedding'),
+    'halfvec': ('search_documents_halfvec', 'idx_knowledge_embedding_halfvec'),
+    'binary': ('search_documents_binary', 'idx_knowledge_embedding_binary'),
+}
+
+
+def make_corpus(n: int, queries: int, seed: int):
+    """Clustered unit vectors plus queries that are noisy copies of corpus rows."""
+    rng = np.random.default_rng(seed)
+    mean = rng.standard_normal(EMBED_DIM).astype(np.float32)
+    centers = rng.standard_normal((max(1, n // 50), EMBED_DIM)).astype(np.float32)
+    corpus = 0.6 * mean + centers[rng.integers(0, len(centers), n)] + 0.8 * rng.standard_normal((n, EMBED_DIM)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    picks = corpus[rng.integers(0, n, queries)]
+    query_vectors = picks + 0.05 * rng.standard_normal(picks.shape).astype(np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return corpus, query_vectors
+
+
+def estimated_index_bytes(layout: str, n: int) -> int:
+    """Rough pgvector index size: element tuples (value + neighbor list for HNSW) at ~90% page fill."""
+    value_bytes = {'vector': 4 + 4 * EMBED_DIM, 'halfvec': 4 + 2 * EMBED_DIM, 'binary': 8 + EMBED_DIM // 8}[layout]
+    if layout == 'vector':
+        per_row = value_bytes + 6 + 8  # IVFFlat list entry: vector + heap TID + tuple header
+    else:
+        per_row = value_bytes + 2 * HNSW_M * 6 + 24  # layer-0 neighbor TIDs + element header
+    return int(n * per_row / 0.9)
+
+
+def recall(found: List[List[int]], truth: List[List[int]]) -> float:
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / max(1, sum(len(t) for t in truth))
+
+
+def run_offline(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    corpus, queries = make_corpus(args.corpus, args.queries, args.seed)
+    truth = [list(np.argsort(-(corpus @ q))[:TOP_K]) for q in queries]
+
+    half = corpus.astype(np.float16)
+    bits = quantize_binary(corpus)
+    stored = {'vector': corpus, 'halfvec': half, 'binary': bits}
+
+    results = []
+    for layout in LAYOUTS:
+        found: List[List[int]] = []
+        timings: List[float] = []
+        for q in queries:
+            start = time.perf_counter()
+            if layout == 'vector':
+                top = np.argsort(-(corpus @ q))[:TOP_K]
+            else:
+                if layout == 'halfvec':
+                    # NumPy has no SIMD float16 kernels, so this overstates halfvec scan time
+                    coarse = -(half @ q.astype(np.float16)).astype(np.float32)
+                else:
+                    coarse = hamming_distances(bits, quantize_binary(q)).astype(np.float32)
+                candidates = np.argpartition(coarse, args.candidates)[:args.candidates]
+                exact = corpus[candidates] @ q  # re-rank reads float32 rows for the candidates only
+                top = candidates[np.argsort(-exact)[:TOP_K]]
+            timings.append(time.perf_counter() - start)
+            found.append(list(top))
+        results.append({
+            'layout': layout,
+            'recall_at_5': recall(found, truth),
+            'latency_ms': statistics.median(timings) * 1000,
+            'index_vector_bytes': stored[layout].nbytes,
+            'index_bytes': estimated_index_bytes(layout, args.corpus),
+        })
+    return results
+
+
+async def run_postgres(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    import asyncpg
+
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        samples = await conn.fetch(
+            '''SELECT embedding::text AS embedding FROM knowledge_documents
+               WHERE guild_id = $1 AND embedding IS NOT NULL ORDER BY random() LIMIT $2''',
+            args.guild_id, args.queries
+        )
+        if not samples:
+            raise SystemExit(f'No embedded knowledge chunks for guild {args.guild_id}')
+        queries = [r['embedding'] for r in samples]
+
+        truth: List[List[str]] = []
+        async with conn.transaction():
+            await conn.execute('SET LOCAL enable_indexscan = off')
+            await conn.execute('SET LOCAL enable_bitmapscan = off')
+            for q in queries:
+                rows = await conn.fetch(
+                    '''SELECT id FROM knowledge_documents WHERE guild_id = $1 AND embedding IS NOT NULL
+                       ORDER BY embedding <=> $2::vector LIMIT $3''',
+                    args.guild_id, q, TOP_K
+                )
+                truth.append([str(r['id']) for r in rows])
+
+        results = []
+        for layout, (function, index_name) in LAYOUTS.items():
+            extra = ', $4' if layout != 'vector' else ''
+            sql = f'SELECT id FROM {function}($1, $2::vector, -1, $3{extra})'
+            found: List[List[str]] = []
+            timings: List[float] = []
+            try:
+                for q in queries:
+                    start = time.perf_counter()
+                    query_args = [args.guild_id, q, TOP_K] + ([] if layout == 'vector' else [args.candidates])
+                    rows = await conn.fetch(sql, *query_args)
+                    timings.append(time.perf_counter() - start)
+                    found.append([str(r['id']) for r in rows])
+            except asyncpg.PostgresError as e:
+                print(f'{function}: {e}')
+                continue
+            size = await conn.fetchval('SELECT pg_relation_size(to_regclass($1))', index_name)
+            results.append({
+                'layout': layout,
+                'recall_at_5': recall(found, truth),
+                'latency_ms': statistics.median(timings) * 1000,
+                'index_vector_bytes': None,
+                'index_bytes': size,
+            })
+        return results
+    finally:
+        await conn.close()
+
+
+def fmt_bytes(n: Any) -> str:
+    if n is None:
+        return 'n/a'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+    return str(n)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', type=int, default=50000, help='synthetic chunks (offline mode)')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--candidates', type=int, default=40, help='rows re-ranked with float32 (EMBEDDING_CANDIDATES)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--database-url', default='', help='measure a real Postgres instead of the offline simulation')
+    parser.add_argument('--guild-id', default='', help='guild whose knowledge chunks are searched (with --database-url)')
+    args = parser.parse_args(argv)
+
+    if args.database_url:
+        results = asyncio.run(run_postgres(args))
+        size_label = 'index size'
+    else:
+        results = run_offline(args)
+        size_label = 'index size (est.)'
+
+    print(f"{'layout':<10}{'recall@5':>10}{'latency ms':>12}{'vectors in index':>18}{size_label:>20}")
+    for r in results:
+        print(f"{r['layout']:<10}{r['recall_at_5']:>10.3f}{r['latency_ms']:>12.2f}"
+              f"{fmt_bytes(r['index_vector_bytes']):>18}{fmt_bytes(r['index_bytes']):>20}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
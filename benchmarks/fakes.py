@@ -0,0 +1,859 @@
+"""In-process fakes for the services bot.py talks to.
+
+These stand in for Hugging Face's InferenceClient, the Supabase client, DDGS and
+the discord.py objects that event handlers receive, so bot.py can be driven
+offline. Latencies are simulated with blocking sleeps, matching how the real
+synchronous clients behave (executor threads for HF, the event loop for Supabase).
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import re
+import time
+import uuid
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+EMBED_DIM = 384
+
+_ids = itertools.count(10**17)
+
+
+def next_snowflake() -> int:
+    """Return a unique Discord-style integer ID."""
+    return next(_ids)
+
+
+def fake_embedding(text: str) -> np.ndarray:
+    """Deterministic unit-length embedding derived from the text hash."""
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+    vec = np.random.default_rng(seed).standard_normal(EMBED_DIM).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def _sleep_latency(mean: float, jitter: float, stall_rate: float = 0.0, stall: float = 0.0):
+    """Block for a log-normally jittered latency around `mean` seconds.
+
+    With probability `stall_rate` the call stalls for `stall` seconds instead (an upstream hiccup).
+    """
+    if stall_rate and random.random() < stall_rate:
+        time.sleep(stall)
+        return
+    if mean <= 0:
+        return
+    time.sleep(mean * random.lognormvariate(0, jitter) if jitter > 0 else mean)
+
+
+# Hugging Face
+
+class FakeInferenceClient:
+    """Stand-in for huggingface_hub.InferenceClient with configurable latency and output size.
+
+    `prefill_per_token` adds time per prompt token (whitespace-separated word), for
+    benchmarks where prompt length matters. `stall_rate` of the calls take `stall` seconds.
+    """
+
+    def __init__(self, chat_latency: float = 0.5, embed_latency: float = 0.05,
+                 tokens: int = 120, jitter: float = 0.3, prefill_per_token: float = 0.0,
+                 stall_rate: float = 0.0, stall: float = 10.0):
+        self.chat_latency = chat_latency
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.prefill_per_token = prefill_per_token
+        self.embed_latency = embed_latency
+        self.tokens = tokens
+        self.jitter = jitter
+        self.chat_calls = 0
+        self.embed_calls = 0
+
+    def chat_completion(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                        max_tokens: int = 1000, temperature: float = 0.7, **kwargs: Any) -> Any:
+        self.chat_calls += 1
+        n_tokens = min(self.tokens, max_tokens)
+        prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in messages)
+        # Generation time scales with the number of tokens produced, prefill with the prompt
+        _sleep_latency(self.chat_latency * n_tokens / max(self.tokens, 1) + self.prefill_per_token * prompt_tokens, self.jitter,
+                       self.stall_rate, self.stall)
+        if max_tokens <= 5:
+            content = 'NO'
+        else:
+            content = ' '.join(['lorem'] * n_tokens)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=n_tokens),
+        )
+
+    def feature_extraction(self, text: Any, model: Optional[str] = None, **kwargs: Any) -> np.ndarray:
+        self.embed_calls += 1
+        _sleep_latency(self.embed_latency, self.jitter, self.stall_rate, self.stall)
+        if isinstance(text, list):
+            return np.stack([fake_embedding(t) for t in text])
+        return fake_embedding(text)
+
+
+class FakeCrossEncoder:
+    """Stand-in for sentence_transformers.CrossEncoder: scores pairs by word overlap, with a per-pair cost."""
+
+    def __init__(self, latency_per_pair: float = 0.002):
+        self.latency_per_pair = latency_per_pair
+        self.batches = 0
+
+    def predict(self, pairs: List[Any], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        self.batches += 1
+        time.sleep(self.latency_per_pair * len(pairs))
+        scores = []
+        for query, passage in pairs:
+            q, p = set(re.findall(r'\w+', query.lower())), set(re.findall(r'\w+', passage.lower()))
+            scores.append(len(q & p) / (len(q) or 1))
+        return np.asarray(scores, dtype=np.float32)
+
+
+class FakeLLMServer:
+    """OpenAI-compatible chat server (the API vLLM and TGI expose) with a prefix KV cache.
+
+    The prompt is rendered through a simple chat template and split into 16-token blocks;
+    like vLLM's automatic prefix caching, a block is reused only if every block before it
+    matched too. Prefill costs `prefill_per_token` seconds per uncached token and is
+    serialized (one GPU), then `decode_per_token` per generated token is streamed.
+    Run it with ``await server.start()`` and point clients at ``server.url``.
+    """
+
+    BLOCK_SIZE = 16
+
+    def __init__(self, prefill_per_token: float = 0.0002, decode_per_token: float = 0.01,
+                 tokens: int = 40, cache_blocks: int = 4096):
+        self.prefill_per_token = prefill_per_token
+        self.decode_per_token = decode_per_token
+        self.tokens = tokens
+        self.cache_blocks = cache_blocks
+        self.blocks: 'OrderedDict[int, None]' = OrderedDict()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.requests = 0
+        self.url = ''
+        self._prefill_lock = asyncio.Lock()
+        self._runner: Any = None
+
+    @staticmethod
+    def render(messages: List[Dict[str, str]]) -> List[str]:
+        text = ''.join(f"<|{m.get('role', 'user')}|>\n{m.get('content', '')}\n" for m in messages)
+        return re.findall(r'\w+|[^\w\s]', text)
+
+    def reset_cache(self):
+        self.blocks.clear()
+        self.prompt_tokens = self.cached_tokens = self.requests = 0
+
+    def _prefill(self, tokens: List[str]) -> int:
+        """Look up and insert the prompt's blocks; return the number of cached tokens."""
+        cached = 0
+        prefix_hash = 0
+        matching = True
+        for start in range(0, len(tokens) - len(tokens) % self.BLOCK_SIZE, self.BLOCK_SIZE):
+            prefix_hash = hash((prefix_hash, tuple(tokens[start:start + self.BLOCK_SIZE])))
+            if matching and prefix_hash in self.blocks:
+                cached += self.BLOCK_SIZE
+                self.blocks.move_to_end(prefix_hash)
+                continue
+            matching = False
+            self.blocks[prefix_hash] = None
+            if len(self.blocks) > self.cache_blocks:
+                self.blocks.popitem(last=False)
+        return cached
+
+    async def _chat(self, request: Any) -> Any:
+        from aiohttp import web
+
+        body = await request.json()
+        tokens = self.render(body.get('messages', []))
+        n_out = min(self.tokens, int(body.get('max_tokens') or self.tokens))
+        async with self._prefill_lock:
+            cached = self._prefill(tokens)
+            await asyncio.sleep((len(tokens) - cached) * self.prefill_per_token)
+        self.requests += 1
+        self.prompt_tokens += len(tokens)
+        self.cached_tokens += cached
+        usage = {'prompt_tokens': len(tokens), 'completion_tokens': n_out,
+                 'prompt_tokens_details': {'cached_tokens': cached}}
+
+        if not body.get('stream'):
+            await asyncio.sleep(n_out * self.decode_per_token)
+            return web.json_response({
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(['lorem'] * n_out)},
+                             'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for _ in range(n_out):
+            chunk = {'choices': [{'index': 0, 'delta': {'content': 'lorem '}}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await asyncio.sleep(self.decode_per_token)
+        final = {'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'usage': usage}
+        await response.write(f'data: {json.dumps(final)}\n\ndata: [DONE]\n\n'.encode())
+        return response
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self._chat)
+        app.router.add_get('/v1/models', lambda request: web.json_response({'data': [{'id': 'fake', 'object': 'model'}]}))
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# Supabase
+
+class _Result:
+    def __init__(self, data: Any):
+        self.data = data
+
+
+class FakeQuery:
+    """Minimal PostgREST query builder over an in-memory table."""
+
+    def __init__(self, db: 'FakeSupabase', table: str):
+        self.db = db
+        self.table_name = table
+        self.op = 'select'
+        self.columns = '*'
+        self.payload: Any = None
+        self.on_conflict: Optional[str] = None
+        self.filters: List[Any] = []
+        self.order_by: Optional[str] = None
+        self.order_desc = False
+        self.limit_n: Optional[int] = None
+        self.range_: Optional[Any] = None
+        self.is_single = False
+        self.negate_next = False
+
+    # Operations
+    def select(self, columns: str = '*', **kwargs: Any) -> 'FakeQuery':
+        self.op, self.columns = 'select', columns
+        return self
+
+    def insert(self, payload: Any, **kwargs: Any) -> 'FakeQuery':
+        self.op, self.payload = 'insert', payload
+        return self
+
+    def upsert(self, payload: Any, on_conflict: Optional[str] = None, **kwargs: Any) -> 'FakeQuery':
+        self.op, self.payload, self.on_conflict = 'upsert', payload, on_conflict
+        return self
+
+    def update(self, payload: Dict[str, Any], **kwargs: Any) -> 'FakeQuery':
+        self.op, self.payload = 'update', payload
+        return self
+
+    def delete(self, **kwargs: Any) -> 'FakeQuery':
+        self.op = 'delete'
+        return self
+
+    # Filters and modifiers
+    def _filter(self, predicate: Any) -> 'FakeQuery':
+        if self.negate_next:
+            self.negate_next = False
+            self.filters.append(lambda row: not predicate(row))
+        else:
+            self.filters.append(predicate)
+        return self
+
+    @property
+    def not_(self) -> 'FakeQuery':
+        self.negate_next = True
+        return self
+
+    def eq(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) == value)
+
+    def neq(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) != value)
+
+    def is_(self, column: str, value: Any) -> 'FakeQuery':
+        want_null = str(value).lower() == 'null'
+        return self._filter(lambda row: (row.get(column) is None) == want_null)
+
+    def in_(self, column: str, values: List[Any]) -> 'FakeQuery':
+        allowed = set(values)
+        return self._filter(lambda row: row.get(column) in allowed)
+
+    def lt(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) < value)
+
+    def gt(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) > value)
+
+    def ilike(self, column: str, pattern: str) -> 'FakeQuery':
+        needle = pattern.strip('%').lower()
+        return self._filter(lambda row: needle in str(row.get(column, '')).lower())
+
+    def order(self, column: str, desc: bool = False, **kwargs: Any) -> 'FakeQuery':
+        self.order_by, self.order_desc = column, desc
+        return self
+
+    def limit(self, n: int) -> 'FakeQuery':
+        self.limit_n = n
+        return self
+
+    def range(self, start: int, end: int) -> 'FakeQuery':
+        self.range_ = (start, end)
+        return self
+
+    def single(self) -> 'FakeQuery':
+        self.is_single = True
+        return self
+
+    def _project(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        if self.columns.strip() == '*':
+            return dict(row)
+        cols = [c.strip() for c in self.columns.split(',')]
+        return {c: row.get(c) for c in cols}
+
+    def _matches(self, row: Dict[str, Any]) -> bool:
+        return all(f(row) for f in self.filters)
+
+    def execute(self) -> _Result:
+        self.db.queries += 1
+        _sleep_latency(self.db.latency, self.db.jitter)
+        rows = self.db.tables.setdefault(self.table_name, [])
+
+        if self.op in ('insert', 'upsert'):
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            written = []
+            for item in payload:
+                existing = None
+                if self.op == 'upsert' and self.on_conflict:
+                    keys = [k.strip() for k in self.on_conflict.split(',')]
+                    existing = next((r for r in rows if all(r.get(k) == item.get(k) for k in keys)), None)
+                if existing is not None:
+                    existing.update(item)
+                    written.append(dict(existing))
+                else:
+                    row = {'id': str(uuid.uuid4()), 'created_at': self.db.now()}
+                    row.update(item)
+                    if self.table_name == 'knowledge_documents':
+                        self.db.link_knowledge_source(row)
+                    rows.append(row)
+                    written.append(dict(row))
+            return _Result(written)
+
+        matched = [r for r in rows if self._matches(r)]
+        if self.op == 'update':
+            for r in matched:
+                r.update(self.payload)
+            return _Result([dict(r) for r in matched])
+        if self.op == 'delete':
+            self.db.tables[self.table_name] = [r for r in rows if not self._matches(r)]
+            self.db.after_delete(self.table_name, matched)
+            return _Result([dict(r) for r in matched])
+
+        if self.order_by:
+            matched.sort(key=lambda r: (r.get(self.order_by) is None, r.get(self.order_by)), reverse=self.order_desc)
+        if self.range_:
+            matched = matched[self.range_[0]:self.range_[1] + 1]
+        if self.limit_n is not None:
+            matched = matched[:self.limit_n]
+        data = [self._project(r) for r in matched]
+        if self.is_single:
+            return _Result(data[0] if data else None)
+        return _Result(data)
+
+
+class _RpcCall:
+    def __init__(self, db: 'FakeSupabase', name: str, params: Dict[str, Any]):
+        self.db, self.name, self.params = db, name, params
+
+    def execute(self) -> _Result:
+        self.db.queries += 1
+        _sleep_latency(self.db.latency, self.db.jitter)
+        handler = self.db.rpc_handlers.get(self.name)
+        if handler is None:
+            raise RuntimeError(f'Unknown RPC: {self.name}')
+        return _Result(handler(self.db, self.params))
+
+
+def _rpc_search_documents(db: 'FakeSupabase', params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Brute-force cosine search matching the search_documents SQL function."""
+    query = np.asarray(params['query_embedding'], dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+    threshold = float(params.get('match_threshold', 0.5))
+    rows = [r for r in db.tables.get('knowledge_documents', [])
+            if r.get('guild_id') == params['p_guild_id'] and r.get('embedding') is not None]
+    if not rows:
+        return []
+    matrix = np.asarray([r['embedding'] for r in rows], dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ query
+    order = np.argsort(-scores)[:int(params.get('match_count', 5))]
+    return [
+        {'id': rows[i]['id'], 'title': rows[i]['title'], 'content': rows[i]['content'], 'similarity': float(scores[i])}
+        for i in order if scores[i] > threshold
+    ]
+
+
+# Popcount of every byte value, for Hamming distance over np.packbits output
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """pgvector binary_quantize(): one bit per dimension, set when the value is positive."""
+    return np.packbits(vectors > 0, axis=-1)
+
+
+def hamming_distances(bits: np.ndarray, query_bits: np.ndarray) -> np.ndarray:
+    return POPCOUNT[np.bitwise_xor(bits, query_bits)].sum(axis=1, dtype=np.int32)
+
+
+def _rpc_search_documents_quantized(mode: str):
+    """Two-stage search matching search_documents_halfvec / search_documents_binary."""
+    def handler(db: 'FakeSupabase', params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        query = np.asarray(params['query_embedding'], dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        rows = [r for r in db.tables.get('knowledge_documents', [])
+                if r.get('guild_id') == params['p_guild_id'] and r.get('embedding') is not None]
+        if not rows:
+            return []
+        matrix = np.asarray([r['embedding'] for r in rows], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        if mode == 'halfvec':
+            coarse = matrix.astype(np.float16).astype(np.float32) @ query.astype(np.float16).astype(np.float32)
+        else:
+            coarse = -hamming_distances(quantize_binary(matrix), quantize_binary(query)).astype(np.float32)
+        candidates = np.argsort(-coarse, kind='stable')[:int(params.get('p_candidates', 40))]
+        exact = matrix[candidates] @ query
+        threshold = float(params.get('match_threshold', 0.5))
+        ranked = [(int(candidates[i]), float(exact[i])) for i in np.argsort(-exact)[:int(params.get('match_count', 5))]]
+        return [
+            {'id': rows[i]['id'], 'title': rows[i]['title'], 'content': rows[i]['content'], 'similarity': score}
+            for i, score in ranked if score > threshold
+        ]
+    return handler
+
+
+def _rpc_claim_unembedded_documents(db: 'FakeSupabase', params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    rows = [r for r in db.tables.get('knowledge_documents', [])
+            if r.get('embedding') is None and not r.get('embedding_claimed_at')]
+    claimed = rows[:int(params.get('batch_size', 32))]
+    for r in claimed:
+        r['embedding_claimed_at'] = db.now()
+    return [{'id': r['id'], 'content': r['content']} for r in claimed]
+
+
+def _rpc_set_document_embeddings(db: 'FakeSupabase', params: Dict[str, Any]) -> int:
+    vectors = dict(zip(params['p_ids'], params['p_embeddings']))
+    updated = 0
+    for r in db.tables.get('knowledge_documents', []):
+        if r['id'] in vectors:
+            r['embedding'] = json.loads(vectors[r['id']])
+            r['embedding_claimed_at'] = None
+            updated += 1
+    return updated
+
+
+def _rpc_list_knowledge_sources(db: 'FakeSupabase', params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    rows = [r for r in db.tables.get('knowledge_sources', []) if r['guild_id'] == params['p_guild_id']]
+    rows.sort(key=lambda r: (r['created_at'], r['id']), reverse=True)
+    if params.get('p_before_created_at') is not None:
+        before = (params['p_before_created_at'], params['p_before_id'])
+        rows = [r for r in rows if (r['created_at'], r['id']) < before]
+    return [dict(r) for r in rows[:int(params.get('p_limit', 20))]]
+
+
+def _rpc_get_reply_context(db: 'FakeSupabase', params: Dict[str, Any]) -> Dict[str, Any]:
+    """Config, memory and top chunks in one call, matching the get_reply_context SQL function."""
+    guild_id, channel_id = params['p_guild_id'], params['p_channel_id']
+    config = next((dict(r) for r in db.tables.get('bot_config', []) if r.get('guild_id') == guild_id), None)
+    memory = next(({'summary': r.get('summary', ''), 'message_count': r.get('message_count', 0)}
+                   for r in db.tables.get('conversation_memory', [])
+                   if r.get('guild_id') == guild_id and r.get('channel_id') == channel_id), None)
+    chunks: List[Dict[str, Any]] = []
+    if params.get('query_embedding') is not None and int(params.get('match_count', 5)) > 0:
+        mode = params.get('p_search_mode', 'vector')
+        search = _rpc_search_documents if mode == 'vector' else _rpc_search_documents_quantized(mode)
+        chunks = search(db, params)
+    return {'config': config, 'memory': memory, 'chunks': chunks}
+
+
+def _rpc_record_exchange(db: 'FakeSupabase', params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Message insert plus memory counter upsert, matching the record_exchange SQL function."""
+    guild_id, channel_id = params['p_guild_id'], params['p_channel_id']
+    db.tables.setdefault('messages', []).append({
+        'id': str(uuid.uuid4()), 'created_at': db.now(), 'guild_id': guild_id, 'channel_id': channel_id,
+        'user_id': params['p_user_id'], 'username': params['p_username'], 'content': params['p_content'],
+        'bot_response': params.get('p_bot_response'),
+    })
+    rows = db.tables.setdefault('conversation_memory', [])
+    memory = next((r for r in rows if r.get('guild_id') == guild_id and r.get('channel_id') == channel_id), None)
+    if memory is None:
+        memory = {'id': str(uuid.uuid4()), 'created_at': db.now(), 'guild_id': guild_id, 'channel_id': channel_id,
+                  'summary': '', 'message_count': 0}
+        rows.append(memory)
+    memory['message_count'] = int(memory.get('message_count') or 0) + 1
+    return [{'summary': memory['summary'], 'message_count': memory['message_count']}]
+
+
+class FakeSupabase:
+    """In-memory stand-in for supabase.Client covering the calls bot.py makes."""
+
+    def __init__(self, latency: float = 0.01, jitter: float = 0.3):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.queries = 0
+        self.rpc_handlers: Dict[str, Any] = {
+            'search_documents': _rpc_search_documents,
+            'search_documents_halfvec': _rpc_search_documents_quantized('halfvec'),
+            'search_documents_binary': _rpc_search_documents_quantized('binary'),
+            'claim_unembedded_documents': _rpc_claim_unembedded_documents,
+            'set_document_embeddings': _rpc_set_document_embeddings,
+            'list_knowledge_sources': _rpc_list_knowledge_sources,
+            'get_reply_context': _rpc_get_reply_context,
+            'record_exchange': _rpc_record_exchange,
+        }
+        self._clock = 0
+        self._source_index: Dict[Any, Dict[str, Any]] = {}
+
+    def now(self) -> str:
+        """Monotonic ISO-like timestamp so ordering by created_at is stable."""
+        self._clock += 1
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f'.{self._clock:06d}+00:00'
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None) -> _RpcCall:
+        return _RpcCall(self, name, params or {})
+
+    def link_knowledge_source(self, chunk: Dict[str, Any]):
+        """Mirror the link_knowledge_source trigger: attach a new chunk to its source row, rejecting a taken title."""
+        if chunk.get('source_id'):
+            return
+        title = re.sub(r' \(Part \d+\)$', '', chunk['title'])
+        sources = self.tables.setdefault('knowledge_sources', [])
+        source = self._source_index.get((chunk['guild_id'], title))
+        if source is not None and not chunk.get('chunk_index'):
+            raise RuntimeError(f'duplicate key value violates unique constraint: knowledge document "{title}" already exists')
+        if source is None:
+            source = {'id': str(uuid.uuid4()), 'guild_id': chunk['guild_id'], 'title': title,
+                      'filename': chunk.get('filename'), 'chunk_count': 0, 'char_count': 0,
+                      'created_at': chunk.get('created_at') or self.now()}
+            sources.append(source)
+            self._source_index[(chunk['guild_id'], title)] = source
+        source['chunk_count'] += 1
+        source['char_count'] += len(chunk.get('content', ''))
+        chunk['source_id'] = source['id']
+
+    def after_delete(self, table: str, deleted: List[Dict[str, Any]]):
+        """Mirror ON DELETE CASCADE from sources and the unlink_knowledge_source trigger."""
+        if table == 'knowledge_sources' and deleted:
+            ids = {r['id'] for r in deleted}
+            for r in deleted:
+                self._source_index.pop((r['guild_id'], r['title']), None)
+            self.tables['knowledge_documents'] = [
+                r for r in self.tables.get('knowledge_documents', []) if r.get('source_id') not in ids
+            ]
+        elif table == 'knowledge_documents':
+            for r in deleted:
+                source = next((s for s in self.tables.get('knowledge_sources', []) if s['id'] == r.get('source_id')), None)
+                if source is None:
+                    continue
+                source['chunk_count'] -= 1
+                source['char_count'] -= len(r.get('content', ''))
+                if source['chunk_count'] <= 0:
+                    self.tables['knowledge_sources'].remove(source)
+                    self._source_index.pop((source['guild_id'], source['title']), None)
+
+    def seed_knowledge(self, guild_id: str, n_chunks: int, chunk_chars: int = 800, chunks_per_doc: int = 4):
+        """Insert `n_chunks` embedded knowledge chunks for a guild, `chunks_per_doc` per document."""
+        rows = self.tables.setdefault('knowledge_documents', [])
+        for i in range(n_chunks):
+            content = f'Document {i} for guild {guild_id}. ' + ('knowledge ' * (chunk_chars // 10))
+            row = {
+                'id': str(uuid.uuid4()),
+                'guild_id': guild_id,
+                'title': f'Doc {i // chunks_per_doc} (Part {i % chunks_per_doc + 1})',
+                'filename': None,
+                'content': content,
+                'chunk_index': i % chunks_per_doc,
+                'embedding': fake_embedding(content).tolist(),
+                'metadata': {'total_chunks': chunks_per_doc},
+                'created_at': self.now(),
+            }
+            self.link_knowledge_source(row)
+            rows.append(row)
+
+
+# DuckDuckGo
+
+class FakeDDGS:
+    """Stand-in for ddgs.DDGS; latency is configured on the class."""
+
+    latency = 0.3
+    jitter = 0.3
+    calls = 0
+
+    def __enter__(self) -> 'FakeDDGS':
+        return self
+
+    def __exit__(self, *exc: Any):
+        return False
+
+    def text(self, query: str, max_results: int = 5) -> List[Dict[str, str]]:
+        FakeDDGS.calls += 1
+        _sleep_latency(self.latency, self.jitter)
+        return [
+            {'title': f'Result {i} for {query}', 'href': f'https://example.com/{i}', 'body': f'Snippet {i} about {query}.'}
+            for i in range(max_results)
+        ]
+
+
+# Discord
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f'<@{user_id}>'
+
+    def __eq__(self, other: Any) -> bool:
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.shard_id = 0
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc: Any):
+        return False
+
+
+class FakeChannel:
+    """Text channel that keeps its own message history."""
+
+    def __init__(self, channel_id: int, guild: FakeGuild, history_size: int = 50):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f'channel-{channel_id}'
+        self.messages: List['FakeMessage'] = []
+        self.history_size = history_size
+
+    def typing(self) -> _Typing:
+        return _Typing()
+
+    async def history(self, limit: int = 100):
+        for msg in list(reversed(self.messages[-limit:])):
+            yield msg
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> 'FakeMessage':
+        return self._record(content or '', author=None)
+
+    def _record(self, content: str, author: Optional[FakeUser]) -> 'FakeMessage':
+        msg = FakeMessage(content, author or BOT_USER, self)
+        self.messages.append(msg)
+        del self.messages[:-self.history_size]
+        return msg
+
+
+class FakeMessage:
+    """Subset of discord.Message used by bot.py's handlers."""
+
+    _state = None  # commands.Context copies this; nothing reads it for non-command messages
+
+    def __init__(self, content: str, author: FakeUser, channel: FakeChannel, mentions: Optional[List[Any]] = None):
+        self.id = next_snowflake()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = mentions or []
+        self.attachments: List[Any] = []
+        self.reference: Any = None
+        self.created_at = time.time()
+        self.replies: List[str] = []
+        self.reactions: List[str] = []
+        self.first_reply_at: Optional[float] = None
+
+    async def add_reaction(self, emoji: str):
+        self.reactions.append(emoji)
+
+    async def reply(self, content: Optional[str] = None, **kwargs: Any) -> 'FakeMessage':
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        self.replies.append(content or '')
+        return self.channel._record(content or '', author=None)
+
+
+class _FakeResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kwargs: Any):
+        self._done = True
+
+    async def send_message(self, content: Optional[str] = None, **kwargs: Any):
+        self._done = True
+        self.interaction._record(content, kwargs)
+
+
+class _FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any):
+        self.interaction._record(content, kwargs)
+
+
+class FakeInteraction:
+    """Subset of discord.Interaction used by the slash-command callbacks."""
+
+    def __init__(self, user: FakeUser, channel: FakeChannel):
+        self.id = next_snowflake()
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.response = _FakeResponse(self)
+        self.followup = _FakeFollowup(self)
+        self.sent: List[Any] = []
+        self.first_reply_at: Optional[float] = None
+
+    def _record(self, content: Any, kwargs: Dict[str, Any]):
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        self.sent.append(content if content is not None else kwargs.get('embed'))
+
+
+class FakeGateway:
+    """Stands in for a discord.py client's gateway websocket.
+
+    Feeds GUILD_CREATE and MESSAGE_CREATE payloads into the client's connection
+    state, and answers member chunk requests the way Discord does (1000 members
+    per GUILD_MEMBERS_CHUNK). Member payloads are generated on demand, so the
+    fake itself holds no per-member data.
+    """
+    CHUNK_SIZE = 1000
+
+    def __init__(self, client: Any):
+        self.state = client._connection
+        self.state.dispatch = lambda *args, **kwargs: None  # feed the caches only, run no handlers
+        self.self_id = int(self.state.self_id or BOT_USER.id)
+        self.member_counts: Dict[int, int] = {}
+        self.chunks_sent = 0
+        self.pending: List[asyncio.Task] = []
+        client.ws = self
+
+    @staticmethod
+    def member_payload(guild_id: int, index: int) -> Dict[str, Any]:
+        user_id = guild_id * 100_000 + index + 1
+        return {
+            'user': {'id': str(user_id), 'username': f'user{user_id}', 'global_name': f'User {index}',
+                     'discriminator': '0', 'avatar': None},
+            'nick': None, 'roles': [], 'joined_at': '2026-01-01T00:00:00+00:00', 'deaf': False, 'mute': False,
+            'flags': 0,
+        }
+
+    def guild_create(self, guild_id: int, members: int, channels: int = 5):
+        """Send GUILD_CREATE for a large guild; like Discord, only the bot's own member is included."""
+        self.member_counts[guild_id] = members
+        me = {'user': {'id': str(self.self_id), 'username': 'DasAI', 'discriminator': '0', 'avatar': None, 'bot': True},
+              'roles': [], 'joined_at': '2026-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+        self.state.parse_guild_create({
+            'id': str(guild_id), 'name': f'Guild {guild_id}', 'owner_id': str(guild_id * 100_000 + 1),
+            'large': members > 250, 'member_count': members + 1, 'features': [], 'emojis': [], 'stickers': [],
+            'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '104324673', 'position': 0,
+                       'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'channels': [{'id': str(guild_id * 100 + c), 'type': 0, 'name': f'channel-{c}', 'position': c,
+                          'permission_overwrites': []} for c in range(channels)],
+            'members': [me], 'voice_states': [], 'presences': [], 'threads': [],
+        })
+
+    def message_create(self, guild_id: int, channel_index: int, author_index: int, content: str):
+        member = self.member_payload(guild_id, author_index)
+        self.state.parse_message_create({
+            'id': str(next_snowflake()), 'channel_id': str(guild_id * 100 + channel_index), 'guild_id': str(guild_id),
+            'author': member.pop('user'), 'member': member, 'content': content, 'timestamp': '2026-01-01T00:00:00+00:00',
+            'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [],
+            'attachments': [], 'embeds': [], 'pinned': False, 'type': 0,
+        })
+
+    async def request_chunks(self, guild_id: int, query: Optional[str] = None, *, limit: int,
+                             user_ids: Optional[List[int]] = None, presences: bool = False,
+                             nonce: Optional[str] = None):
+        # Chunks arrive as separate events after the request returns
+        self.pending.append(asyncio.create_task(self._send_chunks(guild_id, nonce)))
+
+    async def _send_chunks(self, guild_id: int, nonce: Optional[str]):
+        total = self.member_counts.get(guild_id, 0)
+        count = max(1, -(-total // self.CHUNK_SIZE))
+        for index in range(count):
+            await asyncio.sleep(0)
+            start = index * self.CHUNK_SIZE
+            members = [self.member_payload(guild_id, i) for i in range(start, min(start + self.CHUNK_SIZE, total))]
+            self.state.parse_guild_members_chunk({'guild_id': str(guild_id), 'members': members, 'chunk_index': index,
+                                                  'chunk_count': count, 'nonce': nonce})
+            self.chunks_sent += 1
+
+    async def drain(self):
+        """Wait until discord.py has requested and received every guild's members, if it chunks them."""
+        while self.state._chunk_guilds and not all(guild.chunked for guild in self.state.guilds):
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*self.pending)
+        self.pending.clear()
+
+
+BOT_USER = FakeUser(1, 'DasAI', bot=True)
+
+
+def install_fakes(bot_module: Any, hf: Optional[FakeInferenceClient] = None,
+                  db: Optional[Any] = None, ddgs: Any = FakeDDGS):
+    """Point bot.py's module-level clients at the fakes and mark every backend available."""
+    bot_module.hf_client = hf or FakeInferenceClient()
+    bot_module.supabase = db if db is not None else FakeSupabase()
+    bot_module.DDGS = ddgs
+    bot_module.hf_available = True
+    bot_module.embedding_available = True
+    bot_module.web_search_available = True
+    bot_module.clients_ready.set()  # skip init_clients()
+    # discord.py reads the logged-in user from the connection state
+    bot_module.bot._connection.user = BOT_USER
+    return bot_module.hf_client, bot_module.supabase
+
+
+async def measure_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.01):
+    """Record how late the event loop wakes up from a fixed-interval sleep."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
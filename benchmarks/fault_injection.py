@@ -0,0 +1,264 @@
+"""Fault injection against the circuit breakers, adaptive timeouts and degraded replies.
+
+Answers messages through on_message with the fake Hugging Face, Supabase and
+DDGS backends (fakes.py) while faults are injected into one dependency at a
+time: errors, hangs and recovery. For each phase it reports the reply latency,
+how many replies were normal, degraded (the no-backend notice) or errors, and
+the breaker states afterwards, then checks the expected behaviour:
+
+    healthy        normal replies; latency histograms fill up
+    chat down      after BREAKER_FAILURES errors the chat breaker opens and
+                   replies become the instant degraded-mode notice
+    chat recovers  after BREAKER_COOLDOWN the trial call closes the breaker
+    chat hangs     calls time out at the adaptive timeout (recent p99 x
+                   BREAKER_TIMEOUT_FACTOR), far below LLM_TIMEOUT, then fail fast
+    db down        replies continue without memory or RAG and aren't recorded
+    db hangs       the adaptive timeout cuts waits, then the breaker opens
+    embed down     replies continue without RAG
+    search down    web searches are skipped
+
+Exits 1 if any check fails, so it can run as a test.
+
+Usage:
+    python benchmarks/fault_injection.py
+    python benchmarks/fault_injection.py --verbose
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeChannel, FakeDDGS, FakeGuild, FakeInferenceClient, FakeMessage, FakeSupabase, FakeUser,
+    install_fakes, next_snowflake,
+)
+
+QUESTIONS = [
+    'How do I reset my password?',
+    'What does the onboarding document say about laptops?',
+    'Can you explain how the deployment pipeline works?',
+]
+HANG = 8.0  # seconds an injected hang lasts (well past every adaptive timeout)
+
+
+class Harness:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.hf = FakeInferenceClient(chat_latency=0.1, embed_latency=0.02, tokens=40, jitter=0.2)
+        self.db = FakeSupabase(latency=0.005, jitter=0.2)
+        install_fakes(bot, hf=self.hf, db=self.db)
+        bot.LLM_BACKENDS = ['hf']
+        guild = FakeGuild(next_snowflake(), 'fault-guild')
+        self.guild_id = str(guild.id)
+        self.channel = FakeChannel(next_snowflake(), guild)
+        self.user = FakeUser(next_snowflake(), 'fault-user')
+        self.db.seed_knowledge(self.guild_id, 40)
+        self.db.table('bot_config').insert({
+            'guild_id': self.guild_id, 'guild_name': guild.name, 'bot_name': 'DasAI Assistant',
+            'system_instructions': 'You are a helpful assistant.', 'allowed_channels': [],
+            'guild_rate_limit': 0, 'channel_rate_limit': 0, 'user_rate_limit': 0,
+        }).execute()
+        self.failures: List[str] = []
+
+    async def send(self, n: int, content: str = '') -> Dict[str, Any]:
+        """Answer n messages one after another; latencies and reply kinds."""
+        latencies, kinds = [], {'normal': 0, 'degraded': 0, 'error': 0}
+        for i in range(n):
+            message = FakeMessage(content or QUESTIONS[i % len(QUESTIONS)], self.user, self.channel)
+            self.channel.messages.append(message)
+            start = time.perf_counter()
+            await bot.on_message(message)
+            latencies.append(time.perf_counter() - start)
+            reply = message.replies[0] if message.replies else ''
+            kinds['degraded' if reply == bot.DEGRADED_NOTICE else 'error' if reply.startswith('Error') else 'normal'] += 1
+        return {'latencies': latencies, **kinds}
+
+    def check(self, ok: bool, what: str):
+        if not ok:
+            self.failures.append(what)
+        print(f"    {'ok  ' if ok else 'FAIL'} {what}")
+
+    @staticmethod
+    def states() -> str:
+        return ', '.join(f'{name}={b.state}' for name, b in sorted(bot.breakers.items())) or 'none'
+
+    def report(self, phase: str, result: Dict[str, Any]):
+        lat = result['latencies']
+        print(f"{phase:<15}{len(lat):>5}{statistics.median(lat) * 1000:>10.0f}{max(lat) * 1000:>10.0f}"
+              f"{result['normal']:>8}{result['degraded']:>10}{result['error']:>7}   {self.states()}")
+
+
+@contextlib.contextmanager
+def patched(obj: Any, name: str, replacement: Callable[..., Any]) -> Iterator[None]:
+    """Swap obj.name for the duration of a phase."""
+    original = getattr(obj, name)
+    setattr(obj, name, replacement)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+def fail(*args: Any, **kwargs: Any):
+    raise ConnectionError('injected fault')
+
+
+def hang(original: Callable[..., Any]) -> Callable[..., Any]:
+    def slow(*args: Any, **kwargs: Any):
+        time.sleep(HANG)
+        return original(*args, **kwargs)
+    return slow
+
+
+class FailingQuery:
+    """Supabase builder whose execute() raises, whatever is chained before it."""
+
+    def __getattr__(self, name: str) -> Any:
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        fail()
+
+
+class HangingQuery:
+    """Wraps a Supabase builder so that execute() hangs for HANG seconds first."""
+
+    def __init__(self, query: Any):
+        self.query = query
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.query, name)
+        return lambda *args, **kwargs: HangingQuery(attr(*args, **kwargs))
+
+    def execute(self):
+        time.sleep(HANG)
+        return self.query.execute()
+
+
+async def wait_cooldown():
+    await asyncio.sleep(bot.BREAKER_COOLDOWN + 0.1)
+
+
+async def run(args: argparse.Namespace) -> int:
+    # Hung fake calls keep their threads; give them room so they model a slow upstream
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=64))
+    bot.db_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix='supabase')
+    bot.embed_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix='embed')
+    bot.BREAKER_COOLDOWN = args.cooldown
+    h = Harness(args)
+    failures_needed = bot.BREAKER_FAILURES
+    log = io.StringIO()
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log)
+
+    print(f"{'phase':<15}{'msgs':>5}{'p50 ms':>10}{'max ms':>10}{'normal':>8}{'degraded':>10}{'error':>7}   breakers")
+
+    with quiet:
+        healthy = await h.send(args.warmup)
+    h.report('healthy', healthy)
+    h.check(healthy['normal'] == args.warmup, 'all replies normal while healthy')
+
+    with quiet, patched(h.hf, 'chat_completion', fail):
+        down = await h.send(failures_needed + args.messages)
+    h.report('chat down', down)
+    h.check(bot.breakers['chat.hf'].state == 'open', 'chat breaker opens')
+    h.check(down['degraded'] >= args.messages, f'{args.messages}+ replies are the degraded notice')
+    h.check(max(down['latencies'][-args.messages:]) < 0.05, 'degraded replies take < 50 ms')
+
+    await wait_cooldown()
+    with quiet:
+        recovered = await h.send(args.messages)
+    h.report('chat recovers', recovered)
+    h.check(bot.breakers['chat.hf'].state == 'closed', 'trial call closes the chat breaker')
+    h.check(recovered['normal'] == args.messages, 'replies normal after recovery')
+
+    timeout = bot.adaptive_timeout(bot.chat_endpoint('hf', None, 1000), bot.LLM_TIMEOUT)
+    with quiet, patched(h.hf, 'chat_completion', hang(h.hf.chat_completion)):
+        hung = await h.send(failures_needed + args.messages)
+    h.report('chat hangs', hung)
+    print(f'    adaptive chat timeout {timeout:.2f}s (LLM_TIMEOUT {bot.LLM_TIMEOUT:.0f}s)')
+    h.check(timeout < bot.LLM_TIMEOUT / 10, 'adaptive timeout well below LLM_TIMEOUT')
+    h.check(sum(hung['latencies']) < failures_needed * timeout + 1.0,
+            f'hung calls cost at most {failures_needed} adaptive timeouts in total')
+    h.check(bot.breakers['chat.hf'].state == 'open', 'chat breaker opens on timeouts')
+    h.check(max(hung['latencies'][-args.messages:]) < 0.05, 'then degraded replies take < 50 ms')
+    await wait_cooldown()
+    with quiet:
+        await h.send(1)
+
+    saved = len(h.db.tables.get('messages', []))
+    with quiet, patched(h.db, 'table', lambda *a, **k: FailingQuery()), patched(h.db, 'rpc', lambda *a, **k: FailingQuery()):
+        db_down = await h.send(failures_needed + args.messages)
+    h.report('db down', db_down)
+    h.check(bot.breakers['supabase'].state == 'open', 'database breaker opens')
+    h.check(db_down['normal'] == failures_needed + args.messages, 'replies continue without the database')
+    h.check(len(h.db.tables.get('messages', [])) == saved, 'nothing recorded while the database is down')
+    await wait_cooldown()
+    with quiet:
+        await h.send(1)
+
+    db_timeout = bot.adaptive_timeout('supabase', bot.DB_TIMEOUT)
+    table, rpc = h.db.table, h.db.rpc
+    with quiet, patched(h.db, 'table', lambda *a, **k: HangingQuery(table(*a, **k))), \
+            patched(h.db, 'rpc', lambda *a, **k: HangingQuery(rpc(*a, **k))):
+        db_hung = await h.send(failures_needed + args.messages)
+    h.report('db hangs', db_hung)
+    print(f'    adaptive database timeout {db_timeout:.2f}s (DB_TIMEOUT {bot.DB_TIMEOUT:.0f}s)')
+    h.check(max(db_hung['latencies']) < failures_needed * db_timeout + 1.0,
+            f'no reply waits for more than {failures_needed} adaptive timeouts')
+    h.check(bot.breakers['supabase'].state == 'open', 'database breaker opens on timeouts')
+    # A half-open trial every BREAKER_COOLDOWN still waits out one timeout
+    h.check(statistics.median(db_hung['latencies'][-args.messages:]) < 0.3, 'replies fast once the database breaker is open')
+    await wait_cooldown()
+    with quiet:
+        await h.send(1)
+
+    embeds = h.hf.embed_calls
+    with quiet, patched(h.hf, 'feature_extraction', fail):
+        embed_down = await h.send(failures_needed + args.messages)
+    h.report('embed down', embed_down)
+    h.check(bot.breakers['embed'].state == 'open', 'embedding breaker opens')
+    h.check(embed_down['normal'] == failures_needed + args.messages, 'replies continue without RAG')
+    h.check(h.hf.embed_calls == embeds, 'no embedding requests reach the failing endpoint')
+    await wait_cooldown()
+
+    with quiet, patched(FakeDDGS, 'text', fail):
+        search_down = await h.send(failures_needed + args.messages, 'search: latest python release')
+    h.report('search down', search_down)
+    h.check(bot.breakers['search'].state == 'open', 'web search breaker opens')
+    h.check(search_down['normal'] == failures_needed + args.messages, 'replies continue without web search')
+
+    print('\ncounters: ' + ', '.join(f'{k}={v}' for k, v in sorted(bot.metrics.items())
+                                      if k.startswith(('breaker.', 'replies.degraded', 'replies.unrecorded'))))
+    if h.failures:
+        print(f'\n{len(h.failures)} check(s) failed')
+        return 1
+    print('\nall checks passed')
+    return 0
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--warmup', type=int, default=30, help='healthy messages (fills the latency histograms)')
+    parser.add_argument('--messages', type=int, default=10, help='messages per phase after the breaker should open')
+    parser.add_argument('--cooldown', type=float, default=1.0, help='BREAKER_COOLDOWN for the run (s)')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own log output")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,118 @@
+"""Resident memory per guild in the default and lean GATEWAY_PROFILE.
+
+For each profile a fresh process imports bot with GATEWAY_PROFILE set, so the
+real discord.py client and cache settings are used, then replays a gateway
+session through fakes.FakeGateway: GUILD_CREATE for --guilds guilds of
+--members members each, the member chunks discord.py requests (default
+profile only, as chunk_guilds_at_startup is off in lean) and --messages
+MESSAGE_CREATE events per guild. RSS is read from /proc before and after.
+
+Reports cached members and messages, the RSS growth and the growth per guild.
+
+Usage:
+    python benchmarks/gateway_memory.py
+    python benchmarks/gateway_memory.py --guilds 200 --members 5000 --messages 50
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PROFILES = ('default', 'lean')
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def replay(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run one gateway session in this process (GATEWAY_PROFILE already set)."""
+    for var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+        os.environ[var] = ''
+    import bot
+    from fakes import BOT_USER, FakeGateway
+
+    client = bot.bot
+    await client._async_setup_hook()  # binds the client to this loop, as login() would
+    client._connection.user = discord_user(client, BOT_USER.id)
+    gateway = FakeGateway(client)
+
+    gc.collect()
+    before = rss_mb()
+    start = time.perf_counter()
+    for g in range(args.guilds):
+        guild_id = 10_000 + g
+        gateway.guild_create(guild_id, args.members)  # discord.py requests member chunks here if it chunks
+        for m in range(args.messages):
+            gateway.message_create(guild_id, m % 5, (m * 7919) % args.members, f'message {m} in guild {g}')
+    await gateway.drain()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    after = rss_mb()
+
+    return {
+        'profile': bot.GATEWAY_PROFILE,
+        'members_cached': sum(len(guild.members) for guild in client.guilds),
+        'messages_cached': len(client.cached_messages),
+        'chunks': gateway.chunks_sent,
+        'rss_before_mb': before,
+        'rss_growth_mb': after - before,
+        'kb_per_guild': (after - before) * 1024 / args.guilds,
+        'replay_s': elapsed,
+    }
+
+
+def discord_user(client: Any, user_id: int) -> Any:
+    import discord
+    return discord.ClientUser(state=client._connection, data={
+        'id': str(user_id), 'username': 'DasAI', 'discriminator': '0', 'avatar': None, 'bot': True})
+
+
+def run_profile(args: argparse.Namespace, profile: str) -> Dict[str, Any]:
+    env = dict(os.environ, GATEWAY_PROFILE=profile)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', '--guilds', str(args.guilds),
+           '--members', str(args.members), '--messages', str(args.messages)]
+    proc = subprocess.run(cmd, env=env, cwd=ROOT, capture_output=True, text=True, timeout=1800)
+    result = next((json.loads(line[len('RESULT '):]) for line in proc.stdout.splitlines()
+                   if line.startswith('RESULT ')), None)
+    if proc.returncode != 0 or result is None:
+        raise RuntimeError(f'{profile} run failed (exit {proc.returncode}):\n{proc.stderr[-2000:]}')
+    return result
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--members', type=int, default=2000, help='members per guild')
+    parser.add_argument('--messages', type=int, default=20, help='messages per guild')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print('RESULT ' + json.dumps(asyncio.run(replay(args))))
+        return 0
+
+    print(f'{args.guilds} guilds x {args.members} members, {args.messages} messages per guild')
+    print(f"{'profile':<10}{'members cached':>16}{'messages cached':>17}{'chunks':>8}{'RSS growth MB':>15}{'KB/guild':>10}{'replay s':>10}")
+    for profile in PROFILES:
+        r = run_profile(args, profile)
+        print(f"{r['profile']:<10}{r['members_cached']:>16,}{r['messages_cached']:>17,}{r['chunks']:>8}"
+              f"{r['rss_growth_mb']:>15.1f}{r['kb_per_guild']:>10.1f}{r['replay_s']:>10.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
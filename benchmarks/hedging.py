@@ -0,0 +1,156 @@
+"""Tail latency of embeddings and chat completions with and without request hedging.
+
+Drives bot.hf_embed and bot.llm_chat (Hugging Face backend) against the fake
+inference client, whose latencies are log-normal with --jitter and where
+--stall-rate of the calls stall for --stall seconds, from --concurrency
+concurrent callers. Each endpoint first gets --warmup calls so its latency
+histogram is populated, then --requests measured calls, once with
+HEDGE_ENDPOINTS empty and once with it set to embed,chat.
+
+The outage scenario warms up at normal latency, then makes every call
+--outage-factor times slower: nearly every call passes the hedge delay, and
+the HEDGE_BUDGET cap is what keeps the extra upstream load small.
+
+Reports p50/p95/p99/max latency, upstream calls per request, hedges fired
+and won, and failed calls. A stall longer than the adaptive timeout (see
+BREAKER_TIMEOUT_FACTOR) fails the call unless a hedge wins first; failed
+calls count in the latencies at the time they failed. The circuit breakers
+are reset between cases. The default and embedding executors are enlarged so abandoned
+(stalled or losing) calls model upstream waiting rather than client thread
+starvation.
+
+Usage:
+    python benchmarks/hedging.py
+    python benchmarks/hedging.py --requests 1000 --stall-rate 0.05 --percentile 90
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import FakeInferenceClient, install_fakes  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': 'What are the office hours?'}]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def drive(call: Callable[[], Awaitable[Any]], n: int, concurrency: int) -> Tuple[List[float], int]:
+    """Make n calls from `concurrency` callers; per-call latencies and the number that failed."""
+    latencies: List[float] = []
+    failed = 0
+    remaining = iter(range(n))
+
+    async def worker():
+        nonlocal failed
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                if await call() is None:
+                    failed += 1  # hf_embed returns None on errors
+            except Exception:
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failed
+
+
+async def run_case(args: argparse.Namespace, endpoint: str, hedging: bool, outage: bool) -> Dict[str, Any]:
+    hf = FakeInferenceClient(chat_latency=args.chat_latency, embed_latency=args.embed_latency, jitter=args.jitter,
+                             stall_rate=args.stall_rate, stall=args.stall)
+    install_fakes(bot, hf=hf)
+    bot.LLM_BACKENDS = ['hf']
+    bot.HEDGE_ENDPOINTS = {'embed', 'chat'} if hedging else set()
+    bot.HEDGE_PERCENTILE = args.percentile
+    bot.HEDGE_BUDGET = args.budget
+    bot.hedgers.clear()
+    bot.breakers.clear()
+    bot.metrics.clear()
+
+    if endpoint == 'embed':
+        def call() -> Awaitable[Any]:
+            return bot.hf_embed('How do I reset my password?')
+        hedger_name = 'embed'
+    else:
+        def call() -> Awaitable[Any]:
+            return bot.llm_chat(MESSAGES)
+        hedger_name = bot.chat_endpoint('hf', None, 1000)
+
+    await drive(call, args.warmup, args.concurrency)
+    if outage:
+        hf.embed_latency *= args.outage_factor
+        hf.chat_latency *= args.outage_factor
+        hf.stall_rate = 0.0
+    calls_before = hf.embed_calls + hf.chat_calls
+    fired_before = bot.metrics.get(f'hedge.fired.{hedger_name}', 0)
+    won_before = bot.metrics.get(f'hedge.won.{hedger_name}', 0)
+    latencies, failed = await drive(call, args.requests, args.concurrency)
+    return {
+        'endpoint': endpoint,
+        'scenario': 'outage' if outage else 'normal',
+        'hedging': 'on' if hedging else 'off',
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': max(latencies) * 1000,
+        'load': (hf.embed_calls + hf.chat_calls - calls_before) / args.requests,
+        'fired': bot.metrics.get(f'hedge.fired.{hedger_name}', 0) - fired_before,
+        'won': bot.metrics.get(f'hedge.won.{hedger_name}', 0) - won_before,
+        'failed': failed,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=256))
+    bot.embed_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix='embed')
+    results = []
+    for outage in (False, True):
+        for endpoint in ('embed', 'chat'):
+            for hedging in (False, True):
+                results.append(await run_case(args, endpoint, hedging, outage))
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400, help='measured calls per case')
+    parser.add_argument('--warmup', type=int, default=100, help='calls before measuring, to fill the histogram')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--embed-latency', type=float, default=0.05, help='mean embedding latency (s)')
+    parser.add_argument('--chat-latency', type=float, default=0.2, help='mean chat completion latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='log-normal sigma of latencies')
+    parser.add_argument('--stall-rate', type=float, default=0.02, help='fraction of calls that stall')
+    parser.add_argument('--stall', type=float, default=3.0, help='stall duration (s)')
+    parser.add_argument('--outage-factor', type=float, default=5.0, help='slowdown of every call in the outage')
+    parser.add_argument('--percentile', type=float, default=bot.HEDGE_PERCENTILE, help='HEDGE_PERCENTILE')
+    parser.add_argument('--budget', type=float, default=bot.HEDGE_BUDGET, help='HEDGE_BUDGET')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f'{args.requests} calls per case, concurrency {args.concurrency}, {args.stall_rate:.0%} stalls of {args.stall:.1f}s, '
+          f'hedge at p{args.percentile:g} with a {args.budget:.0%} budget')
+    print(f"{'endpoint':<9}{'scenario':<9}{'hedging':<8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'calls/req':>11}{'fired':>7}{'won':>6}{'failed':>8}")
+    for r in results:
+        print(f"{r['endpoint']:<9}{r['scenario']:<9}{r['hedging']:<8}{r['p50']:>9.1f}{r['p95']:>9.1f}{r['p99']:>9.1f}"
+              f"{r['max']:>9.1f}{r['load']:>11.3f}{r['fired']:>7}{r['won']:>6}{r['failed']:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,134 @@
+"""Payload size and latency of the knowledge-base read paths on a large guild.
+
+Seeds one guild with --chunks knowledge chunks (50k by default) and times the
+queries behind /knowledge_list, /knowledge_view and the dashboard, in their old
+form (``select('*')`` over chunk rows, ``ilike`` title scans) and in the current
+form (``knowledge_sources`` rows, keyset pages, explicit column lists).
+
+Against the in-memory fake, latency is mostly Python filtering; the payload
+column is the number that carries over. ``--bandwidth-mbps`` adds an estimated
+wire time for each payload. Pass --supabase-url/--supabase-key to measure a real
+(local) Supabase loaded with database/schema.sql instead; seeding then inserts
+through PostgREST and takes a while.
+
+Usage:
+    python benchmarks/knowledge_queries.py
+    python benchmarks/knowledge_queries.py --chunks 10000 --chunks-per-doc 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import FakeInferenceClient, FakeSupabase, install_fakes  # noqa: E402
+
+GUILD_ID = '900000000000000001'
+
+
+def payload_bytes(data: Any) -> int:
+    """Size of a result as PostgREST would serialize it."""
+    return len(json.dumps(data, default=str).encode('utf-8'))
+
+
+async def measure(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Run `fn` `repeat` times; return the median latency and the payload of the last run."""
+    timings: List[float] = []
+    data: Any = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = fn()
+        if asyncio.iscoroutine(data):
+            data = await data
+        timings.append(time.perf_counter() - start)
+    return {'ms': statistics.median(timings) * 1000, 'bytes': payload_bytes(data)}
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    if args.supabase_url:
+        from supabase import create_client
+        db: Any = create_client(args.supabase_url, args.supabase_key)
+    else:
+        db = FakeSupabase(latency=0, jitter=0)
+    install_fakes(bot, hf=FakeInferenceClient(chat_latency=0, embed_latency=0), db=db)
+
+    if isinstance(db, FakeSupabase):
+        db.seed_knowledge(GUILD_ID, args.chunks, chunks_per_doc=args.chunks_per_doc)
+    else:
+        for start in range(0, args.chunks, 500):
+            batch = []
+            for i in range(start, min(start + 500, args.chunks)):
+                content = f'Document {i}. ' + 'knowledge ' * 80
+                embedding = await bot.hf_embed(content)
+                batch.append({
+                    'guild_id': GUILD_ID, 'content': content, 'chunk_index': i % args.chunks_per_doc,
+                    'title': f'Doc {i // args.chunks_per_doc} (Part {i % args.chunks_per_doc + 1})',
+                    'embedding': embedding.tolist() if embedding is not None else None,
+                })
+            db.table('knowledge_documents').insert(batch).execute()
+
+    target = f'Doc {args.chunks // args.chunks_per_doc // 2}'
+    docs = db.table('knowledge_sources').select('created_at, id').eq('guild_id', GUILD_ID).order('created_at', desc=True).range(1000, 1000).execute().data
+    deep_cursor = (str(docs[0]['created_at']), str(docs[0]['id'])) if docs else None
+    chunk_id = db.table('knowledge_documents').select('id').eq('guild_id', GUILD_ID).limit(1).execute().data[0]['id']
+
+    async def view_new():
+        source = await bot.find_knowledge_source(GUILD_ID, target)
+        return await bot.get_knowledge_source_content(source['id']) if source else []
+
+    cases = [
+        ('list (dashboard)',
+         lambda: db.table('knowledge_documents').select('*').eq('guild_id', GUILD_ID).order('created_at', desc=True).limit(50).execute().data,
+         lambda: bot.list_knowledge_sources(GUILD_ID, 50)),
+        ('list deep page (offset vs keyset)',
+         lambda: db.table('knowledge_documents').select('id, title, created_at').eq('guild_id', GUILD_ID).order('created_at', desc=True).range(1000, 1019).execute().data,
+         lambda: bot.list_knowledge_sources(GUILD_ID, 20, before=deep_cursor)),
+        ('view by title',
+         lambda: db.table('knowledge_documents').select('*').eq('guild_id', GUILD_ID).ilike('title', f'%{target}%').order('chunk_index').execute().data,
+         view_new),
+        ('get chunk by id',
+         lambda: db.table('knowledge_documents').select('*').eq('guild_id', GUILD_ID).eq('id', chunk_id).single().execute().data,
+         lambda: bot.get_knowledge_document(GUILD_ID, chunk_id)),
+    ]
+
+    results = []
+    for name, old, new in cases:
+        before = await measure(old, args.repeat)
+        after = await measure(new, args.repeat)
+        results.append({'query': name, 'before': before, 'after': after})
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=50000, help='knowledge chunks to seed in the test guild')
+    parser.add_argument('--chunks-per-doc', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query (median is reported)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=100.0, help='link speed used for the wire-time estimate')
+    parser.add_argument('--supabase-url', default='', help='use a real (local) Supabase/PostgREST instead of the fake')
+    parser.add_argument('--supabase-key', default='')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    wire_ms = lambda n: n * 8 / (args.bandwidth_mbps * 1e6) * 1000  # noqa: E731
+    print(f"{'query':<34}{'bytes before':>14}{'bytes after':>13}{'ms before':>11}{'ms after':>10}{'wire before':>13}{'wire after':>12}")
+    for r in results:
+        b, a = r['before'], r['after']
+        print(f"{r['query']:<34}{b['bytes']:>14,}{a['bytes']:>13,}{b['ms']:>11.1f}{a['ms']:>10.1f}"
+              f"{wire_ms(b['bytes']):>12.1f}ms{wire_ms(a['bytes']):>10.1f}ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
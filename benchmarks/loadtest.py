@@ -0,0 +1,213 @@
+"""Offline load-test harness for bot.py.
+
+Replays synthetic Discord traffic across many guilds and channels against
+``on_message`` and the slash-command callbacks, with fake Hugging Face,
+Supabase and DDGS backends (see fakes.py), and reports throughput, reply
+latency percentiles and event-loop lag.
+
+Usage:
+    python benchmarks/loadtest.py                    # default scenario
+    python benchmarks/loadtest.py --messages 2000 --rate 100 --guilds 50
+    python benchmarks/loadtest.py --compare          # diff against benchmarks/baseline.json
+    python benchmarks/loadtest.py --save-baseline    # rewrite the committed baseline
+
+Pass --supabase-url/--supabase-key to run against a local PostgREST (e.g.
+``supabase start``) loaded with database/schema.sql instead of the in-memory fake.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Keep bot.py from building real clients from a developer's .env
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeChannel, FakeDDGS, FakeGuild, FakeInferenceClient, FakeInteraction,
+    FakeMessage, FakeSupabase, FakeUser, install_fakes, measure_loop_lag, next_snowflake,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+QUESTIONS = [
+    'How do I reset my password?',
+    'What are the office hours?',
+    'Can you explain how the deployment pipeline works?',
+    'hey there',
+    'thanks!',
+    'What does the onboarding document say about laptops?',
+    'search: latest python release',
+    'Summarize the knowledge base entry on billing.',
+    'news about the product launch',
+    'Where is the style guide?',
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of floats (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def build_world(args: argparse.Namespace, db: Any):
+    """Create fake guilds, channels and users, and seed each guild's knowledge base."""
+    channels: List[FakeChannel] = []
+    users: List[FakeUser] = [FakeUser(next_snowflake(), f'user{i}') for i in range(args.users)]
+    for g in range(args.guilds):
+        guild = FakeGuild(next_snowflake(), f'guild-{g}')
+        for _ in range(args.channels):
+            channels.append(FakeChannel(next_snowflake(), guild))
+        if isinstance(db, FakeSupabase) and args.kb_chunks:
+            db.seed_knowledge(str(guild.id), args.kb_chunks)
+        if isinstance(db, FakeSupabase):
+            # Unlimited by default, so the run measures capacity rather than throttling
+            limits = (30, 10, 5) if args.rate_limits else (0, 0, 0)
+            db.table('bot_config').insert({
+                'guild_id': str(guild.id), 'guild_name': guild.name, 'bot_name': 'DasAI Assistant',
+                'system_instructions': 'You are a helpful assistant.', 'allowed_channels': [],
+                'guild_rate_limit': limits[0], 'channel_rate_limit': limits[1], 'user_rate_limit': limits[2],
+            }).execute()
+    return channels, users
+
+
+async def run_one(args: argparse.Namespace, channel: FakeChannel, user: FakeUser,
+                  latencies: List[float], errors: List[str]):
+    """Deliver one synthetic message or slash command and record its reply latency."""
+    question = random.choice(QUESTIONS)
+    start = time.perf_counter()
+    try:
+        if random.random() < args.slash_ratio:
+            interaction = FakeInteraction(user, channel)
+            await bot.ask.callback(interaction, question)
+            replied_at = interaction.first_reply_at
+        else:
+            message = FakeMessage(question, user, channel)
+            channel.messages.append(message)
+            await bot.on_message(message)
+            replied_at = message.first_reply_at
+        if replied_at is not None:
+            latencies.append(replied_at - start)
+    except Exception as e:
+        errors.append(repr(e))
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    random.seed(args.seed)
+    hf = FakeInferenceClient(chat_latency=args.hf_latency, embed_latency=args.embed_latency,
+                             tokens=args.tokens, jitter=args.jitter)
+    if args.supabase_url:
+        from supabase import create_client
+        db: Any = create_client(args.supabase_url, args.supabase_key)
+    else:
+        db = FakeSupabase(latency=args.db_latency, jitter=args.jitter)
+    FakeDDGS.latency = args.ddgs_latency
+    FakeDDGS.jitter = args.jitter
+    install_fakes(bot, hf=hf, db=db)
+
+    channels, users = build_world(args, db)
+
+    latencies: List[float] = []
+    errors: List[str] = []
+    lag_samples: List[float] = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples, stop))
+
+    start = time.perf_counter()
+    tasks = []
+    for _ in range(args.messages):
+        tasks.append(asyncio.create_task(run_one(args, random.choice(channels), random.choice(users), latencies, errors)))
+        # Open-loop arrivals: exponential inter-arrival times at the target rate
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+
+    queries = getattr(db, 'queries', None)
+    return {
+        'messages': args.messages,
+        'replied': len(latencies),
+        'errors': len(errors),
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'latency_p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'loop_lag_p99_ms': round(percentile(lag_samples, 99) * 1000, 1),
+        'loop_lag_max_ms': round(max(lag_samples, default=0.0) * 1000, 1),
+        'hf_chat_calls': hf.chat_calls,
+        'hf_embed_calls': hf.embed_calls,
+        'ddgs_calls': FakeDDGS.calls,
+        'db_queries': queries,
+        'rate_limited': sum(v for k, v in bot.metrics.items() if k.startswith('replies.rate_limited.')),
+        'shed': sum(v for k, v in bot.metrics.items() if k.startswith('replies.shed.')),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]):
+    """Print each numeric metric next to the baseline with its relative change."""
+    print(f"{'metric':<18}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, current in result.items():
+        base = baseline.get(key)
+        if not isinstance(current, (int, float)) or not isinstance(base, (int, float)):
+            continue
+        change = f'{(current - base) / base:+.1%}' if base else 'n/a'
+        print(f'{key:<18}{base:>12}{current:>12}{change:>10}')
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=300, help='total messages/commands to send')
+    parser.add_argument('--rate', type=float, default=30.0, help='arrival rate in messages per second')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=3, help='channels per guild')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--slash-ratio', type=float, default=0.1, help='fraction of traffic sent as /ask')
+    parser.add_argument('--kb-chunks', type=int, default=40, help='knowledge chunks seeded per guild')
+    parser.add_argument('--hf-latency', type=float, default=0.4, help='mean chat completion latency (s)')
+    parser.add_argument('--embed-latency', type=float, default=0.05, help='mean embedding latency (s)')
+    parser.add_argument('--tokens', type=int, default=120, help='tokens per fake completion')
+    parser.add_argument('--db-latency', type=float, default=0.005, help='mean Supabase round trip (s)')
+    parser.add_argument('--ddgs-latency', type=float, default=0.3, help='mean web search latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.3, help='log-normal sigma applied to latencies')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--rate-limits', action='store_true', help='rate-limit each guild to 30/10/5 replies per minute (server/channel/user)')
+    parser.add_argument('--supabase-url', default='', help='use a real (local) Supabase/PostgREST instead of the fake')
+    parser.add_argument('--supabase-key', default='')
+    parser.add_argument('--compare', action='store_true', help='compare against benchmarks/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='write the result to benchmarks/baseline.json')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+
+    if args.compare and os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding='utf-8') as f:
+            compare(result, json.load(f))
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {BASELINE_PATH}')
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+"""Time-to-first-token with the inline and prefix-stable prompt layouts.
+
+Replays the same stream of replies (several guilds, each with long server
+instructions; fresh knowledge, web and memory context every time; a growing
+channel history) once per PROMPT_LAYOUT and streams each prompt to an
+OpenAI-compatible chat endpoint, recording the time until the first content
+token arrives.
+
+By default the endpoint is fakes.FakeLLMServer, which models a single GPU with
+vLLM-style block prefix caching: uncached prompt tokens cost --prefill-ms each.
+Point --endpoint at a real vLLM (--enable-prefix-caching) or TGI server with
+--model to measure it instead; the cached-token column then comes from the
+server's usage report when it sends one.
+
+Usage:
+    python benchmarks/prefix_cache.py
+    python benchmarks/prefix_cache.py --guilds 8 --requests 300 --concurrency 4
+    python benchmarks/prefix_cache.py --endpoint http://localhost:8000 --model meta-llama/Llama-3.1-8B-Instruct
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import aiohttp  # noqa: E402
+
+import bot  # noqa: E402
+from fakes import FakeLLMServer  # noqa: E402
+from prompt_budget import text  # noqa: E402
+
+LAYOUTS = ('inline', 'stable')
+
+
+def make_workload(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """One entry per reply: the guild's instructions, that reply's context and the fetched history.
+
+    Each guild is one channel; history holds (message id, message) pairs like generate_ai_response.
+    """
+    rng = random.Random(args.seed)
+    instructions = [f'You are the assistant for server {g}. ' + text(rng, args.instruction_words) for g in range(args.guilds)]
+    histories: Dict[int, List[Any]] = {}
+    workload = []
+    for _ in range(args.requests):
+        guild = rng.randrange(args.guilds)
+        history = histories.setdefault(guild, [])
+        docs = [{'title': f'Guide {rng.randrange(100)}', 'similarity': rng.random(), 'semantic_score': rng.random(),
+                 'snippet': text(rng, 120)} for _ in range(3)]
+        web = [{'title': 'Result', 'snippet': text(rng, 40), 'url': 'https://example.com'}] if rng.random() < 0.3 else []
+        user = {'role': 'user', 'content': f'user{rng.randrange(50)}: ' + text(rng, 20)}
+        workload.append({
+            'channel': str(guild), 'instructions': instructions[guild],
+            'history': list(history[-bot.PROMPT_HISTORY_MESSAGES:]),
+            'sections': bot.build_prompt_sections(docs, web, text(rng, 60)), 'user': user,
+        })
+        history.extend([(len(history), user), (len(history) + 1, {'role': 'assistant', 'content': text(rng, 80)})])
+    return workload
+
+
+async def first_token(session: aiohttp.ClientSession, endpoint: str, model: str,
+                      messages: List[Dict[str, str]], max_tokens: int) -> Dict[str, Any]:
+    """Stream one completion; return the time to the first content token and any cached-token count."""
+    payload = {'model': model, 'messages': messages, 'max_tokens': max_tokens, 'stream': True,
+               'stream_options': {'include_usage': True}}
+    start = time.perf_counter()
+    ttft = None
+    cached = None
+    async with session.post(f'{endpoint}/v1/chat/completions', json=payload) as resp:
+        resp.raise_for_status()
+        async for line in resp.content:
+            line = line.strip()
+            if not line.startswith(b'data:') or line == b'data: [DONE]':
+                continue
+            chunk = json.loads(line[5:])
+            if ttft is None and any(c.get('delta', {}).get('content') for c in chunk.get('choices') or []):
+                ttft = time.perf_counter() - start
+            details = (chunk.get('usage') or {}).get('prompt_tokens_details') or {}
+            if details.get('cached_tokens') is not None:
+                cached = details['cached_tokens']
+    return {'ttft': ttft if ttft is not None else time.perf_counter() - start, 'cached': cached}
+
+
+async def run_layout(args: argparse.Namespace, endpoint: str, layout: str,
+                     workload: List[Dict[str, Any]]) -> Dict[str, Any]:
+    bot.PROMPT_LAYOUT = layout
+    bot.history_anchors.clear()
+    prompts = []
+    for item in workload:
+        history = bot.history_window(item['channel'], item['history'])
+        messages, stats = bot.assemble_prompt(item['instructions'], item['sections'], history, item['user'], args.budget)
+        prompts.append((messages, stats['total']))
+
+    results: List[Dict[str, Any]] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for p in prompts:
+        queue.put_nowait(p)
+
+    async with aiohttp.ClientSession() as session:
+        async def worker():
+            while not queue.empty():
+                messages, _ = queue.get_nowait()
+                results.append(await first_token(session, endpoint, args.model, messages, args.max_tokens))
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    ttfts = sorted(r['ttft'] for r in results)
+    cached = [r['cached'] for r in results if r['cached'] is not None]
+    return {
+        'layout': layout,
+        'tokens': statistics.mean(t for _, t in prompts),
+        'ttft_p50_ms': ttfts[len(ttfts) // 2] * 1000,
+        'ttft_p95_ms': ttfts[int(len(ttfts) * 0.95) - 1] * 1000,
+        'cached_tokens': statistics.mean(cached) if cached else None,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    workload = make_workload(args)
+    server = None
+    endpoint = args.endpoint.rstrip('/')
+    if not endpoint:
+        server = FakeLLMServer(prefill_per_token=args.prefill_ms / 1000, decode_per_token=0.005, tokens=args.max_tokens)
+        endpoint = await server.start()
+    try:
+        results = []
+        for layout in LAYOUTS:
+            if server:
+                server.reset_cache()
+            results.append(await run_layout(args, endpoint, layout, workload))
+        return results
+    finally:
+        if server:
+            await server.stop()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', default='', help='OpenAI-compatible server (default: in-process FakeLLMServer)')
+    parser.add_argument('--model', default=bot.HF_MODEL)
+    parser.add_argument('--guilds', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=120)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--instruction-words', type=int, default=600, help='length of each guild\'s system instructions')
+    parser.add_argument('--budget', type=int, default=bot.PROMPT_TOKEN_BUDGET)
+    parser.add_argument('--max-tokens', type=int, default=16)
+    parser.add_argument('--prefill-ms', type=float, default=0.2, help='fake server prefill time per uncached token')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f"{'layout':<10}{'prompt tokens':>15}{'cached tokens':>15}{'TTFT p50 ms':>13}{'TTFT p95 ms':>13}")
+    for r in results:
+        cached = f"{r['cached_tokens']:.0f}" if r['cached_tokens'] is not None else 'n/a'
+        print(f"{r['layout']:<10}{r['tokens']:>15.0f}{cached:>15}{r['ttft_p50_ms']:>13.1f}{r['ttft_p95_ms']:>13.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
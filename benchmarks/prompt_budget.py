@@ -0,0 +1,147 @@
+"""Prompt size and reply latency with and without the prompt token budget.
+
+Builds the context a busy channel produces (long server instructions, five
+knowledge chunks, four web results, a memory summary and ten history messages
+with long bot replies) and assembles it two ways: the old unbounded
+concatenation (reimplemented here) and bot.assemble_prompt() with
+PROMPT_TOKEN_BUDGET. For each it reports prompt tokens, assembly CPU time and
+the latency of a fake chat completion whose prefill cost grows with the prompt
+(--prefill-ms per word), which is what the budget cuts.
+
+Token counts use --tokenizer (a tokenizer.json, e.g. from HF_MODEL's repo)
+when given, otherwise the ~4 characters per token estimate the bot falls back
+to.
+
+Usage:
+    python benchmarks/prompt_budget.py
+    python benchmarks/prompt_budget.py --tokenizer tokenizer.json --budget 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import FakeInferenceClient, install_fakes  # noqa: E402
+
+WORDS = ('server role channel moderator event schedule release build deploy config token '
+         'permission voice stream update patch feature request ticket support guide rule').split()
+
+
+def text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words)) + '.'
+
+
+def make_context(rng: random.Random) -> Dict[str, Any]:
+    """Inputs shaped like one reply in an active channel."""
+    docs = [{
+        'title': f'Guide {i}', 'similarity': 0.9 - i * 0.05, 'semantic_score': 0.8 - i * 0.05,
+        'filename': f'guide_{i}.md', 'created_at': '2026-01-01', 'snippet': text(rng, 220),
+    } for i in range(5)]
+    web = [{'title': f'Result {i}', 'snippet': text(rng, 60), 'url': f'https://example.com/{i}'} for i in range(4)]
+    history = []
+    for i in range(10):
+        if i % 2:
+            history.append({'role': 'assistant', 'content': text(rng, 250)})
+        else:
+            history.append({'role': 'user', 'content': f'user{i}: ' + text(rng, 30)})
+    return {
+        'instructions': 'You are the helpful assistant for this server. ' + text(rng, 150),
+        'docs': docs, 'web': web, 'history': history,
+        'memory': text(rng, 120),
+        'user': {'role': 'user', 'content': 'asker: ' + text(rng, 25)},
+    }
+
+
+def legacy_prompt(ctx: Dict[str, Any]) -> List[Dict[str, str]]:
+    """generate_ai_response's message building before the token budget."""
+    knowledge_context = "\n\n📚 **Relevant Knowledge Base Context:**\n"
+    for doc in ctx['docs']:
+        knowledge_context += f"\n[{doc['title']}] (relevance: {doc['similarity']:.0%}, semantic: {doc['semantic_score']:.2f})"
+        knowledge_context += f" | File: {doc['filename']} | Added: {doc['created_at']}\n➡️ {doc['snippet']}\n"
+    web_context = "\n\n🔍 **Web Search Results:**\n"
+    for i, r in enumerate(ctx['web'], 1):
+        web_context += f"{i}. **{r['title']}**\n   {r['snippet']}\n   Source: {r['url']}\n\n"
+    system_prompt = ctx['instructions']
+    system_prompt += f"\n\nUse the following knowledge base context to help answer questions when relevant:{knowledge_context}"
+    system_prompt += f"\n\nUse these web search results to provide accurate, up-to-date information. Cite sources when helpful:{web_context}"
+    system_prompt += f"\n\nConversation context:\n{ctx['memory']}"
+    messages = [{'role': 'system', 'content': system_prompt}]
+    messages.extend(ctx['history'][-6:])
+    messages.append(ctx['user'])
+    return messages
+
+
+def budgeted_prompt(ctx: Dict[str, Any], budget: int) -> List[Dict[str, str]]:
+    sections = bot.build_prompt_sections(ctx['docs'], ctx['web'], ctx['memory'])
+    messages, _ = bot.assemble_prompt(ctx['instructions'], sections, ctx['history'], ctx['user'], budget)
+    return messages
+
+
+def prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(bot.count_tokens(m['content']) + bot.CHAT_MESSAGE_OVERHEAD for m in messages)
+
+
+async def measure(build, contexts: List[Dict[str, Any]]) -> Dict[str, float]:
+    tokens: List[int] = []
+    cpu: List[float] = []
+    latency: List[float] = []
+    for ctx in contexts:
+        bot.count_tokens.cache_clear()  # count every reply's text from scratch, as the bot does for new content
+        start = time.process_time()
+        messages = build(ctx)
+        cpu.append(time.process_time() - start)
+        tokens.append(prompt_tokens(messages))
+        start = time.perf_counter()
+        await bot.hf_chat(messages, max_tokens=200)
+        latency.append(time.perf_counter() - start)
+    return {
+        'tokens': statistics.mean(tokens), 'max_tokens': max(tokens),
+        'cpu_ms': statistics.median(cpu) * 1000, 'latency_ms': statistics.median(latency) * 1000,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Tuple[str, Dict[str, float]]]:
+    install_fakes(bot, hf=FakeInferenceClient(chat_latency=args.decode_ms / 1000, tokens=200, jitter=0,
+                                             prefill_per_token=args.prefill_ms / 1000))
+    if args.tokenizer:
+        bot.prompt_tokenizer = bot.tokenizers.Tokenizer.from_file(args.tokenizer)
+    rng = random.Random(args.seed)
+    contexts = [make_context(rng) for _ in range(args.requests)]
+    return [
+        ('legacy concatenation', await measure(legacy_prompt, contexts)),
+        (f'budget {args.budget}', await measure(lambda ctx: budgeted_prompt(ctx, args.budget), contexts)),
+    ]
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--budget', type=int, default=bot.PROMPT_TOKEN_BUDGET, help='PROMPT_TOKEN_BUDGET to test')
+    parser.add_argument('--tokenizer', default='', help='tokenizer.json used for counting (default: character estimate)')
+    parser.add_argument('--prefill-ms', type=float, default=0.15, help='fake model prefill time per prompt word')
+    parser.add_argument('--decode-ms', type=float, default=300.0, help='fake model time to generate the reply')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f"token counts: {'tokenizer ' + args.tokenizer if args.tokenizer else 'estimated (~4 chars/token)'}")
+    print(f"{'prompt':<24}{'mean tokens':>13}{'max tokens':>12}{'assembly ms':>13}{'reply ms':>10}")
+    for name, r in results:
+        print(f"{name:<24}{r['tokens']:>13.0f}{r['max_tokens']:>12}{r['cpu_ms']:>13.2f}{r['latency_ms']:>10.0f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,134 @@
+"""Database round trips and latency per answered message, with and without the reply RPCs.
+
+Sends --messages messages one at a time through on_message against the fake
+Supabase (fakes.py, fixed --db-latency per call, no jitter) and fake Hugging
+Face backends, once with REPLY_CONTEXT_RPC off (a query per table: bot_config
+on a cache miss, conversation_memory, search_documents, then the messages
+insert and the conversation_memory select and upsert) and once with it on
+(get_reply_context before the reply, record_exchange after it, plus a summary
+update every 5th message).
+
+Each mode runs with the guild's config cached and with it expired before
+every message (a guild idle for longer than CONFIG_CACHE_TTL). Reports DB
+calls per message, the handler's wall-clock p50/p95 and the time to the
+first reply chunk.
+
+Usage:
+    python benchmarks/reply_round_trips.py
+    python benchmarks/reply_round_trips.py --messages 200 --db-latency 0.04
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeChannel, FakeGuild, FakeInferenceClient, FakeMessage, FakeSupabase, FakeUser,
+    install_fakes, next_snowflake,
+)
+
+QUESTIONS = [
+    'How do I reset my password?',
+    'What are the office hours?',
+    'Can you explain how the deployment pipeline works?',
+    'What does the onboarding document say about laptops?',
+    'Summarize the knowledge base entry on billing.',
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_mode(args: argparse.Namespace, reply_rpc: bool, config_expired: bool) -> Dict[str, Any]:
+    bot.REPLY_CONTEXT_RPC = reply_rpc
+    bot.guild_config_cache.clear()
+    bot.guild_config_cache_time.clear()
+    bot.metrics.clear()
+    hf = FakeInferenceClient(chat_latency=args.hf_latency, embed_latency=args.embed_latency, jitter=0.0)
+    db = FakeSupabase(latency=args.db_latency, jitter=0.0)
+    install_fakes(bot, hf=hf, db=db)
+    bot.web_search_available = False  # web search isn't a database call; keep it out of the comparison
+
+    guild = FakeGuild(next_snowflake(), 'bench-guild')
+    guild_id = str(guild.id)
+    channel = FakeChannel(next_snowflake(), guild)
+    user = FakeUser(next_snowflake(), 'bench-user')
+    db.seed_knowledge(guild_id, args.kb_chunks)
+    db.table('bot_config').insert({
+        'guild_id': guild_id, 'guild_name': guild.name, 'bot_name': 'DasAI Assistant',
+        'system_instructions': 'You are a helpful assistant.', 'allowed_channels': [],
+        'guild_rate_limit': 0, 'channel_rate_limit': 0, 'user_rate_limit': 0,
+    }).execute()
+    await bot.fetch_bot_config(guild_id, guild.name)  # warm the cache outside the measurement
+
+    trips: List[int] = []
+    handler_ms: List[float] = []
+    first_reply_ms: List[float] = []
+    for i in range(args.messages):
+        if config_expired:
+            bot.guild_config_cache_time[guild_id] = 0.0
+        message = FakeMessage(QUESTIONS[i % len(QUESTIONS)], user, channel)
+        channel.messages.append(message)
+        queries = db.queries
+        start = time.perf_counter()
+        await bot.on_message(message)
+        handler_ms.append((time.perf_counter() - start) * 1000)
+        trips.append(db.queries - queries)
+        if message.first_reply_at is not None:
+            first_reply_ms.append((message.first_reply_at - start) * 1000)
+
+    return {
+        'mode': 'reply RPCs' if reply_rpc else 'separate',
+        'config': 'expired' if config_expired else 'cached',
+        'trips': statistics.mean(trips),
+        'handler_p50': percentile(handler_ms, 50),
+        'handler_p95': percentile(handler_ms, 95),
+        'first_reply_p50': percentile(first_reply_ms, 50) if first_reply_ms else 0.0,
+        'rpc_errors': bot.metrics.get('db.reply_rpc_errors', 0),
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for config_expired in (False, True):
+        for reply_rpc in (False, True):
+            results.append(await run_mode(args, reply_rpc, config_expired))
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--db-latency', type=float, default=0.02, help='Supabase round trip (s)')
+    parser.add_argument('--hf-latency', type=float, default=0.2, help='mean chat completion latency (s)')
+    parser.add_argument('--embed-latency', type=float, default=0.03, help='mean embedding latency (s)')
+    parser.add_argument('--kb-chunks', type=int, default=200, help='knowledge chunks seeded in the guild')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f'{args.messages} messages, {args.db_latency * 1000:.0f} ms per database call')
+    print(f"{'mode':<13}{'config':<9}{'DB calls/msg':>13}{'handler p50':>13}{'p95':>9}{'first reply p50':>17}")
+    for r in results:
+        print(f"{r['mode']:<13}{r['config']:<9}{r['trips']:>13.2f}{r['handler_p50']:>11.1f}ms"
+              f"{r['handler_p95']:>7.1f}ms{r['first_reply_p50']:>15.1f}ms")
+    errors = sum(r['rpc_errors'] for r in results)
+    if errors:
+        print(f'{errors} reply RPC call(s) failed and fell back to separate queries')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
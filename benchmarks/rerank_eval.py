@@ -0,0 +1,128 @@
+"""Retrieval quality and added latency of the cross-encoder re-rank stage.
+
+Embeds the passages of a labelled set (benchmarks/data/rerank_eval.json by
+default: handbook-style passages with near-miss distractors), retrieves the top
+--candidates per query by cosine similarity, then re-orders them with
+bot.rerank_passages(). Reports precision@1, recall@N and MRR for the vector
+order and the re-ranked order, the latency the re-rank stage adds, and how many
+queries fell back to the vector order under --timeout.
+
+Usage:
+    python benchmarks/rerank_eval.py --embedder local --model cross-encoder/ms-marco-MiniLM-L-6-v2
+    python benchmarks/rerank_eval.py --embedder hf --model cross-encoder/ms-marco-MiniLM-L-6-v2 --timeout 0.1
+    python benchmarks/rerank_eval.py --embedder fake --model fake      # offline smoke test of the pipeline
+
+--embedder local needs sentence-transformers and downloads HF_EMBED_MODEL;
+--embedder hf calls the Hugging Face Inference API with HF_API_KEY. The fake
+embedder and cross-encoder need neither, but their scores say nothing about
+retrieval quality.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['DISCORD_TOKEN'] = ''
+
+import bot  # noqa: E402
+from fakes import FakeCrossEncoder, fake_embedding  # noqa: E402
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'rerank_eval.json')
+
+
+async def embed_all(texts: List[str], embedder: str) -> np.ndarray:
+    """Unit-normalised embeddings for `texts`."""
+    if embedder == 'fake':
+        vectors = [fake_embedding(t) for t in texts]
+    elif embedder == 'local':
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(bot.HF_EMBED_MODEL, device='cpu')
+        vectors = list(model.encode(texts))
+    else:
+        vectors = await bot.hf_embed_batch(texts)
+        if any(v is None for v in vectors):
+            raise SystemExit('Embedding failed; check HF_API_KEY')
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def score(rankings: List[List[str]], relevant: List[List[str]], top_n: int) -> Dict[str, float]:
+    """precision@1, recall@top_n and MRR over all queries."""
+    p1, recall, mrr = [], [], []
+    for ranked, rel in zip(rankings, relevant):
+        p1.append(1.0 if ranked and ranked[0] in rel else 0.0)
+        recall.append(len(set(ranked[:top_n]) & set(rel)) / len(rel))
+        mrr.append(next((1.0 / (i + 1) for i, doc_id in enumerate(ranked) if doc_id in rel), 0.0))
+    return {'precision@1': statistics.mean(p1), f'recall@{top_n}': statistics.mean(recall), 'mrr': statistics.mean(mrr)}
+
+
+async def run(args: argparse.Namespace):
+    with open(args.dataset, encoding='utf-8') as f:
+        dataset = json.load(f)
+    passages = dataset['passages']
+    queries = dataset['queries']
+
+    passage_vectors = await embed_all([p['text'] for p in passages], args.embedder)
+    query_vectors = await embed_all([q['query'] for q in queries], args.embedder)
+
+    if args.model == 'fake':
+        bot.reranker = FakeCrossEncoder()
+    else:
+        bot.reranker = bot._load_cross_encoder(args.model)
+        bot.reranker.predict([('warm up', 'warm up')], batch_size=1, show_progress_bar=False)
+    bot.RERANK_TIMEOUT = args.timeout
+
+    vector_rankings: List[List[str]] = []
+    reranked_rankings: List[List[str]] = []
+    added_ms: List[float] = []
+    fallbacks = 0
+    for query, vector in zip(queries, query_vectors):
+        similarities = passage_vectors @ vector
+        top = np.argsort(-similarities)[:args.candidates]
+        docs = [{'id': passages[i]['id'], 'content': passages[i]['text'], 'similarity': float(similarities[i])} for i in top]
+        vector_rankings.append([d['id'] for d in docs])
+
+        start = time.perf_counter()
+        reranked = await bot.rerank_passages(query['query'], [dict(d) for d in docs], args.top_n)
+        added_ms.append((time.perf_counter() - start) * 1000)
+        if reranked is None:
+            fallbacks += 1
+            reranked = docs
+        reranked_rankings.append([d['id'] for d in reranked])
+
+    relevant = [q['relevant'] for q in queries]
+    before = score(vector_rankings, relevant, args.top_n)
+    after = score(reranked_rankings, relevant, args.top_n)
+    print(f"{len(queries)} queries, {len(passages)} passages, {args.candidates} candidates, top {args.top_n}")
+    print(f"{'metric':<14}{'vector':>10}{'reranked':>10}")
+    for key in before:
+        print(f'{key:<14}{before[key]:>10.3f}{after[key]:>10.3f}')
+    print(f'added latency: p50 {statistics.median(added_ms):.1f} ms, '
+          f'p95 {sorted(added_ms)[int(0.95 * (len(added_ms) - 1))]:.1f} ms, '
+          f'fallbacks {fallbacks}/{len(queries)} (timeout {args.timeout * 1000:.0f} ms)')
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=DEFAULT_DATASET)
+    parser.add_argument('--embedder', choices=('local', 'hf', 'fake'), default='local')
+    parser.add_argument('--model', default='cross-encoder/ms-marco-MiniLM-L-6-v2', help="cross-encoder name, or 'fake'")
+    parser.add_argument('--candidates', type=int, default=bot.RERANK_CANDIDATES, help='vector-search hits re-ranked per query')
+    parser.add_argument('--top-n', type=int, default=3, help='passages kept after re-ranking')
+    parser.add_argument('--timeout', type=float, default=bot.RERANK_TIMEOUT, help='re-rank time cap in seconds')
+    asyncio.run(run(parser.parse_args(argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+"""Import time, memory and time to gateway connect for bot.py.
+
+Starts a fresh interpreter per run with `python -X importtime`, imports bot
+and runs Client.start() with the Discord login and gateway patched out: the
+fake login returns a user, setup_hook runs as usual, and the run stops when
+discord.py calls connect(), i.e. the moment the bot would open the gateway.
+It then waits for clients_ready (the Supabase and Hugging Face clients, built
+in the background) so that cost is reported too.
+
+Credentials are dummies, so client construction is exercised without network
+access. Reports the median over --runs of:
+
+    import ms    process start until `import bot` returns
+    connect ms   process start until the gateway connect
+    clients ms   process start until the Supabase/HF clients exist
+    RSS MB       resident memory after import and at connect
+
+plus the slowest top-level imports of bot.py. Each run is appended to
+--history (one JSON line with the commit and date) so startup regressions show
+up over time, and the exit code is 1 when connect ms exceeds --target-ms.
+
+Usage:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 10 --top 15
+    python benchmarks/startup.py --target-ms 800 --no-record
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_PATH = os.path.join(ROOT, 'benchmarks', 'startup_history.jsonl')
+STARTUP_TARGET_MS = 750  # process start to gateway connect
+
+CHILD = r'''
+import asyncio, json, os, sys, time, types
+spawned = float(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+import bot
+marks = {'import': time.time(), 'rss_import': rss_mb()}
+import discord
+
+async def static_login(token):
+    return {'id': '1', 'username': 'startup-bench', 'discriminator': '0', 'avatar': None, 'bot': True}
+
+async def application_info():
+    return types.SimpleNamespace(id=1, interactions_endpoint_url=None, flags=discord.ApplicationFlags())
+
+async def connect(reconnect=True):
+    marks['connect'] = time.time()
+    marks['rss_connect'] = rss_mb()
+    ready = getattr(bot, 'clients_ready', None)  # absent before clients were built at startup
+    if ready is not None:
+        await asyncio.wait_for(ready.wait(), 30)
+    marks['clients'] = time.time()
+    print('STARTUP ' + json.dumps({k: v if k.startswith('rss') else (v - spawned) * 1000 for k, v in marks.items()}), flush=True)
+    os._exit(0)  # skip shutdown, which would wait for the health checks started by setup_hook
+
+client = bot.bot
+client.http.static_login = static_login
+client.application_info = application_info
+client.connect = connect
+
+async def main():
+    async with client:
+        await client.start('startup-bench')
+
+asyncio.run(main())
+'''
+
+CHILD_ENV = {
+    'DISCORD_TOKEN': 'startup-bench',
+    'SUPABASE_URL': 'https://startup-bench.supabase.co',
+    'SUPABASE_SERVICE_ROLE_KEY': 'startup-bench',
+    'HF_API_KEY': 'hf_startup_bench',
+    'DATABASE_URL': '',
+    'TRACE_EXPORTER': 'none',
+    'HEALTH_PROBE_INTERVAL': '3600',
+}
+
+
+def parse_importtime(stderr: str) -> Tuple[float, Dict[str, float]]:
+    """Cumulative ms of `import bot` and of each module bot.py imports directly."""
+    children: Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if name == 'bot' and depth == 0:
+            return int(cumulative) / 1000, children
+        if depth == 1:
+            children[name] = int(cumulative) / 1000
+    return 0.0, children
+
+
+def run_once() -> Dict[str, Any]:
+    env = dict(os.environ, **CHILD_ENV)
+    spawned = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, repr(spawned), ROOT],
+                          env=env, cwd=ROOT, capture_output=True, text=True, timeout=120)
+    result = next((json.loads(line[len('STARTUP '):]) for line in proc.stdout.splitlines()
+                   if line.startswith('STARTUP ')), None)
+    if proc.returncode != 0 or result is None:
+        raise RuntimeError(f'startup run failed (exit {proc.returncode}):\n{proc.stderr[-2000:]}')
+    result['importtime_ms'], result['imports'] = parse_importtime(proc.stderr)
+    return result
+
+
+def git_commit() -> str:
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    return proc.stdout.strip() or 'unknown'
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest direct imports to list')
+    parser.add_argument('--target-ms', type=float, default=STARTUP_TARGET_MS, help='connect ms budget (exit 1 above it)')
+    parser.add_argument('--history', default=HISTORY_PATH, help='JSONL file the summary is appended to')
+    parser.add_argument('--no-record', dest='record', action='store_false', help="don't append to --history")
+    args = parser.parse_args(argv)
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    def median(key: str) -> float:
+        return statistics.median(r[key] for r in runs)
+
+    summary = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'import_ms': round(median('import'), 1),
+        'importtime_ms': round(median('importtime_ms'), 1),
+        'connect_ms': round(median('connect'), 1),
+        'clients_ms': round(median('clients'), 1),
+        'rss_import_mb': round(median('rss_import'), 1),
+        'rss_connect_mb': round(median('rss_connect'), 1),
+        'target_ms': args.target_ms,
+    }
+    imports = {name: statistics.median(r['imports'].get(name, 0.0) for r in runs) for name in runs[0]['imports']}
+
+    print(f"{'import ms':<14}{summary['import_ms']:>10.1f}   (-X importtime: {summary['importtime_ms']:.1f})")
+    print(f"{'connect ms':<14}{summary['connect_ms']:>10.1f}   (target {args.target_ms:.0f})")
+    print(f"{'clients ms':<14}{summary['clients_ms']:>10.1f}")
+    print(f"{'RSS MB':<14}{summary['rss_import_mb']:>10.1f}   at import, {summary['rss_connect_mb']:.1f} at connect")
+    print(f"\nslowest imports in bot.py (cumulative ms, median of {args.runs}):")
+    for name, ms in sorted(imports.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f'  {name:<40}{ms:>8.1f}')
+
+    if args.record:
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(summary) + '\n')
+        print(f'\nappended to {os.path.relpath(args.history)}')
+    if summary['connect_ms'] > args.target_ms:
+        print(f"connect took {summary['connect_ms']:.0f} ms, over the {args.target_ms:.0f} ms target")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
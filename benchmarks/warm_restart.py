@@ -0,0 +1,240 @@
+"""Database queries, LLM calls and reply latency in the first minutes after a restart, with and without the warm-state snapshot.
+
+Replays Poisson traffic (--rate messages per simulated second over --guilds
+guilds with Zipf popularity, answer cache enabled, a fixed pool of questions
+per guild, and a role lookup for one in five messages as command permission
+checks do) through on_message against the fake Supabase and Hugging Face
+backends (fakes.py). Time is compressed by --speedup; CONFIG_CACHE_TTL and
+ANSWER_CACHE_TTL are scaled by the same factor.
+
+Each mode runs --duration simulated seconds of traffic to warm the caches,
+writes a snapshot, and simulates a restart by clearing every in-process cache.
+With the snapshot it then restores it (revalidation runs in the background,
+as at startup). It replays another --duration seconds. Before the restart one
+guild's config, its team lead's role and another guild's knowledge base are
+changed, so revalidation has stale entries to find.
+
+Reports, for the first simulated minute and the whole window after the
+restart: database queries, LLM chat calls, and p50/p99 reply latency.
+
+Usage:
+    python benchmarks/warm_restart.py
+    python benchmarks/warm_restart.py --guilds 100 --rate 1 --speedup 30
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for _var in ('DISCORD_TOKEN', 'SUPABASE_URL', 'SUPABASE_SERVICE_ROLE_KEY', 'HF_API_KEY'):
+    os.environ[_var] = ''
+
+import bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeChannel, FakeGuild, FakeInferenceClient, FakeMessage, FakeSupabase, FakeUser,
+    install_fakes, next_snowflake,
+)
+
+QUESTIONS = [
+    'How do I reset my password?',
+    'What are the office hours?',
+    'Can you explain how the deployment pipeline works?',
+    'What does the onboarding document say about laptops?',
+    'Summarize the knowledge base entry on billing.',
+    'Where is the style guide kept?',
+    'Who do I ask about expense reports?',
+    'How do I request time off?',
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class World:
+    """The fake backends plus the guilds, channels and users that traffic is drawn from."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.rng = random.Random(args.seed)
+        self.hf = FakeInferenceClient(chat_latency=args.chat_latency, embed_latency=args.embed_latency, jitter=0.3)
+        self.db = FakeSupabase(latency=args.db_latency, jitter=0.3)
+        install_fakes(bot, hf=self.hf, db=self.db)
+        bot.web_search_available = False  # keep classification calls out of the LLM counts
+        self.guilds = []
+        for rank in range(args.guilds):
+            guild = FakeGuild(next_snowflake(), f'guild-{rank}')
+            guild_id = str(guild.id)
+            users = [FakeUser(next_snowflake(), f'user-{rank}-{u}') for u in range(5)]
+            self.db.table('bot_config').insert({
+                'guild_id': guild_id, 'guild_name': guild.name, 'bot_name': 'DasAI Assistant',
+                'system_instructions': 'You are a helpful assistant.', 'allowed_channels': [],
+                'guild_rate_limit': 0, 'channel_rate_limit': 0, 'user_rate_limit': 0,
+                'answer_cache': True, 'updated_at': self.db.now(),
+            }).execute()
+            for i, user in enumerate(users):
+                self.db.table('user_roles').insert({
+                    'guild_id': guild_id, 'user_id': str(user.id), 'username': user.name,
+                    'role': 'team_lead' if i == 0 else 'member', 'updated_at': self.db.now(),
+                }).execute()
+            self.db.seed_knowledge(guild_id, 8)
+            self.guilds.append((guild_id, FakeChannel(next_snowflake(), guild), users))
+        self.weights = [1 / (rank + 1) for rank in range(args.guilds)]
+
+    def change_before_restart(self):
+        """Edit one guild's config, add a document to another and remove the first's team lead."""
+        first, second = self.guilds[0][0], self.guilds[1][0]
+        self.db.table('user_roles').delete().eq('guild_id', first).eq('user_id', str(self.guilds[0][2][0].id)).execute()
+        self.db.table('bot_config').update({
+            'system_instructions': 'You are a terse assistant.', 'updated_at': self.db.now(),
+        }).eq('guild_id', first).execute()
+        self.db.table('knowledge_sources').insert({
+            'guild_id': second, 'title': 'New policy', 'chunk_count': 1, 'char_count': 100,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }).execute()
+
+    async def replay(self, args: argparse.Namespace) -> List[Dict[str, Any]]:
+        """Send --duration simulated seconds of traffic; per-message records."""
+        records: List[Dict[str, Any]] = []
+        tasks = []
+        start = time.perf_counter()
+        sim_time = 0.0
+
+        async def handle(guild_id: str, message: FakeMessage, sim_at: float, check_role: bool):
+            began = time.perf_counter()
+            if check_role:
+                await bot.get_user_role(guild_id, str(message.author.id))
+            await bot.on_message(message)
+            records.append({'sim_at': sim_at, 'latency': time.perf_counter() - began,
+                            'replied': bool(message.replies)})
+
+        while True:
+            sim_time += self.rng.expovariate(args.rate)
+            if sim_time >= args.duration:
+                break
+            delay = start + sim_time / args.speedup - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            guild_id, channel, users = self.rng.choices(self.guilds, self.weights)[0]
+            message = FakeMessage(self.rng.choice(QUESTIONS), self.rng.choice(users), channel)
+            channel.messages.append(message)
+            tasks.append(asyncio.create_task(handle(guild_id, message, sim_time, self.rng.random() < 0.2)))
+        await asyncio.gather(*tasks)
+        return records
+
+
+def restart():
+    """Forget everything a new process wouldn't have."""
+    bot.guild_config_cache.clear()
+    bot.guild_config_cache_time.clear()
+    bot.role_cache.clear()
+    bot.answer_caches.clear()
+    bot.rate_buckets.clear()
+    bot.hedgers.clear()
+    bot.breakers.clear()
+
+
+async def counted_window(world: World, args: argparse.Namespace) -> Dict[str, Any]:
+    """Replay after the restart, sampling the query and chat counters at the end of the first minute."""
+    queries, chats = world.db.queries, world.hf.chat_calls
+    first_minute: Dict[str, int] = {}
+
+    async def sample():
+        await asyncio.sleep(60 / args.speedup)
+        first_minute['queries'] = world.db.queries - queries
+        first_minute['chats'] = world.hf.chat_calls - chats
+
+    sampler = asyncio.create_task(sample())
+    records = await world.replay(args)
+    await sampler
+    return {
+        'records': records,
+        'queries': world.db.queries - queries,
+        'chats': world.hf.chat_calls - chats,
+        'first_queries': first_minute['queries'],
+        'first_chats': first_minute['chats'],
+    }
+
+
+async def run_mode(args: argparse.Namespace, snapshot: bool, state_dir: str) -> Dict[str, Any]:
+    restart()
+    bot.metrics.clear()
+    world = World(args)
+    await world.replay(args)
+    bot.WARM_STATE_DIR = state_dir
+    bot.save_warm_state()
+    world.change_before_restart()
+
+    restart()
+    queries = world.db.queries
+    if snapshot:
+        await bot.restore_warm_state()
+    window = await counted_window(world, args)
+    records = window['records']
+    first = [r['latency'] for r in records if r['sim_at'] < 60]
+    latencies = [r['latency'] for r in records]
+    return {
+        'mode': 'snapshot' if snapshot else 'cold',
+        'messages': len(records),
+        'replied': sum(r['replied'] for r in records),
+        'first_queries': window['first_queries'],
+        'first_chats': window['first_chats'],
+        'first_p99': percentile(first, 99) * 1000,
+        'queries': world.db.queries - queries,
+        'chats': window['chats'],
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'stale': {k.split('.')[-1]: v for k, v in bot.metrics.items() if k.startswith('warm_state.stale.')},
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    bot.CONFIG_CACHE_TTL = 60 / args.speedup
+    bot.ANSWER_CACHE_TTL = int(3600 / args.speedup)
+    state_dir = tempfile.mkdtemp(prefix='warm_state_')
+    try:
+        return [await run_mode(args, snapshot, state_dir) for snapshot in (False, True)]
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per simulated second')
+    parser.add_argument('--duration', type=float, default=300, help='simulated seconds before and after the restart')
+    parser.add_argument('--speedup', type=float, default=20, help='simulated seconds per real second')
+    parser.add_argument('--db-latency', type=float, default=0.02, help='Supabase round trip (s)')
+    parser.add_argument('--chat-latency', type=float, default=0.15, help='mean chat completion latency (s)')
+    parser.add_argument('--embed-latency', type=float, default=0.02, help='mean embedding latency (s)')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f'{args.guilds} guilds, {args.rate:g} msg/s, first {args.duration:.0f} s after a restart '
+          f'(simulated, {args.speedup:g}x)')
+    print(f"{'mode':<10}{'msgs':>6}{'1st min DB':>12}{'1st min LLM':>13}{'1st min p99':>13}"
+          f"{'DB total':>10}{'LLM total':>11}{'p50 ms':>8}{'p99 ms':>8}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['messages']:>6}{r['first_queries']:>12}{r['first_chats']:>13}{r['first_p99']:>11.0f}ms"
+              f"{r['queries']:>10}{r['chats']:>11}{r['p50']:>8.0f}{r['p99']:>8.0f}")
+    stale = results[-1]['stale']
+    print(f"revalidation: {stale.get('configs', 0)} stale config(s), {stale.get('roles', 0)} stale role(s), "
+          f"{stale.get('answers', 0)} answer cache(s) dropped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
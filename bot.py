@@ -5,27 +5,80 @@ import os
 import sys
 import asyncio
 import io
+import json
+import time
+import random
+import contextlib
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import abc
+import subprocess
+import signal
+import sqlite3
+import gzip
+import hashlib
+import re
+import struct
+import uuid
+import bisect
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict
+import importlib.util
 import aiohttp
 from dotenv import load_dotenv
-from typing import Optional, Any, Dict, List
-from supabase import create_client, Client
-from huggingface_hub import InferenceClient
+from typing import Optional, Any, Awaitable, Callable, Dict, List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from supabase import Client
+    from huggingface_hub import InferenceClient
+
+
+def lazy_import(name: str) -> Any:
+    """Return module `name` without executing it; it loads on first attribute access. None if not installed.
+
+    Keeps the heavy optional subsystems (NumPy, PDF parsing, web search, ANN, tokenizers) out of
+    startup; most processes only touch some of them, and only once traffic arrives.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
 
 # PDF parsing
-try:
-    from PyPDF2 import PdfReader
-    pdf_available = True
-except ImportError:
-    pdf_available = False
+PyPDF2 = lazy_import('PyPDF2')
+pdf_available = PyPDF2 is not None
+if not pdf_available:
     print('PyPDF2 not installed. PDF upload will be disabled.')
 
 # Web search
-try:
-    from ddgs import DDGS
-    web_search_available = True
-except ImportError:
-    web_search_available = False
+ddgs = lazy_import('ddgs')
+web_search_available = ddgs is not None
+if not web_search_available:
     print('ddgs not installed. Web search will be disabled.')
+DDGS: Any = None  # ddgs.DDGS, resolved on the first search
+
+# Direct Postgres connection (LISTEN/NOTIFY cache invalidation)
+asyncpg = lazy_import('asyncpg')
+asyncpg_available = asyncpg is not None
+
+# Tokenizer for prompt token budgeting (falls back to a character estimate)
+tokenizers = lazy_import('tokenizers')
+tokenizers_available = tokenizers is not None
+
+# Approximate nearest-neighbour search for large local vector indexes
+hnswlib = lazy_import('hnswlib')
+hnswlib_available = hnswlib is not None
 
 # Load environment variables
 load_dotenv()
@@ -37,21 +90,394 @@ SUPABASE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
 HF_API_KEY = os.getenv('HF_API_KEY')
 HF_MODEL = os.getenv('HF_MODEL', 'meta-llama/Llama-3.2-3B-Instruct')
 HF_EMBED_MODEL = os.getenv('HF_EMBED_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
-
-# Initialize clients
-supabase: Optional[Client] = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
-hf_client: Optional[InferenceClient] = InferenceClient(token=HF_API_KEY) if HF_API_KEY else None
+EMBED_DIMENSIONS = 384  # all-MiniLM-L6-v2; must match vector(384) in database/schema.sql
+
+# Chat backends, tried in order with failover: 'hf' (Hugging Face Inference), 'openai' (any
+# OpenAI-compatible server: llama.cpp, vLLM, Ollama, TGI) and 'fake' (deterministic, for tests).
+# Guilds can put one first with bot_config.llm_backend.
+LLM_BACKENDS = [b.strip() for b in os.getenv('LLM_BACKENDS', 'hf').lower().split(',') if b.strip()]
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'http://localhost:8080/v1')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', '')  # model name on the server; defaults to HF_MODEL
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))  # seconds per chat request
+LLM_MAX_CONNECTIONS = 32  # pooled keep-alive connections per HTTP backend
+LLM_FAILOVER_COOLDOWN = 30  # seconds a failed backend is skipped while others are available
+
+# Request hedging: when a chat, embedding or web search call is still running at the endpoint's
+# recent HEDGE_PERCENTILE latency, a duplicate is sent (chat: to the next healthy backend, if any)
+# and the first answer wins. Only the kinds listed in HEDGE_ENDPOINTS (chat, embed, search) are
+# hedged; latencies are tracked for all of them and shown by !metrics.
+HEDGE_ENDPOINTS = {e.strip() for e in os.getenv('HEDGE_ENDPOINTS', '').lower().split(',') if e.strip()}
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_BUDGET = float(os.getenv('HEDGE_BUDGET', '0.05'))  # hedges per request, caps the extra load in an outage
+HEDGE_BUDGET_BURST = 10  # hedges an endpoint can save up while it's fast
+HEDGE_MIN_SAMPLES = 20  # latencies observed before an endpoint is hedged
+HEDGE_MIN_DELAY = 0.02  # seconds; never hedge sooner than this
+LATENCY_WINDOW = 300  # seconds of latency history the percentiles cover
+
+# Circuit breakers per dependency (each chat backend, embed, search, supabase): after
+# BREAKER_FAILURES consecutive failures or timeouts, calls fail fast for BREAKER_COOLDOWN seconds
+# and replies degrade (no RAG, no web search, no memory, or a notice when no chat backend is left).
+# Then one trial call decides whether the breaker closes again. Timeouts adapt to the dependency's
+# recent p99 latency times BREAKER_TIMEOUT_FACTOR, between BREAKER_MIN_TIMEOUT and the fixed limits below.
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))  # seconds
+BREAKER_TIMEOUT_FACTOR = float(os.getenv('BREAKER_TIMEOUT_FACTOR', '3'))
+BREAKER_MIN_TIMEOUT = 1.0  # seconds
+BREAKER_MIN_SAMPLES = 20  # latencies observed before the timeout adapts
+EMBED_TIMEOUT = 30  # seconds per embedding request
+EMBED_BATCH_SIZE = 32  # texts per batched embedding request, so batch latencies stay comparable
+SEARCH_TIMEOUT = 20  # seconds per web search
+DB_TIMEOUT = float(os.getenv('DB_TIMEOUT', '10'))  # seconds per database call on the reply path
+DEGRADED_NOTICE = "⚠️ My AI backend isn't responding right now, so I can't answer. Please try again in a minute."
+
+# Readiness: after one full check at startup, backends are re-probed on cheap metadata endpoints
+# (no inference calls), so availability follows outages and recoveries without spending quota
+HEALTH_PROBE_INTERVAL = int(os.getenv('HEALTH_PROBE_INTERVAL', '60'))  # seconds
+HEALTH_PROBE_FAILURES = 3  # consecutive failed probes before a backend is treated as down
+HF_HUB_MODELS_API = 'https://huggingface.co/api/models'
+# Slash commands are only re-synced with Discord when their definitions change
+COMMAND_TREE_HASH_PATH = os.getenv('COMMAND_TREE_HASH_PATH', '.command_tree_hash')
+
+# Model cascade: short/conversational replies without retrieved context go to SMALL_MODEL;
+# anything with knowledge/web context or scoring above CASCADE_THRESHOLD goes to HF_MODEL.
+# Unset SMALL_MODEL to send everything to HF_MODEL.
+SMALL_MODEL = os.getenv('SMALL_MODEL', '')
+SMALL_MAX_TOKENS = 400
+CASCADE_THRESHOLD = float(os.getenv('CASCADE_THRESHOLD', '0.35'))
+CASCADE_ESCALATE = os.getenv('CASCADE_ESCALATE', 'false').lower() in ('1', 'true', 'yes')  # retry weak small-model answers on HF_MODEL
+ROUTING_LOG_PATH = os.getenv('ROUTING_LOG_PATH', '')  # JSONL log of routing decisions, for tuning the threshold
+
+# Direct Postgres URL (Supabase: Settings > Database > Connection string), used for LISTEN/NOTIFY
+DATABASE_URL = os.getenv('DATABASE_URL')
+CACHE_NOTIFY_CHANNEL = 'dasai_cache'
+# DIRECT_DB: run knowledge search, chunk inserts (COPY) and conversation memory over the asyncpg
+# pool with a binary pgvector codec instead of PostgREST. Needs DATABASE_URL on a session-mode
+# connection (port 5432): asyncpg caches prepared statements per connection, which a
+# transaction-mode pooler breaks.
+DIRECT_DB = os.getenv('DIRECT_DB', 'false').lower() in ('1', 'true', 'yes')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+# Answer a message with two database calls, get_reply_context (config, memory and knowledge chunks)
+# before the reply and record_exchange (message row and memory counter) after it, instead of one
+# call per table. Falls back to the separate queries when the functions aren't in the schema.
+REPLY_CONTEXT_RPC = os.getenv('REPLY_CONTEXT_RPC', 'true').lower() in ('1', 'true', 'yes')
+
+# Scaling configuration
+# BOT_WORKERS: number of bot processes to launch; shards are split evenly between them
+# SHARD_COUNT: total number of shards across all workers ('auto' lets Discord decide, single process only)
+# WORKER_INDEX: set by the launcher for each worker process
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')
+WORKER_INDEX = os.getenv('WORKER_INDEX')
+# GATEWAY_PROFILE: 'default' chunks every guild's member list at startup and caches all members plus
+# the last 1000 messages; 'lean' caches neither (members arrive with each message/interaction and are
+# fetched on demand), so memory stays flat as guild sizes grow
+GATEWAY_PROFILE = os.getenv('GATEWAY_PROFILE', 'default').lower()
+
+# Job queue configuration
+# BOT_ROLE: 'all' runs everything in one process; 'gateway' holds the Discord connection and
+# queues heavy jobs; 'worker' consumes the queue without connecting to Discord
+BOT_ROLE = os.getenv('BOT_ROLE', 'all').lower()
+JOB_QUEUE = os.getenv('JOB_QUEUE', 'postgres' if DATABASE_URL else 'sqlite').lower()  # 'postgres' or 'sqlite'
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'jobs.db')  # SQLite file shared by local processes
+JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY', '2'))  # jobs run at once per worker process
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 5  # seconds between queue polls when no NOTIFY arrives
+JOB_HEARTBEAT_INTERVAL = 30  # seconds between updated_at refreshes while a job runs
+JOB_STALE_AFTER = 120  # seconds without a heartbeat before a running job from a dead worker is reclaimed
+JOB_NOTIFY_CHANNEL = 'dasai_jobs'
+
+# Embedding backfill: knowledge chunks stored without an embedding are embedded in the background
+EMBEDDING_BACKFILL_BATCH = int(os.getenv('EMBEDDING_BACKFILL_BATCH', '32'))
+EMBEDDING_BACKFILL_INTERVAL = 30  # seconds between polls when no NOTIFY arrives
+BACKFILL_NOTIFY_CHANNEL = 'dasai_backfill'
+
+# Message retention (opt-in, requires DATABASE_URL): expired history is archived to gzip JSONL, then dropped.
+# Nothing is deleted unless MESSAGE_ARCHIVE_DIR is set; point it at persistent storage (a mounted volume).
+MESSAGE_RETENTION_DAYS = int(os.getenv('MESSAGE_RETENTION_DAYS', '0'))  # for guilds without their own setting; 0 keeps everything
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', '')
+MESSAGE_RETENTION_INTERVAL = 6 * 3600  # seconds between retention runs
+MESSAGES_PARTITION_INTERVAL = 24 * 3600  # seconds between ensure_messages_partitions calls (every process)
+MESSAGES_PARTITION_PATTERN = re.compile(r'^messages_p(\d{4})_(\d{2})$')
+
+# Embedding ANN index layout: vector (float32 IVFFlat), or halfvec/binary (quantized HNSW with
+# exact float re-rank of EMBEDDING_CANDIDATES rows). Requires pgvector >= 0.7 for the quantized modes.
+EMBEDDING_INDEX = os.getenv('EMBEDDING_INDEX', 'vector').lower()
+EMBEDDING_CANDIDATES = int(os.getenv('EMBEDDING_CANDIDATES', '40'))
+# mode -> (search RPC, index name, index definition)
+EMBEDDING_INDEXES = {
+    'vector': ('search_documents', 'idx_knowledge_embedding',
+               'USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100)'),
+    'halfvec': ('search_documents_halfvec', 'idx_knowledge_embedding_halfvec',
+                'USING hnsw ((embedding::halfvec(384)) halfvec_cosine_ops)'),
+    'binary': ('search_documents_binary', 'idx_knowledge_embedding_binary',
+               'USING hnsw ((binary_quantize(embedding)::bit(384)) bit_hamming_ops)'),
+}
+if EMBEDDING_INDEX not in EMBEDDING_INDEXES:
+    print(f'Unknown EMBEDDING_INDEX={EMBEDDING_INDEX!r}, using vector')
+    EMBEDDING_INDEX = 'vector'
+
+# Local vector index: per-guild in-process copy of the knowledge embeddings, searched before the DB
+LOCAL_VECTOR_INDEX = os.getenv('LOCAL_VECTOR_INDEX', 'false').lower() in ('1', 'true', 'yes')
+LOCAL_INDEX_DIR = os.getenv('LOCAL_INDEX_DIR', 'vector_index')
+LOCAL_INDEX_MAX_GUILDS = int(os.getenv('LOCAL_INDEX_MAX_GUILDS', '32'))  # loaded at once, LRU-evicted
+LOCAL_INDEX_RECONCILE_INTERVAL = 300  # seconds between checks against the database
+LOCAL_INDEX_HNSW_MIN = 2000  # below this many chunks, exact NumPy search is already sub-millisecond
+
+# Minimum cosine similarity of knowledge search hits (kept low for recall; re-ranking sorts them out)
+KNOWLEDGE_MATCH_THRESHOLD = 0.35
+
+# Cross-encoder re-ranking of knowledge search candidates (needs sentence-transformers; off when unset)
+RERANK_MODEL = os.getenv('RERANK_MODEL', '')  # e.g. cross-encoder/ms-marco-MiniLM-L-6-v2
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', '20'))  # vector-search hits scored per query
+RERANK_TIMEOUT = float(os.getenv('RERANK_TIMEOUT', '0.3'))  # seconds before falling back to vector order
+RERANK_MAX_PENDING = 2  # batches queued on the re-rank thread before new queries skip it
+
+# Semantic answer cache: guilds with bot_config.answer_cache reuse the answer to an earlier question
+# whose embedding is at least ANSWER_CACHE_THRESHOLD similar. Cleared when the guild's knowledge
+# base or system instructions change.
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.92'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))  # seconds an answer is reused
+ANSWER_CACHE_SIZE = 256  # answers kept per guild, least recently used evicted
+ANSWER_CACHE_MAX_GUILDS = 256
+ANSWER_CACHE_MIN_WORDS = 3  # shorter messages are usually follow-ups that depend on the conversation
+
+# Warm-state snapshot: the config, role and answer caches are written to WARM_STATE_DIR every
+# WARM_STATE_INTERVAL seconds and at shutdown, and restored at startup so a restart doesn't send
+# every guild's first requests to the database and the LLM at once. Restored entries are checked
+# against the database in a few batched queries. Off unless a directory is set; use one on a
+# persistent volume, since the snapshot holds cached answers and roles.
+WARM_STATE_DIR = os.getenv('WARM_STATE_DIR', '')
+WARM_STATE_INTERVAL = int(os.getenv('WARM_STATE_INTERVAL', '300'))
+WARM_STATE_FORMAT = 1  # bumped when the snapshot layout changes; other versions are ignored
+
+# Prompt budget: prompt tokens allowed per AI reply (0 = no limit). Context sources are filled in
+# priority order, each up to its own cap; whatever doesn't fit is trimmed or dropped.
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+PROMPT_SECTION_BUDGETS = [('knowledge', 1200), ('web', 600), ('history', 900), ('memory', 300)]
+PROMPT_USER_MESSAGE_MAX = 1000  # tokens of the triggering message kept
+PROMPT_HISTORY_MESSAGES = 10  # recent channel messages considered for the history section
+CHAT_MESSAGE_OVERHEAD = 4  # chat-template tokens per message
+TOKENIZER_PATH = os.getenv('TOKENIZER_PATH', '')  # local tokenizer.json instead of HF_MODEL's from the Hub
+# Prompt layout: 'stable' keeps the system message to the guild's instructions alone, byte for byte, and
+# passes knowledge/web/memory with the user's message, so inference servers with prefix caching
+# (TGI, vLLM) reuse the instructions' KV cache; 'inline' (the original layout) puts the context in the system message.
+PROMPT_LAYOUT = os.getenv('PROMPT_LAYOUT', 'inline')
+HISTORY_ANCHORS_MAX = 10000  # channels whose 'stable' history window is remembered, LRU-evicted
+
+# Load shedding: chat completions in flight at the inference backends before new replies are
+# degraded. Replies waiting on the database or web search don't count; only inference backs up.
+MAX_INFLIGHT_REPLIES = int(os.getenv('MAX_INFLIGHT_REPLIES', '32'))
+SHED_MAX_TOKENS = 300  # max_tokens used once replies are shortened
+
+# Burst coalescing: messages in a channel that arrive within COALESCE_WINDOW seconds of each other
+# are answered together with one generation, and a message arriving while that generation runs
+# cancels it and joins the burst. Every reply waits up to COALESCE_WINDOW. 0 disables.
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))
+COALESCE_MAX_WAIT = 5.0  # seconds after a burst's first message when it stops taking new messages
+COALESCE_MAX_MESSAGES = 10
+
+# Clients are created by init_clients() once the event loop runs (setup_hook, run_job_worker);
+# handlers wait for clients_ready before using them
+supabase: Optional['Client'] = None
+hf_client: Optional['InferenceClient'] = None
+clients_ready = asyncio.Event()
 hf_available = False
 embedding_available = False
 
-def _sync_chat_test():
-    """Synchronous wrapper for chat test."""
-    assert hf_client is not None
-    return hf_client.chat_completion(
-        messages=[{'role': 'user', 'content': 'Hi'}],
-        model=HF_MODEL,
-        max_tokens=5
-    )
+# Tracing configuration (OpenTelemetry-style spans)
+# TRACE_EXPORTER: 'none' (disabled), 'jsonl' (append to TRACE_JSONL_PATH) or 'otlp' (POST to a local collector)
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none').lower()
+TRACE_JSONL_PATH = os.getenv('TRACE_JSONL_PATH', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))  # fraction of root spans recorded
+TRACE_FLUSH_INTERVAL = 5  # seconds between exporter flushes
+
+# Active span for the current task; asyncio copies it into child tasks, so context propagates
+_current_span: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('current_span', default=None)
+_trace_buffer: List[Dict[str, Any]] = []  # finished spans waiting for export
+_UNSAMPLED_SPAN: Dict[str, Any] = {'sampled': False}
+_INHERITED_ATTRIBUTES = ('guild.id', 'channel.id')
+
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes: Any):
+    """Record a span around a block of code.
+
+    Child spans share the parent's trace id and inherit its guild/channel attributes.
+    The sampling decision is made once per trace, at the root span.
+    """
+    parent = _current_span.get()
+    if TRACE_EXPORTER == 'none' or (parent is not None and not parent['sampled']):
+        yield None
+        return
+
+    if parent is None and random.random() >= TRACE_SAMPLE_RATE:
+        token = _current_span.set(_UNSAMPLED_SPAN)
+        try:
+            yield None
+        finally:
+            _current_span.reset(token)
+        return
+
+    span: Dict[str, Any] = {
+        'sampled': True,
+        'trace_id': parent['trace_id'] if parent else os.urandom(16).hex(),
+        'span_id': os.urandom(8).hex(),
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'start_ns': time.time_ns(),
+        'end_ns': 0,
+        'attributes': {},
+        'status': 'ok',
+    }
+    if parent:
+        for key in _INHERITED_ATTRIBUTES:
+            if key in parent['attributes']:
+                span['attributes'][key] = parent['attributes'][key]
+    span['attributes'].update({k.replace('_', '.'): v for k, v in attributes.items() if v is not None})
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span['status'] = 'error'
+        span['attributes']['error.message'] = str(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span['end_ns'] = time.time_ns()
+        _trace_buffer.append(span)
+
+
+def traced(name: Optional[str] = None):
+    """Decorator that wraps an async function in a span, tagging guild/channel arguments."""
+    def decorator(func):
+        span_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if TRACE_EXPORTER == 'none':
+                return await func(*args, **kwargs)
+            attributes: Dict[str, Any] = {}
+            try:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                attributes['guild_id'] = bound.get('guild_id')
+                attributes['channel_id'] = bound.get('channel_id')
+            except TypeError:
+                pass
+            with trace_span(span_name, **attributes):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """Encode an attribute value as an OTLP AnyValue."""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _spans_to_otlp(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Convert finished spans into an OTLP/HTTP JSON export request."""
+    otlp_spans = []
+    for span in spans:
+        otlp_span: Dict[str, Any] = {
+            'traceId': span['trace_id'],
+            'spanId': span['span_id'],
+            'name': span['name'],
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(span['start_ns']),
+            'endTimeUnixNano': str(span['end_ns']),
+            'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span['attributes'].items()],
+            'status': {'code': 2 if span['status'] == 'error' else 1},
+        }
+        if span['parent_id']:
+            otlp_span['parentSpanId'] = span['parent_id']
+        otlp_spans.append(otlp_span)
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'dasai-bot'}}]},
+            'scopeSpans': [{'scope': {'name': 'dasai'}, 'spans': otlp_spans}],
+        }]
+    }
+
+
+def _write_trace_jsonl(spans: List[Dict[str, Any]]):
+    """Append spans to the JSONL trace file (runs in an executor)."""
+    with open(TRACE_JSONL_PATH, 'a', encoding='utf-8') as f:
+        for span in spans:
+            f.write(json.dumps({
+                'trace_id': span['trace_id'],
+                'span_id': span['span_id'],
+                'parent_id': span['parent_id'],
+                'name': span['name'],
+                'start_ns': span['start_ns'],
+                'duration_ms': round((span['end_ns'] - span['start_ns']) / 1e6, 3),
+                'status': span['status'],
+                'attributes': span['attributes'],
+            }) + '\n')
+
+
+async def flush_traces():
+    """Export all buffered spans to the configured exporter."""
+    if not _trace_buffer:
+        return
+    spans = _trace_buffer[:]
+    del _trace_buffer[:len(spans)]
+
+    try:
+        if TRACE_EXPORTER == 'jsonl':
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, _write_trace_jsonl, spans)
+        elif TRACE_EXPORTER == 'otlp':
+            async with aiohttp.ClientSession() as session:
+                async with session.post(TRACE_OTLP_ENDPOINT, json=_spans_to_otlp(spans),
+                                        timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    if response.status >= 300:
+                        print(f'Trace export failed: HTTP {response.status}')
+    except Exception as e:
+        print(f'Trace export error: {e}')
+
+
+async def trace_flush_loop():
+    """Background task that periodically exports finished spans."""
+    while True:
+        await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+        await flush_traces()
+
+
+def _create_clients() -> Tuple[Any, Any]:
+    """Import the Supabase and Hugging Face libraries and build the clients (blocking: ~0.5 s of imports)."""
+    db = hf = None
+    if SUPABASE_URL and SUPABASE_KEY:
+        from supabase import create_client
+        db = create_client(SUPABASE_URL, SUPABASE_KEY)
+    if HF_API_KEY:
+        from huggingface_hub import InferenceClient
+        hf = InferenceClient(token=HF_API_KEY)
+    return db, hf
+
+
+async def init_clients():
+    """Create the clients off the event loop, then release handlers waiting on clients_ready."""
+    global supabase, hf_client
+    if clients_ready.is_set():
+        return
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_event_loop()
+        supabase, hf_client = await loop.run_in_executor(None, _create_clients)
+        print(f'Clients ready in {(time.perf_counter() - start) * 1000:.0f}ms')
+    except Exception as e:
+        print(f'Error creating clients: {e}')
+    clients_ready.set()
 
 
 def _sync_embed_test():
@@ -64,26 +490,25 @@ def _sync_embed_test():
 
 
 async def check_hf_api():
-    """Check if Hugging Face API is available."""
+    """Check which chat backends and the Hugging Face embedding model are available."""
     global hf_available, embedding_available
     
+    # Test each chat backend; AI replies are enabled if any of them answers
+    for backend in backend_chain():
+        try:
+            await backend.chat([{'role': 'user', 'content': 'Hi'}], None, 5, 0.7)
+            hf_available = True
+            print(f'Chat backend {backend.name} connected')
+        except Exception as e:
+            backend.failed_until = time.time() + LLM_FAILOVER_COOLDOWN
+            print(f'Chat backend {backend.name} error: {e!r}')
+    if not hf_available:
+        print('No chat backend available (set HF_API_KEY or LLM_BACKENDS). AI features disabled.')
+    
     if not HF_API_KEY or not hf_client:
-        print('HF_API_KEY not set. AI features disabled.')
+        print('HF_API_KEY not set. RAG features disabled.')
         return
     
-    try:
-        # Test chat model using official SDK
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, _sync_chat_test)
-        if response and response.choices:
-            hf_available = True
-            print(f'Hugging Face API connected - Model: {HF_MODEL}')
-        else:
-            print(f'Hugging Face API error: No response from model')
-            
-    except Exception as e:
-        print(f'Hugging Face chat API error: {e}')
-    
     try:
         # Test embedding model
         loop = asyncio.get_event_loop()
@@ -99,14 +524,14 @@ async def check_hf_api():
         print('RAG features disabled.')
 
 
-def _sync_chat(messages: list, model: str) -> Any:
+def _sync_chat(messages: list, model: str, max_tokens: int = 1000, temperature: float = 0.7) -> Any:
     """Synchronous wrapper for chat completion."""
     assert hf_client is not None
     return hf_client.chat_completion(
         messages=messages,
         model=model,
-        max_tokens=1000,
-        temperature=0.7
+        max_tokens=max_tokens,
+        temperature=temperature
     )
 
 
@@ -119,325 +544,2785 @@ def _sync_embed(text: str) -> Any:
     )
 
 
-async def hf_chat(messages: list, model: Optional[str] = None) -> str:
-    """Send chat request to Hugging Face Inference API using official SDK."""
-    if not hf_available or not hf_client:
-        return "AI is not configured. Please set HF_API_KEY."
+# Chat backends
+# Each backend's chat() returns {'content', 'prompt_tokens', 'completion_tokens'} and raises on
+# failure, so llm_chat() can move on to the next one.
+
+class ChatBackend(abc.ABC):
+    """Base class for chat completion backends."""
+    name = ''
     
-    model = model or HF_MODEL
+    def __init__(self):
+        self.failed_until = 0.0  # skipped until then after a failure
     
-    try:
-        # Run synchronous HF client in executor to not block event loop
+    def configured(self) -> bool:
+        return True
+    
+    async def probe(self) -> bool:
+        """Cheap reachability check without running inference."""
+        return True
+    
+    @abc.abstractmethod
+    async def chat(self, messages: list, model: Optional[str], max_tokens: int, temperature: float) -> Dict[str, Any]:
+        """Run a chat completion; returns {'content', 'prompt_tokens', 'completion_tokens'}."""
+    
+    async def close(self):
+        pass
+
+
+class HFBackend(ChatBackend):
+    """Hugging Face Inference API through the SDK's synchronous client, run in an executor."""
+    name = 'hf'
+    
+    def configured(self) -> bool:
+        return hf_client is not None
+    
+    async def probe(self) -> bool:
+        return await hf_model_ready(HF_MODEL)
+    
+    async def chat(self, messages: list, model: Optional[str], max_tokens: int, temperature: float) -> Dict[str, Any]:
         loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: _sync_chat(messages, model)
+        response = await asyncio.wait_for(
+            loop.run_in_executor(chat_executor, lambda: _sync_chat(messages, model or HF_MODEL, max_tokens, temperature)),
+            LLM_TIMEOUT
         )
-        
-        if response and response.choices and len(response.choices) > 0:
-            return response.choices[0].message.content or 'No response generated.'
-        return 'No response generated.'
-            
+        usage = getattr(response, 'usage', None)
+        return {
+            'content': response.choices[0].message.content if response and response.choices else '',
+            'prompt_tokens': getattr(usage, 'prompt_tokens', None) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', None) or 0,
+        }
+
+
+class OpenAIBackend(ChatBackend):
+    """OpenAI-compatible /chat/completions over a pooled keep-alive aiohttp session."""
+    name = 'openai'
+    
+    def __init__(self, base_url: str, api_key: str = '', model: str = ''):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created on first use so it belongs to the running event loop
+        if self._session is None or self._session.closed:
+            headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=LLM_MAX_CONNECTIONS, keepalive_timeout=60),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=LLM_TIMEOUT)
+            )
+        return self._session
+    
+    async def probe(self) -> bool:
+        async with self._get_session().get(f'{self.base_url}/models', timeout=aiohttp.ClientTimeout(total=10)) as response:
+            return response.status < 300
+    
+    async def chat(self, messages: list, model: Optional[str], max_tokens: int, temperature: float) -> Dict[str, Any]:
+        payload = {
+            'model': model or self.model or HF_MODEL,
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+        }
+        async with self._get_session().post(f'{self.base_url}/chat/completions', json=payload) as response:
+            if response.status >= 300:
+                raise RuntimeError(f'HTTP {response.status}: {(await response.text())[:200]}')
+            data = await response.json(content_type=None)
+        usage = data.get('usage') or {}
+        choices = data.get('choices') or []
+        message = (choices[0].get('message') or {}) if choices else {}
+        return {
+            'content': message.get('content') or '',
+            'prompt_tokens': usage.get('prompt_tokens') or 0,
+            'completion_tokens': usage.get('completion_tokens') or 0,
+        }
+    
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class FakeBackend(ChatBackend):
+    """Deterministic offline backend: the reply is derived from the last message."""
+    name = 'fake'
+    
+    async def chat(self, messages: list, model: Optional[str], max_tokens: int, temperature: float) -> Dict[str, Any]:
+        last = str(messages[-1].get('content', '')) if messages else ''
+        if max_tokens <= 5:
+            content = 'NO'
+        else:
+            digest = hashlib.sha1(last.encode('utf-8')).hexdigest()[:8]
+            content = ' '.join(f'Reply {digest}: {last}'.split()[:max_tokens])
+        return {'content': content, 'prompt_tokens': sum(len(str(m.get('content', '')).split()) for m in messages),
+                'completion_tokens': len(content.split())}
+
+
+chat_backends: Dict[str, ChatBackend] = {
+    'hf': HFBackend(),
+    'openai': OpenAIBackend(OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_MODEL),
+    'fake': FakeBackend(),
+}
+
+
+class LLMUnavailable(Exception):
+    """Raised when every chat backend failed or none is configured."""
+
+
+def backend_chain(preferred: Optional[str] = None) -> List[ChatBackend]:
+    """Backends to try, in order: the guild's preferred one, then LLM_BACKENDS."""
+    names = ([preferred] if preferred else []) + [n for n in LLM_BACKENDS if n != preferred]
+    return [chat_backends[n] for n in names if n in chat_backends and chat_backends[n].configured()]
+
+
+class LatencyHistogram:
+    """Rolling latency distribution in log-spaced buckets (1 ms to ~5 min, 20% wide).
+
+    Two halves of LATENCY_WINDOW are kept; the older one is dropped when a new half starts,
+    so percentiles cover the last half to full window.
+    """
+    BOUNDS = [0.001 * 1.2 ** i for i in range(70)]
+    
+    def __init__(self, window: float = LATENCY_WINDOW):
+        self.half = window / 2
+        self.current = [0] * (len(self.BOUNDS) + 1)
+        self.previous = [0] * (len(self.BOUNDS) + 1)
+        self.started = time.monotonic()
+    
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.started < self.half:
+            return
+        fresh = [0] * (len(self.BOUNDS) + 1)
+        self.previous = self.current if now - self.started < 2 * self.half else fresh
+        self.current = list(fresh)
+        self.started = now
+    
+    def record(self, seconds: float):
+        self._rotate()
+        self.current[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+    
+    def count(self) -> int:
+        self._rotate()
+        return sum(self.current) + sum(self.previous)
+    
+    def percentile(self, pct: float) -> Optional[float]:
+        """Upper bound of the bucket holding the pct-th percentile, in seconds (None without samples)."""
+        self._rotate()
+        counts = [a + b for a, b in zip(self.current, self.previous)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank, seen = pct / 100 * total, 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class Hedger:
+    """Latency histogram and hedge budget of one upstream endpoint."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = LatencyHistogram()
+        self.tokens = 1.0
+    
+    def delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None if this endpoint isn't hedged (yet)."""
+        if self.name.split('.')[0] not in HEDGE_ENDPOINTS or self.latency.count() < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, self.latency.percentile(HEDGE_PERCENTILE) or 0.0)
+    
+    def take(self) -> bool:
+        """Spend one hedge from the budget if there is one."""
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+hedgers: Dict[str, Hedger] = {}  # endpoint -> latency histogram and hedge budget
+
+
+def get_hedger(endpoint: str) -> Hedger:
+    if endpoint not in hedgers:
+        hedgers[endpoint] = Hedger(endpoint)
+    return hedgers[endpoint]
+
+
+async def hedged(endpoint: str, call: Callable[[], Awaitable[Any]],
+                 hedge_call: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+    """Await call(), racing hedge_call() (default: call() again) if it outlasts the endpoint's hedge delay.
+
+    The first successful result wins and the other request is cancelled; calls running in an
+    executor thread can't be interrupted, so their result is just discarded. Each request adds
+    HEDGE_BUDGET to the endpoint's budget and each hedge spends 1, so when everything is slow
+    (an outage) at most that fraction of requests is duplicated. The calls are expected to go
+    through guarded(), which records the latencies the hedge delay is based on.
+    """
+    hedger = get_hedger(endpoint)
+    hedger.tokens = min(HEDGE_BUDGET_BURST, hedger.tokens + HEDGE_BUDGET)
+    primary = asyncio.ensure_future(call())
+    delay = hedger.delay()
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                if hedger.take():
+                    return await _hedge_race(endpoint, primary, hedge_call or call)
+                incr_metric(f'hedge.budget_exhausted.{endpoint}')
+        return await primary
+    finally:
+        if not primary.done():
+            primary.cancel()
+
+
+async def _hedge_race(endpoint: str, primary: 'asyncio.Future[Any]', hedge_call: Callable[[], Awaitable[Any]]) -> Any:
+    """Send the hedge and return the first successful result of the two."""
+    incr_metric(f'hedge.fired.{endpoint}')
+    backup = asyncio.ensure_future(hedge_call())
+    pending = {primary, backup}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: t is not primary):
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    if task is backup:
+                        incr_metric(f'hedge.won.{endpoint}')
+                    return task.result()
+                error = task.exception()
+        raise error or asyncio.CancelledError()
+    finally:
+        if not backup.done():
+            backup.cancel()
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one dependency.
+
+    Opens after BREAKER_FAILURES consecutive failures; while open, calls are rejected. After
+    BREAKER_COOLDOWN seconds one trial call is let through (half-open): its success closes the
+    breaker, its failure opens it for another cooldown.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+    
+    def is_open(self) -> bool:
+        """Whether a call made now would be rejected."""
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at < BREAKER_COOLDOWN
+        return self.state == 'half_open' and self.trial_running
+    
+    def allow(self) -> bool:
+        """Admit a call (in half-open, only the one trial call)."""
+        if self.state == 'open' and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = 'half_open'
+            print(f'Circuit breaker {self.name} half-open, sending a trial request')
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+    
+    def success(self):
+        if self.state != 'closed':
+            print(f'Circuit breaker {self.name} closed')
+            incr_metric(f'breaker.closed.{self.name}')
+        self.state, self.failures, self.trial_running = 'closed', 0, False
+    
+    def failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= BREAKER_FAILURES):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            incr_metric(f'breaker.opened.{self.name}')
+            print(f'Circuit breaker {self.name} opened after {self.failures} failure(s)')
+    
+    def release(self):
+        """The trial call was cancelled before it finished; let the next call be the trial."""
+        self.trial_running = False
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+
+def breaker_open(name: str) -> bool:
+    """Whether the named dependency is currently failing fast (so callers can skip it)."""
+    return name in breakers and breakers[name].is_open()
+
+
+def adaptive_timeout(endpoint: str, ceiling: float) -> float:
+    """Timeout for the next call: recent p99 latency times BREAKER_TIMEOUT_FACTOR, at most `ceiling`."""
+    latency = get_hedger(endpoint).latency
+    if latency.count() < BREAKER_MIN_SAMPLES:
+        return ceiling
+    return min(ceiling, max(BREAKER_MIN_TIMEOUT, (latency.percentile(99) or ceiling) * BREAKER_TIMEOUT_FACTOR))
+
+
+async def guarded(name: str, call: Callable[[], Awaitable[Any]], ceiling: float,
+                  endpoint: Optional[str] = None) -> Any:
+    """Await call() through the `name` circuit breaker with an adaptive timeout.
+
+    The latency is recorded under `endpoint` (default: `name`). Raises CircuitOpen without
+    calling while the breaker is open, and TimeoutError (counted as a failure) on timeout.
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        incr_metric(f'breaker.rejected.{name}')
+        raise CircuitOpen(f'{name} circuit breaker is open')
+    endpoint = endpoint or name
+    latency = get_hedger(endpoint).latency
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(call(), adaptive_timeout(endpoint, ceiling))
+    except asyncio.TimeoutError:
+        # Not recorded: the timeout is derived from p99, so counting these would ratchet it upwards
+        incr_metric(f'breaker.timeouts.{name}')
+        breaker.failure()
+        raise
+    except asyncio.CancelledError:
+        # Lost a hedge race or the caller gave up: a lower bound on the latency, not a failure
+        latency.record(time.perf_counter() - start)
+        breaker.release()
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    latency.record(time.perf_counter() - start)
+    breaker.success()
+    return result
+
+
+# Supabase requests, query embeddings and Hugging Face chat completions each get their own
+# threads, so one dependency being slow or hung can't stall the others or push them past their
+# adaptive timeouts. The chat pool holds a full MAX_INFLIGHT_REPLIES of completions: beyond
+# that, load shedding refuses new replies rather than queueing them.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='supabase')
+embed_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='embed')
+chat_executor = ThreadPoolExecutor(max_workers=max(MAX_INFLIGHT_REPLIES, 1), thread_name_prefix='chat')
+
+
+async def db_call(call: Callable[[], Any], endpoint: Optional[str] = None) -> Any:
+    """Run a blocking Supabase request on db_executor, guarded by the supabase breaker.
+
+    Pass an `endpoint` for bulk requests so their latency doesn't stretch the timeout of
+    reply-path queries (and theirs doesn't cut bulk requests short).
+    """
+    loop = asyncio.get_event_loop()
+    return await guarded('supabase', lambda: loop.run_in_executor(db_executor, call), DB_TIMEOUT, endpoint=endpoint)
+
+
+def chat_endpoint(backend: str, model: Optional[str], max_tokens: int) -> str:
+    """Latency histogram (and so adaptive timeout and hedge delay) for a chat call.
+
+    Latency depends on the model and on how long the reply may be: classification calls,
+    SMALL_MODEL answers and full replies are tracked apart, so fast calls don't pull the
+    timeout of long generations down.
+    """
+    tier = 'short' if max_tokens <= 50 else 'medium' if max_tokens <= SMALL_MAX_TOKENS else 'long'
+    return f"chat.{backend}.{model or 'default'}.{tier}"
+
+
+def chat_breaker_open(preferred: Optional[str] = None) -> bool:
+    """Whether every chat backend for a guild is failing fast."""
+    chain = backend_chain(preferred)
+    return bool(chain) and all(breaker_open(f'chat.{b.name}') for b in chain)
+
+
+inflight_chat_calls = 0  # chat completions running or queued at the backends (load shedding signal)
+
+
+async def llm_chat(messages: list, model: Optional[str] = None, max_tokens: int = 1000,
+                   temperature: float = 0.7, backend: Optional[str] = None) -> Dict[str, Any]:
+    """Run a chat completion on the first healthy backend, failing over to the next on errors.
+
+    Backends that failed recently are tried last, and slow requests may be hedged (see hedged()).
+    `model` is passed to whichever backend answers; None means that backend's default.
+    Raises LLMUnavailable if all of them fail.
+    """
+    chain = backend_chain(backend)
+    now = time.time()
+    chain.sort(key=lambda b: b.failed_until > now)  # stable: recently failed ones move to the end
+    last_error: Optional[Exception] = None
+    
+    def endpoint(backend: ChatBackend) -> str:
+        return chat_endpoint(backend.name, model, max_tokens)
+    
+    def breaker_name(backend: ChatBackend) -> str:
+        # A failing SMALL_MODEL mustn't open the breaker that replies on the default model go through
+        return f'chat.{backend.name}' + (f'.{model}' if model else '')
+    
+    async def attempt(backend: ChatBackend) -> Tuple[ChatBackend, Dict[str, Any]]:
+        global inflight_chat_calls
+        inflight_chat_calls += 1
+        try:
+            result = await guarded(breaker_name(backend), lambda: backend.chat(messages, model, max_tokens, temperature),
+                                   LLM_TIMEOUT, endpoint(backend))
+        finally:
+            inflight_chat_calls -= 1
+        return backend, result
+    
+    for primary in chain:
+        start = time.perf_counter()
+        # Hedges go to the next healthy backend, or to the same one again if there is none
+        backup = next((alt for alt in chain if alt is not primary and alt.failed_until <= now
+                       and not breaker_open(breaker_name(alt))), primary)
+        try:
+            b, result = await hedged(endpoint(primary), lambda: attempt(primary), lambda: attempt(backup))
+        except CircuitOpen as e:
+            last_error = e
+            continue
+        except Exception as e:
+            if not model:
+                # Only default-model failures demote the backend (the model may just be unavailable)
+                primary.failed_until = time.time() + LLM_FAILOVER_COOLDOWN
+            incr_metric(f'llm.errors.{primary.name}')
+            print(f'Chat backend {primary.name} failed: {e!r}')
+            last_error = e
+            continue
+        if not model:
+            b.failed_until = 0.0
+        incr_metric(f'llm.requests.{b.name}')
+        if result['prompt_tokens']:
+            incr_metric('llm.prompt_tokens', result['prompt_tokens'])
+        span = _current_span.get()
+        if span is not None and span.get('sampled'):
+            span['attributes'].update({
+                'llm.backend': b.name,
+                'llm.prompt_tokens': result['prompt_tokens'],
+                'llm.completion_tokens': result['completion_tokens'],
+                'llm.latency_ms': round((time.perf_counter() - start) * 1000, 1),
+            })
+        result['backend'] = b.name
+        return result
+    raise LLMUnavailable(str(last_error) if last_error else 'no chat backend configured')
+
+
+async def close_chat_backends():
+    """Close pooled HTTP sessions."""
+    for b in chat_backends.values():
+        await b.close()
+    if _probe_session is not None:
+        await _probe_session.close()
+
+
+# Readiness probes
+_probe_session: Optional[aiohttp.ClientSession] = None
+
+
+async def hf_model_ready(model: str) -> bool:
+    """Whether the Hub answers for `model` (a metadata request, no quota used).
+
+    The Hub's `inference` status isn't used: models served through Inference Providers, or
+    reported cold, still answer requests. Raises on network errors.
+    """
+    global _probe_session
+    if _probe_session is None or _probe_session.closed:
+        _probe_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    headers = {'Authorization': f'Bearer {HF_API_KEY}'} if HF_API_KEY else {}
+    async with _probe_session.get(f'{HF_HUB_MODELS_API}/{model}', params={'expand[]': 'inference'},
+                                  headers=headers) as response:
+        return response.status == 200
+
+
+probe_failures: Counter = Counter()  # backend name or 'embed' -> consecutive failed probes
+
+
+async def _probe_up(name: str, probe: Callable[[], Awaitable[bool]]) -> bool:
+    """Run one probe; a dependency is only down after HEALTH_PROBE_FAILURES failures in a row."""
+    try:
+        ok = await probe()
+    except Exception:
+        ok = False
+    if ok:
+        probe_failures.pop(name, None)
+        return True
+    probe_failures[name] += 1
+    incr_metric(f'health.probe_failures.{name}')
+    return probe_failures[name] < HEALTH_PROBE_FAILURES
+
+
+async def run_health_probes():
+    """Probe every configured backend once and update hf_available/embedding_available.
+
+    Probes only catch outages: a failed request to a backend is handled by its circuit breaker,
+    so a probe that fails now and then (or can't tell) leaves the backend up.
+    """
+    global hf_available, embedding_available
+    chat_ok = False
+    for backend in backend_chain():
+        if await _probe_up(backend.name, backend.probe):
+            chat_ok = True
+            if backend.name not in probe_failures:
+                backend.failed_until = 0.0
+        else:
+            backend.failed_until = max(backend.failed_until, time.time() + HEALTH_PROBE_INTERVAL)
+    embed_ok = hf_client is not None and await _probe_up('embed', lambda: hf_model_ready(HF_EMBED_MODEL))
+    
+    if chat_ok != hf_available:
+        print(f"Chat backends {'recovered' if chat_ok else 'unavailable'}")
+    if embed_ok != embedding_available:
+        print(f"Embedding model {HF_EMBED_MODEL} {'recovered' if embed_ok else 'unavailable'}")
+    hf_available, embedding_available = chat_ok, embed_ok
+
+
+async def health_probe_loop():
+    """Background task that re-probes the backends every HEALTH_PROBE_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+        try:
+            await run_health_probes()
+        except Exception as e:
+            print(f'Health probe error: {e}')
+
+
+async def readiness_loop():
+    """Full backend check once per process, then periodic cheap probes."""
+    await check_hf_api()
+    await health_probe_loop()
+
+
+# Model cascade
+CASCADE_KEYWORDS = ('explain', 'why', 'how do', 'how does', 'how to', 'compare', 'difference', 'step',
+                    'code', 'error', 'debug', 'write', 'analy', 'summar', 'design', 'calculate', 'prove')
+SMALLTALK = ('hi', 'hey', 'hello', 'thanks', 'thank you', 'thx', 'lol', 'ok', 'okay', 'gm', 'gn',
+             'good morning', 'good night', 'bye', 'nice', 'cool')
+WEAK_ANSWER_MARKERS = ("i'm not sure", "i am not sure", "i don't know", "i do not know", "i can't help",
+                       "i cannot help", "as an ai")
+
+
+def route_query(query: str, has_context: bool) -> Tuple[str, float, str]:
+    """Pick the model tier for a message: ('small' | 'large', complexity score, reason)."""
+    if not SMALL_MODEL:
+        return 'large', 1.0, 'no_small_model'
+    if has_context:
+        return 'large', 1.0, 'context'
+    text = query.lower().strip()
+    if text.rstrip('!.?') in SMALLTALK:
+        return 'small', 0.0, 'smalltalk'
+    score = min(len(text.split()) / 60, 0.5)
+    if '```' in query or re.search(r'\b(def|class|import|function|select|traceback)\b', text):
+        score += 0.3
+    score += min(sum(0.2 for k in CASCADE_KEYWORDS if k in text), 0.4)
+    if text.count('?') > 1:
+        score += 0.1
+    score = round(min(score, 1.0), 3)
+    if score >= CASCADE_THRESHOLD:
+        return 'large', score, 'complex'
+    return 'small', score, 'simple'
+
+
+def is_weak_answer(content: str) -> bool:
+    """Empty, failed or hedging answers that are worth retrying on the larger model."""
+    text = content.strip().lower()
+    return len(text) < 2 or any(m in text[:200] for m in WEAK_ANSWER_MARKERS)
+
+
+def _write_routing_log(record: Dict[str, Any]):
+    """Append one routing decision to ROUTING_LOG_PATH (runs in an executor)."""
+    with open(ROUTING_LOG_PATH, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@traced()
+async def cascade_chat(messages: list, query: str, has_context: bool, max_tokens: int = 1000,
+                       backend: Optional[str] = None, guild_id: str = '') -> str:
+    """Answer with the tier route_query() picks, escalating weak small-model answers if enabled."""
+    if not hf_available:
+        return "AI is not configured. Please set HF_API_KEY or LLM_BACKENDS."
+    
+    tier, score, reason = route_query(query, has_context)
+    record: Dict[str, Any] = {'ts': time.time(), 'guild_id': guild_id, 'tier': tier, 'score': score,
+                              'reason': reason, 'escalated': False, 'attempts': []}
+    content = ''
+    error: Optional[Exception] = None
+    for attempt_tier in (tier, 'large') if tier == 'small' else (tier,):
+        if attempt_tier == 'large' and record['attempts']:
+            if error is not None:
+                incr_metric('cascade.fallback')  # the small model failed outright
+            elif not CASCADE_ESCALATE or not is_weak_answer(content):
+                break
+            else:
+                record['escalated'] = True
+                incr_metric('cascade.escalated')
+        small = attempt_tier == 'small'
+        attempt: Dict[str, Any] = {'tier': attempt_tier, 'model': SMALL_MODEL if small else HF_MODEL}
+        start = time.perf_counter()
+        try:
+            result = await llm_chat(messages, SMALL_MODEL if small else None,
+                                    min(max_tokens, SMALL_MAX_TOKENS) if small else max_tokens, backend=backend)
+        except Exception as e:
+            print(f'Chat error ({attempt_tier} tier): {e}')
+            error = e
+            record['attempts'].append({**attempt, 'error': str(e),
+                                       'latency_ms': round((time.perf_counter() - start) * 1000, 1)})
+            continue
+        error = None
+        content = result['content']
+        record['attempts'].append({
+            **attempt, 'backend': result['backend'],
+            'latency_ms': round((time.perf_counter() - start) * 1000, 1),
+            'prompt_tokens': result['prompt_tokens'], 'completion_tokens': result['completion_tokens'],
+        })
+    if error is not None and not content:
+        return f"Error: {str(error)}"
+    
+    answered = [a for a in record['attempts'] if 'error' not in a]
+    final_tier = answered[-1]['tier'] if answered else tier
+    incr_metric(f'cascade.{final_tier}')
+    span = _current_span.get()
+    if span is not None and span.get('sampled'):
+        span['attributes'].update({'cascade.tier': tier, 'cascade.score': score, 'cascade.reason': reason,
+                                   'cascade.escalated': record['escalated']})
+    if ROUTING_LOG_PATH:
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write_routing_log, record)
+        except Exception as e:
+            print(f'Routing log error: {e}')
+    return content or 'No response generated.'
+
+
+@traced()
+async def hf_chat(messages: list, model: Optional[str] = None, max_tokens: int = 1000,
+                  temperature: float = 0.7, backend: Optional[str] = None) -> str:
+    """Send a chat request through the configured backends (see llm_chat) and return the reply text."""
+    if not hf_available:
+        return "AI is not configured. Please set HF_API_KEY or LLM_BACKENDS."
+    
+    try:
+        result = await llm_chat(messages, model, max_tokens, temperature, backend)
+        return result['content'] or 'No response generated.'
     except Exception as e:
-        print(f'Hugging Face error: {e}')
+        print(f'Chat error: {e}')
         return f"Error: {str(e)}"
 
 
-async def hf_embed(text: str) -> Optional[List[float]]:
-    """Generate embeddings using Hugging Face official SDK."""
+@traced()
+async def hf_embed(text: str) -> Optional['np.ndarray']:
+    """Generate an embedding (float32 vector) using Hugging Face official SDK."""
     if not embedding_available or not hf_client:
         return None
     
     try:
         loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(
-            None,
-            lambda: _sync_embed(text)
-        )
+        data = await hedged('embed', lambda: guarded(
+            'embed', lambda: loop.run_in_executor(embed_executor, lambda: _sync_embed(text)), EMBED_TIMEOUT))
+        if data is None:
+            return None
+        vector = np.asarray(data, dtype=np.float32)
+        # Some endpoints return a batch of one
+        if vector.ndim == 2:
+            vector = vector[0]
+        return vector if vector.ndim == 1 and vector.size else None
+    except CircuitOpen:
+        return None
+    except Exception as e:
+        print(f'Embedding error: {e!r}')
+        return None
+
+
+def _sync_embed_batch(texts: List[str]) -> Any:
+    """Synchronous wrapper for embedding several texts in one request."""
+    assert hf_client is not None
+    return hf_client.feature_extraction(
+        text=texts,  # type: ignore[arg-type]
+        model=HF_EMBED_MODEL
+    )
+
+
+async def hf_embed_batch(texts: List[str]) -> List[Optional['np.ndarray']]:
+    """Embed texts EMBED_BATCH_SIZE per request, falling back to one request per text.
+
+    Texts not embedded (breaker open, errors) come back as None for the backfill to retry.
+    """
+    if not embedding_available or not hf_client or not texts:
+        return [None] * len(texts)
+    
+    loop = asyncio.get_event_loop()
+    embeddings: List[Optional['np.ndarray']] = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[i:i + EMBED_BATCH_SIZE]
+        try:
+            data = await guarded('embed', lambda: loop.run_in_executor(embed_executor, lambda: _sync_embed_batch(batch)),
+                                 EMBED_TIMEOUT, endpoint='embed.batch')
+            matrix = np.asarray(data, dtype=np.float32)
+            if matrix.ndim == 2 and len(matrix) == len(batch) and matrix.shape[1]:
+                embeddings.extend(matrix)
+                continue
+        except CircuitOpen:
+            pass
+        except Exception as e:
+            print(f'Batch embedding error: {e!r}')
+        
+        if breaker_open('embed'):
+            return embeddings + [None] * (len(texts) - len(embeddings))
+        # Endpoint doesn't accept batched inputs for this model
+        embeddings.extend([await hf_embed(text) for text in batch])
+    return embeddings
+
+
+# Local vector index
+# Each guild's chunks are kept on disk under LOCAL_INDEX_DIR/<guild_id>/ as vectors.npy
+# (memory-mapped on load), chunks.json and, for large guilds with hnswlib installed, an HNSW
+# graph in hnsw.bin. Inserts and deletes made by this process are applied incrementally; a
+# periodic reconcile against the database picks up everything else (dashboard edits, other
+# processes, the embedding backfill).
+def parse_embedding(value: Any) -> Optional['np.ndarray']:
+    """Embedding column value (list, or pgvector text from PostgREST) as a unit float32 vector."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    vector = np.asarray(value, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+class GuildVectorIndex:
+    """In-process nearest-neighbour index over one guild's knowledge chunk embeddings."""
+
+    def __init__(self, guild_id: str, vectors: 'np.ndarray', chunks: List[Dict[str, Any]], hnsw: Any = None):
+        self.guild_id = guild_id
+        self.vectors = vectors  # (n, dim) unit float32; a read-only memmap until first modified
+        self.chunks = chunks  # id, source_id, title, content for each row of vectors
+        self.alive = np.ones(len(chunks), dtype=bool)
+        self.positions = {chunk['id']: i for i, chunk in enumerate(chunks)}
+        self.hnsw = hnsw
+        self.dirty = False
+        self.compact_needed = False
+        self.version = 0  # bumped by every add/remove, so a snapshot can tell if it is still current
+        # While a save writes the HNSW graph from an executor thread, graph updates wait here
+        # (rows added, rows deleted) and searches scan the added rows exactly
+        self.saves_running = 0
+        self.hnsw_added: List[int] = []
+        self.hnsw_deleted: List[int] = []
+
+    @property
+    def size(self) -> int:
+        return int(self.alive.sum())
+
+    @classmethod
+    def build(cls, guild_id: str, rows: List[Dict[str, Any]]) -> 'GuildVectorIndex':
+        """Build from chunk rows that include an `embedding`."""
+        chunks: List[Dict[str, Any]] = []
+        vectors: List[np.ndarray] = []
+        for row in rows:
+            vector = parse_embedding(row.get('embedding'))
+            if vector is not None:
+                vectors.append(vector)
+                chunks.append({k: row.get(k) for k in ('id', 'source_id', 'title', 'content')})
+        matrix = np.vstack(vectors) if vectors else np.zeros((0, EMBED_DIMENSIONS), dtype=np.float32)
+        index = cls(guild_id, matrix, chunks)
+        index.hnsw = index._build_hnsw()
+        index.dirty = True
+        return index
+
+    def _build_hnsw(self) -> Any:
+        return build_hnsw(self.vectors)
+
+    @classmethod
+    def load(cls, guild_id: str) -> Optional['GuildVectorIndex']:
+        """Load a persisted index, or None if it is missing or inconsistent."""
+        path = os.path.join(LOCAL_INDEX_DIR, guild_id)
+        try:
+            with open(os.path.join(path, 'chunks.json'), encoding='utf-8') as f:
+                chunks = json.load(f)
+            vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if len(vectors) != len(chunks):
+            return None
+        
+        hnsw = None
+        hnsw_path = os.path.join(path, 'hnsw.bin')
+        if hnswlib_available and os.path.exists(hnsw_path):
+            hnsw = hnswlib.Index(space='cosine', dim=vectors.shape[1])
+            hnsw.load_index(hnsw_path, max_elements=max(len(chunks) * 2, 1024))
+            if hnsw.get_current_count() != len(chunks):
+                hnsw = None
+            else:
+                hnsw.set_ef(64)
+        index = cls(guild_id, vectors, chunks, hnsw)
+        if index.hnsw is None:
+            index.hnsw = index._build_hnsw()
+        return index
+
+    def snapshot(self) -> Dict[str, Any]:
+        """A copy that save_snapshot() can use off the event loop while the index keeps changing.
+
+        Call on the event loop, then finish_save() once the save is done. vectors is replaced
+        (never modified in place) by add(), so only `alive` and the chunk list are copied. The
+        HNSW graph is shared as is, unless compaction rebuilds it: it is frozen until finish_save().
+        """
+        share_hnsw = self.hnsw is not None and not self.compact_needed
+        if share_hnsw:
+            self.saves_running += 1
+        return {
+            'guild_id': self.guild_id, 'version': self.version, 'vectors': self.vectors,
+            'chunks': list(self.chunks), 'alive': self.alive.copy(), 'compact': self.compact_needed,
+            'hnsw': self.hnsw if share_hnsw else None,
+        }
+
+    def finish_save(self, snapshot: Dict[str, Any]):
+        """Unfreeze the HNSW graph shared by snapshot() and apply the updates held back meanwhile."""
+        if snapshot['hnsw'] is None:
+            return
+        self.saves_running -= 1
+        if self.saves_running or self.hnsw is None:
+            return
+        if self.hnsw_added:
+            added = np.asarray(self.hnsw_added)
+            if self.hnsw.get_max_elements() < len(self.chunks):
+                self.hnsw.resize_index(len(self.chunks) * 2)
+            self.hnsw.add_items(np.asarray(self.vectors)[added], added)
+        for position in self.hnsw_deleted:
+            self.hnsw.mark_deleted(position)
+        self.hnsw_added, self.hnsw_deleted = [], []
+
+    @staticmethod
+    def save_snapshot(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        """Persist a snapshot to disk, dropping deleted rows. Blocking; run in an executor.
+
+        Returns what was written (vectors, chunks, hnsw), for apply_saved() to swap in.
+        """
+        vectors, chunks, hnsw = np.asarray(snapshot['vectors']), snapshot['chunks'], None
+        if snapshot['compact']:
+            keep = np.flatnonzero(snapshot['alive'])
+            vectors = vectors[keep]
+            chunks = [chunks[i] for i in keep]
+            hnsw = build_hnsw(vectors)
+        elif snapshot['hnsw'] is not None:
+            hnsw = snapshot['hnsw']  # frozen until finish_save(); searches only read it
+        
+        path = os.path.join(LOCAL_INDEX_DIR, snapshot['guild_id'])
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vectors.npy.tmp.npy'), vectors)
+        os.replace(os.path.join(path, 'vectors.npy.tmp.npy'), os.path.join(path, 'vectors.npy'))
+        hnsw_path = os.path.join(path, 'hnsw.bin')
+        if hnsw is not None:
+            hnsw.save_index(hnsw_path + '.tmp')
+            os.replace(hnsw_path + '.tmp', hnsw_path)
+        elif os.path.exists(hnsw_path):
+            os.remove(hnsw_path)
+        # Written last: load() rejects a chunks.json that doesn't match vectors.npy
+        with open(os.path.join(path, 'chunks.json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(chunks, f)
+        os.replace(os.path.join(path, 'chunks.json.tmp'), os.path.join(path, 'chunks.json'))
+        return {'version': snapshot['version'], 'compacted': snapshot['compact'], 'vectors': vectors,
+                'chunks': chunks, 'hnsw': hnsw}
+
+    def apply_saved(self, saved: Dict[str, Any]):
+        """Swap in a compacted copy written by save_snapshot(), on the event loop.
+
+        If the index changed while it was being written, the copy is stale: the index stays
+        dirty (and uncompacted) and is saved again next time. So is a compacted copy while another
+        save still holds the graph, since the updates it holds back use the old row positions.
+        """
+        if saved['version'] != self.version or (saved['compacted'] and self.saves_running):
+            return
+        if saved['compacted']:
+            self.vectors, self.chunks, self.hnsw = saved['vectors'], saved['chunks'], saved['hnsw']
+            self.alive = np.ones(len(self.chunks), dtype=bool)
+            self.positions = {chunk['id']: i for i, chunk in enumerate(self.chunks)}
+            self.compact_needed = False
+        self.dirty = False
+
+    def add(self, rows: List[Dict[str, Any]]) -> int:
+        """Add (or replace) chunks from rows that include an `embedding`. Returns the number added."""
+        new_vectors: List[np.ndarray] = []
+        for row in rows:
+            vector = parse_embedding(row.get('embedding'))
+            if vector is None:
+                continue
+            self.remove([row['id']])
+            self.positions[row['id']] = len(self.chunks)
+            self.chunks.append({k: row.get(k) for k in ('id', 'source_id', 'title', 'content')})
+            new_vectors.append(vector)
+        if not new_vectors:
+            return 0
         
-        # Handle numpy array return format
-        if data is not None:
-            # Convert numpy array to list
-            if hasattr(data, 'tolist'):
-                result = data.tolist()
-                # If it's already a flat list, return it
-                if isinstance(result, list) and len(result) > 0:
-                    if not isinstance(result[0], list):
-                        return result
-                    # If nested, take first element
-                    return result[0]
-            # If it's already a list
-            if isinstance(data, list):
-                return data
+        self.version += 1
+        start = len(self.vectors)
+        added = np.vstack(new_vectors)
+        self.vectors = np.vstack([np.asarray(self.vectors), added])
+        self.alive = np.concatenate([self.alive, np.ones(len(added), dtype=bool)])
+        if self.hnsw is not None and self.saves_running:
+            self.hnsw_added.extend(range(start, start + len(added)))
+        elif self.hnsw is not None:
+            if self.hnsw.get_max_elements() < len(self.chunks):
+                self.hnsw.resize_index(len(self.chunks) * 2)
+            self.hnsw.add_items(added, np.arange(start, start + len(added)))
+        elif hnswlib_available and len(self.chunks) >= LOCAL_INDEX_HNSW_MIN:
+            self.hnsw = self._build_hnsw()
+        self.dirty = True
+        return len(added)
+
+    def remove(self, chunk_ids: List[str]) -> int:
+        """Remove chunks by ID. Returns the number removed."""
+        removed = 0
+        for chunk_id in chunk_ids:
+            position = self.positions.pop(chunk_id, None)
+            if position is None:
+                continue
+            self.alive[position] = False
+            if self.hnsw is not None and self.saves_running:
+                self.hnsw_deleted.append(position)
+            elif self.hnsw is not None:
+                self.hnsw.mark_deleted(position)
+            removed += 1
+        if removed:
+            self.dirty = self.compact_needed = True
+            self.version += 1
+        return removed
+
+    def remove_sources(self, source_ids: List[str]) -> int:
+        """Remove every chunk belonging to the given knowledge_sources rows."""
+        doomed = set(source_ids)
+        return self.remove([c['id'] for i, c in enumerate(self.chunks) if self.alive[i] and c.get('source_id') in doomed])
+
+    def search(self, query: List[float], match_count: int, threshold: float) -> List[Dict[str, Any]]:
+        """Same result shape as the search_documents RPC."""
+        vector = parse_embedding(query)
+        alive = self.size
+        if vector is None or alive == 0:
+            return []
+        k = min(match_count, alive)
+        hits: List[Tuple[int, float]] = []
+        if self.hnsw is not None:
+            with contextlib.suppress(RuntimeError):  # too few live neighbours reachable; scan instead
+                labels, distances = self.hnsw.knn_query(vector, k=k)
+                hits = [(int(label), 1.0 - float(distance)) for label, distance in zip(labels[0], distances[0])]
+            if self.hnsw_added or self.hnsw_deleted:
+                # Graph frozen by a running save: drop rows deleted since, scan rows added since
+                added = np.asarray([i for i in self.hnsw_added if self.alive[i]], dtype=np.int64)
+                scores = np.asarray(self.vectors)[added] @ vector
+                hits = sorted([hit for hit in hits if self.alive[hit[0]]] +
+                              [(int(i), float(score)) for i, score in zip(added, scores)],
+                              key=lambda hit: -hit[1])[:k]
+        if not hits:
+            scores = np.asarray(self.vectors) @ vector
+            scores[~self.alive] = -np.inf
+            top = np.argpartition(-scores, k - 1)[:k]
+            hits = [(int(i), float(scores[i])) for i in top[np.argsort(-scores[top])]]
+        return [
+            {'id': self.chunks[i]['id'], 'title': self.chunks[i]['title'], 'content': self.chunks[i]['content'], 'similarity': score}
+            for i, score in hits if score > threshold
+        ]
+
+
+def build_hnsw(vectors: 'np.ndarray') -> Any:
+    """HNSW graph over unit vectors labelled by row, or None below LOCAL_INDEX_HNSW_MIN rows."""
+    if not hnswlib_available or len(vectors) < LOCAL_INDEX_HNSW_MIN:
+        return None
+    graph = hnswlib.Index(space='cosine', dim=vectors.shape[1])
+    graph.init_index(max_elements=max(len(vectors) * 2, 1024), ef_construction=200, M=16)
+    graph.add_items(np.asarray(vectors), np.arange(len(vectors)))
+    graph.set_ef(64)
+    return graph
+
+
+async def save_local_index(index: GuildVectorIndex):
+    """Persist an index without blocking the loop or racing searches and updates on it."""
+    snapshot = index.snapshot()
+    try:
+        saved = await asyncio.get_event_loop().run_in_executor(None, GuildVectorIndex.save_snapshot, snapshot)
+    finally:
+        index.finish_save(snapshot)
+    index.apply_saved(saved)
+
+
+local_indexes: 'OrderedDict[str, GuildVectorIndex]' = OrderedDict()
+local_index_builds: Dict[str, asyncio.Task] = {}
+
+
+async def fetch_knowledge_chunks(guild_id: str, chunk_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Fetch embedded chunks (with embeddings) for a guild, or only `chunk_ids`, in pages."""
+    rows: List[Dict[str, Any]] = []
+    page_size = 1000  # PostgREST's default max rows per response
+    if chunk_ids is not None:
+        for i in range(0, len(chunk_ids), 200):
+            query = supabase.table('knowledge_documents').select('id, source_id, title, content, embedding').in_('id', chunk_ids[i:i + 200])
+            result = await db_call(query.execute, endpoint='supabase.index_pages')
+            rows.extend(dict(row) for row in result.data or [])  # type: ignore
+        return rows
+    offset = 0
+    while True:
+        query = supabase.table('knowledge_documents').select('id, source_id, title, content, embedding').eq('guild_id', guild_id).not_.is_('embedding', 'null')
+        result = await db_call(query.order('id').range(offset, offset + page_size - 1).execute, endpoint='supabase.index_pages')
+        page = [dict(row) for row in result.data or []]  # type: ignore
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        offset += page_size
+
+
+async def fetch_embedded_chunk_ids(guild_id: str) -> List[str]:
+    """IDs of a guild's embedded chunks, without the embeddings."""
+    ids: List[str] = []
+    page_size = 1000
+    offset = 0
+    while True:
+        query = supabase.table('knowledge_documents').select('id').eq('guild_id', guild_id).not_.is_('embedding', 'null')
+        result = await db_call(query.order('id').range(offset, offset + page_size - 1).execute, endpoint='supabase.index_pages')
+        page = [str(dict(row)['id']) for row in result.data or []]  # type: ignore
+        ids.extend(page)
+        if len(page) < page_size:
+            return ids
+        offset += page_size
+
+
+async def _store_local_index(index: GuildVectorIndex):
+    """Add a loaded index to the LRU, persisting and evicting the least recently used beyond the limit."""
+    local_indexes[index.guild_id] = index
+    local_indexes.move_to_end(index.guild_id)
+    while len(local_indexes) > LOCAL_INDEX_MAX_GUILDS:
+        _, evicted = local_indexes.popitem(last=False)
+        if evicted.dirty:
+            await save_local_index(evicted)
+        incr_metric('local_index.evictions')
+
+
+async def _load_local_index(guild_id: str):
+    """Load a guild's index from disk (then reconcile it) or build it from the database."""
+    loop = asyncio.get_event_loop()
+    try:
+        index = await loop.run_in_executor(None, GuildVectorIndex.load, guild_id)
+        if index is not None:
+            await _store_local_index(index)
+            await reconcile_local_index(guild_id)
+            return
+        rows = await fetch_knowledge_chunks(guild_id)
+        index = await loop.run_in_executor(None, GuildVectorIndex.build, guild_id, rows)
+        await save_local_index(index)
+        await _store_local_index(index)
+        print(f'Built local vector index for guild {guild_id}: {index.size} chunk(s)')
+    except Exception as e:
+        print(f'Error loading local vector index for guild {guild_id}: {e}')
+    finally:
+        local_index_builds.pop(guild_id, None)
+
+
+def get_local_index(guild_id: str) -> Optional[GuildVectorIndex]:
+    """Return the guild's loaded index, or None while it is loaded in the background."""
+    index = local_indexes.get(guild_id)
+    if index is not None:
+        local_indexes.move_to_end(guild_id)
+        return index
+    if guild_id not in local_index_builds:
+        local_index_builds[guild_id] = asyncio.create_task(_load_local_index(guild_id))
+    return None
+
+
+def local_index_add(guild_id: str, rows: List[Dict[str, Any]]):
+    """Apply newly inserted chunks to the guild's index if it is loaded."""
+    index = local_indexes.get(guild_id)
+    if index is not None:
+        index.add(rows)
+
+
+def local_index_remove_sources(guild_id: str, source_ids: List[str]):
+    """Drop deleted documents' chunks from the guild's index if it is loaded."""
+    index = local_indexes.get(guild_id)
+    if index is not None:
+        index.remove_sources(source_ids)
+
+
+def drop_local_index(guild_id: str):
+    """Forget a guild's index (e.g. after a reindex); it is rebuilt on next use."""
+    local_indexes.pop(guild_id, None)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(LOCAL_INDEX_DIR, guild_id, 'chunks.json'))
+
+
+async def reconcile_local_index(guild_id: str):
+    """Bring a loaded index in line with the database: add missing chunks, drop deleted ones."""
+    index = local_indexes.get(guild_id)
+    if index is None:
+        return
+    db_ids = set(await fetch_embedded_chunk_ids(guild_id))
+    local_ids = set(index.positions)
+    missing = list(db_ids - local_ids)
+    stale = list(local_ids - db_ids)
+    if missing:
+        index.add(await fetch_knowledge_chunks(guild_id, missing))
+    if stale:
+        index.remove(stale)
+    if missing or stale:
+        incr_metric('local_index.reconciled_chunks', len(missing) + len(stale))
+    if index.dirty:
+        await save_local_index(index)
+
+
+async def local_index_reconcile_loop():
+    """Background task that periodically reconciles every loaded guild index."""
+    while True:
+        await asyncio.sleep(LOCAL_INDEX_RECONCILE_INTERVAL)
+        for guild_id in list(local_indexes):
+            try:
+                await reconcile_local_index(guild_id)
+            except Exception as e:
+                print(f'Error reconciling local vector index for guild {guild_id}: {e}')
+
+
+# Cross-encoder re-ranking
+# Scores (query, passage) pairs jointly, which ranks far better than embedding cosine alone.
+# Each query's candidates go through the model as one batch on a dedicated thread, so the
+# event loop never waits on it for longer than RERANK_TIMEOUT.
+reranker: Optional[Any] = None
+rerank_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rerank')
+rerank_pending = 0
+
+
+def _load_cross_encoder(model_name: str) -> Any:
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, device='cpu')
+
+
+async def load_reranker():
+    """Load RERANK_MODEL in the background; searches skip re-ranking until it is ready."""
+    global reranker
+    try:
+        loop = asyncio.get_event_loop()
+        reranker = await loop.run_in_executor(rerank_executor, _load_cross_encoder, RERANK_MODEL)
+        print(f'Re-ranker loaded: {RERANK_MODEL}')
+    except ImportError:
+        print('sentence-transformers not installed. Re-ranking will be disabled.')
+    except Exception as e:
+        print(f'Error loading re-ranker {RERANK_MODEL}: {e}')
+
+
+def _rerank_done(_future: Any):
+    global rerank_pending
+    rerank_pending -= 1
+
+
+async def rerank_passages(query: str, docs: List[Dict[str, Any]], top_n: int) -> Optional[List[Dict[str, Any]]]:
+    """Re-order `docs` by cross-encoder score and return the best `top_n`.
+
+    Returns None when the model isn't loaded, the re-rank thread is backed up, or scoring
+    doesn't finish within RERANK_TIMEOUT; callers then keep the vector-search order.
+    """
+    global rerank_pending
+    if reranker is None or not docs:
         return None
+    if rerank_pending >= RERANK_MAX_PENDING:
+        incr_metric('rag.rerank_skipped')
+        return None
+    
+    pairs = [(query, str(doc.get('content', ''))) for doc in docs]
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    rerank_pending += 1
+    future = loop.run_in_executor(
+        rerank_executor,
+        functools.partial(reranker.predict, pairs, batch_size=len(pairs), show_progress_bar=False)
+    )
+    future.add_done_callback(_rerank_done)
+    try:
+        with trace_span('rerank', candidates=len(pairs)):
+            # shield: a timed-out batch keeps running on the thread; only this query stops waiting
+            scores = await asyncio.wait_for(asyncio.shield(future), RERANK_TIMEOUT)
+    except asyncio.TimeoutError:
+        incr_metric('rag.rerank_timeouts')
+        return None
+    except Exception as e:
+        print(f'Re-rank error: {e}')
+        return None
+    
+    incr_metric('rag.reranked')
+    incr_metric('rag.rerank_ms', int((time.monotonic() - start) * 1000))
+    for doc, score in zip(docs, scores):
+        doc['rerank_score'] = float(score)
+    return sorted(docs, key=lambda d: d['rerank_score'], reverse=True)[:top_n]
+
+
+# Semantic answer cache
+class AnswerCache:
+    """Recent (question embedding, answer) pairs for one guild, searched exactly with NumPy."""
+    
+    def __init__(self, instructions: str, capacity: int = ANSWER_CACHE_SIZE):
+        self.instructions = instructions  # answers are only valid for the instructions they were made with
+        self.vectors = np.zeros((capacity, EMBED_DIMENSIONS), dtype=np.float32)
+        self.answers: List[str] = [''] * capacity
+        self.generation_ms = np.zeros(capacity, dtype=np.float32)
+        self.created = np.zeros(capacity)
+        self.last_used = np.zeros(capacity)
+        self.size = 0
+    
+    def lookup(self, embedding: 'np.ndarray', now: float) -> Optional[Tuple[str, float]]:
+        """Return (answer, generation ms saved) for the closest fresh entry above the threshold."""
+        if not self.size:
+            return None
+        scores = self.vectors[:self.size] @ embedding
+        scores[self.created[:self.size] < now - ANSWER_CACHE_TTL] = -1.0
+        best = int(np.argmax(scores))
+        if scores[best] < ANSWER_CACHE_THRESHOLD:
+            return None
+        self.last_used[best] = now
+        return self.answers[best], float(self.generation_ms[best])
+    
+    def add(self, embedding: 'np.ndarray', answer: str, generation_ms: float, now: float):
+        if self.size < len(self.answers):
+            slot = self.size
+            self.size += 1
+        else:
+            # Expired entries first (their last use is older), then the least recently used
+            slot = int(np.argmin(np.where(self.created < now - ANSWER_CACHE_TTL, 0, self.last_used)))
+        self.vectors[slot] = embedding
+        self.answers[slot] = answer
+        self.generation_ms[slot] = generation_ms
+        self.created[slot] = self.last_used[slot] = now
+
+
+answer_caches: 'OrderedDict[str, AnswerCache]' = OrderedDict()
+
+
+def _normalized(embedding: 'np.ndarray') -> Optional['np.ndarray']:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm and vector.shape == (EMBED_DIMENSIONS,) else None
+
+
+def answer_cache_lookup(guild_id: str, instructions: str, embedding: 'np.ndarray') -> Optional[str]:
+    """Return a cached answer to a similar earlier question in this guild, if any."""
+    incr_metric('answer_cache.lookups')
+    cache = answer_caches.get(guild_id)
+    vector = _normalized(embedding)
+    if cache is None or vector is None:
+        return None
+    if cache.instructions != instructions:
+        answer_caches.pop(guild_id, None)
+        return None
+    answer_caches.move_to_end(guild_id)
+    hit = cache.lookup(vector, time.time())
+    if hit is None:
+        return None
+    answer, generation_ms = hit
+    incr_metric('answer_cache.hits')
+    incr_metric('answer_cache.saved_ms', int(generation_ms))
+    return answer
+
+
+def answer_cache_store(guild_id: str, instructions: str, embedding: 'np.ndarray', answer: str, generation_ms: float):
+    """Remember an answer for later similar questions in this guild."""
+    vector = _normalized(embedding)
+    if vector is None:
+        return
+    cache = answer_caches.get(guild_id)
+    if cache is None or cache.instructions != instructions:
+        cache = answer_caches[guild_id] = AnswerCache(instructions)
+        while len(answer_caches) > ANSWER_CACHE_MAX_GUILDS:
+            answer_caches.popitem(last=False)
+    answer_caches.move_to_end(guild_id)
+    cache.add(vector, answer, generation_ms, time.time())
+
+
+def invalidate_answer_cache(guild_id: str):
+    """Forget a guild's cached answers (knowledge base or configuration changed)."""
+    if answer_caches.pop(guild_id, None) is not None:
+        incr_metric('answer_cache.invalidations')
+
+
+def knowledge_candidate_count() -> int:
+    """Vector-search hits fetched per query; more when the cross-encoder re-ranks them."""
+    return RERANK_CANDIDATES if reranker is not None else 8
+
+
+@traced()
+async def search_knowledge_base(guild_id: str, query: str, match_count: int = 3,
+                                query_embedding: Optional['np.ndarray'] = None) -> List[Dict[str, Any]]:
+    """Search knowledge base for relevant documents using semantic search (per-guild).
+
+    Pass `query_embedding` when the caller has already embedded `query`.
+    """
+    if not supabase or not embedding_available:
+        return []
+
+    # Generate embedding for the query
+    if query_embedding is None:
+        query_embedding = await hf_embed(query)
+    if query_embedding is None:
+        return []
+
+    try:
+        # 1. Lower threshold, increase matches
+        params: Dict[str, Any] = {
+            'p_guild_id': guild_id,
+            'query_embedding': query_embedding,
+            'match_threshold': KNOWLEDGE_MATCH_THRESHOLD,
+            'match_count': knowledge_candidate_count()
+        }
+        local_index = get_local_index(guild_id) if LOCAL_VECTOR_INDEX else None
+        if local_index is not None:
+            # Hot guild: answered in-process, no database round trip
+            with trace_span('local_index.search', chunks=local_index.size):
+                result_data: Any = local_index.search(query_embedding, params['match_count'], params['match_threshold'])
+            incr_metric('rag.local_index_searches')
+        else:
+            rpc_name = EMBEDDING_INDEXES[EMBEDDING_INDEX][0]
+            result_data = None
+            if direct_db():
+                try:
+                    with trace_span('postgres.query', db_function=rpc_name):
+                        result_data = await guarded('supabase', lambda: db_search_documents(
+                            rpc_name, guild_id, query_embedding, params['match_threshold'], params['match_count']
+                        ), DB_TIMEOUT)
+                except Exception as e:
+                    print(f'Direct {rpc_name} failed, using PostgREST: {e}')
+                    incr_metric('db.direct_errors')
+            if result_data is None:
+                params['query_embedding'] = query_embedding.tolist()
+                try:
+                    with trace_span('supabase.rpc', db_function=rpc_name):
+                        if EMBEDDING_INDEX == 'vector':
+                            result = await db_call(supabase.rpc(rpc_name, params).execute)
+                        else:
+                            result = await db_call(supabase.rpc(rpc_name, {**params, 'p_candidates': EMBEDDING_CANDIDATES}).execute)
+                except Exception as e:
+                    if EMBEDDING_INDEX == 'vector' or isinstance(e, (CircuitOpen, asyncio.TimeoutError)):
+                        raise
+                    # Quantized search functions missing (older schema or pgvector); use the float32 search
+                    print(f'{rpc_name} failed, falling back to search_documents: {e}')
+                    with trace_span('supabase.rpc', db_function='search_documents'):
+                        result = await db_call(supabase.rpc('search_documents', params).execute)
+                result_data = result.data
+            incr_metric('rag.db_searches')
+        return await rank_knowledge_results(query, result_data, match_count)
+    except Exception as e:
+        print(f'Knowledge search error: {e}')
+    return []
+
+
+async def rank_knowledge_results(query: str, result_data: Any, match_count: int) -> List[Dict[str, Any]]:
+    """Re-rank vector-search rows for `query` and attach the best-matching snippet to the top 5."""
+    # Convert all keys to str if bytes (Supabase may return bytes keys)
+    def decode_dict(d):
+        if isinstance(d, dict):
+            return {k.decode() if isinstance(k, bytes) else k: v for k, v in d.items()}
+        return d
+    docs = [decode_dict(row) for row in result_data if isinstance(row, dict)] if result_data and isinstance(result_data, list) else []
+    if not docs:
+        return []
+
+    # 5. Semantic re-ranking: vector similarity order, then the cross-encoder if enabled
+    docs = [d for d in docs if isinstance(d, dict)]
+    for doc in docs:
+        doc['semantic_score'] = doc.get('similarity', 0)
+    def safe_score(d):
+        try:
+            return float(d.get('semantic_score', 0))
+        except Exception:
+            return 0.0
+    docs.sort(key=safe_score, reverse=True)
+    reranked = await rerank_passages(query, docs, match_count)
+    if reranked is not None:
+        docs = reranked
+
+    # 6. Highlight matched content (find best matching sentence)
+    import re
+    def best_snippet(text, query):
+        # Find the sentence with the most query word overlap
+        sentences = re.split(r'(?<=[.!?])\s+', text)
+        query_words = set(re.findall(r'\w+', query.lower()))
+        best = ''
+        best_score = 0
+        for sent in sentences:
+            sent_words = set(re.findall(r'\w+', sent.lower()))
+            score = len(query_words & sent_words)
+            if score > best_score:
+                best = sent
+                best_score = score
+        return best.strip() if best else (sentences[0].strip() if sentences else text[:200])
+
+    # 7. Add source metadata and highlight
+    improved = []
+    for doc in docs[:5]:  # Return top 5
+        if not isinstance(doc, dict):
+            continue
+        content = doc.get('content', '')
+        snippet = best_snippet(content, query)
+        improved.append({
+            'title': doc.get('title', 'Untitled'),
+            'filename': doc.get('filename', ''),
+            'created_at': doc.get('created_at', ''),
+            'similarity': doc.get('similarity', 0),
+            'semantic_score': doc.get('semantic_score', 0),
+            'rerank_score': doc.get('rerank_score'),
+            'snippet': snippet,
+            'content': content,
+        })
+    return improved
+
+
+def ddgs_client() -> Any:
+    """New DuckDuckGo search client; the ddgs package is imported on the first search."""
+    global DDGS
+    if DDGS is None:
+        DDGS = ddgs.DDGS
+    return DDGS()
+
+
+def _sync_web_search(query: str, max_results: int) -> List[Dict[str, Any]]:
+    """Synchronous DuckDuckGo text search (runs in an executor)."""
+    with ddgs_client() as search:
+        return list(search.text(query, max_results=max_results))
+
+
+@traced()
+async def web_search(query: str, max_results: int = 5) -> List[Dict[str, str]]:
+    """Search the web using DuckDuckGo and return results."""
+    if not web_search_available:
+        return []
+    
+    try:
+        loop = asyncio.get_event_loop()
+        results = await hedged('search', lambda: guarded(
+            'search', lambda: loop.run_in_executor(None, _sync_web_search, query, max_results), SEARCH_TIMEOUT))
+        return [
+            {
+                'title': r.get('title', ''),
+                'url': r.get('href', ''),
+                'snippet': r.get('body', '')
+            }
+            for r in results
+        ]
+    except CircuitOpen:
+        return []
+    except Exception as e:
+        print(f'Web search error: {e!r}')
+        return []
+
+
+async def web_search_with_summary(query: str, max_results: int = 5) -> str:
+    """Search the web and return a formatted summary for the AI to use."""
+    results = await web_search(query, max_results)
+    
+    if not results:
+        return "No web search results found."
+    
+    summary_parts = [f"Web search results for '{query}':\n"]
+    for i, r in enumerate(results, 1):
+        summary_parts.append(f"{i}. **{r['title']}**")
+        summary_parts.append(f"   URL: {r['url']}")
+        summary_parts.append(f"   {r['snippet']}\n")
+    
+    return '\n'.join(summary_parts)
+
+
+@traced()
+async def add_document_to_knowledge_base(guild_id: str, title: str, content: str, filename: Optional[str] = None) -> bool:
+    """Add a document to the knowledge base with embedding (per-guild)."""
+    if not supabase:
+        return False
+    
+    # Remove null bytes (\u0000) from content
+    content = content.replace('\u0000', '').replace('\x00', '')
+
+    # Split content into chunks if too long (max ~500 tokens per chunk)
+    max_chunk_size = 2000  # characters
+    chunks = []
+
+    if len(content) > max_chunk_size:
+        # Simple chunking by paragraphs
+        paragraphs = content.split('\n\n')
+        current_chunk = ""
+
+        for para in paragraphs:
+            if len(current_chunk) + len(para) < max_chunk_size:
+                current_chunk += para + "\n\n"
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk.strip())
+                current_chunk = para + "\n\n"
+
+        if current_chunk:
+            chunks.append(current_chunk.strip())
+    else:
+        chunks = [content]
+    
+    docs: List[Dict[str, Any]] = [{
+        'guild_id': guild_id,
+        'title': f"{title}" if len(chunks) == 1 else f"{title} (Part {i+1})",
+        'filename': filename,
+        'content': chunk,
+        'chunk_index': i,
+        'metadata': {'total_chunks': len(chunks)}
+    } for i, chunk in enumerate(chunks)]
+    
+    try:
+        embeddings = await hf_embed_batch(chunks)
+        if any(embedding is None for embedding in embeddings):
+            backfill_wake.set()  # the backfill worker will embed these chunks later
+        
+        inserted: Optional[List[Dict[str, Any]]] = None
+        if direct_db():
+            try:
+                with trace_span('postgres.copy', table='knowledge_documents', rows=len(docs)):
+                    inserted = await db_insert_chunks(docs, embeddings)
+            except Exception as e:
+                print(f'Direct chunk insert failed, using PostgREST: {e}')
+                incr_metric('db.direct_errors')
+        if inserted is None:
+            inserted = []
+            for doc_data, embedding in zip(docs, embeddings):
+                if embedding is not None:
+                    doc_data = {**doc_data, 'embedding': embedding.tolist()}
+                result = supabase.table('knowledge_documents').insert(doc_data).execute()
+                if result.data:
+                    inserted.append({**dict(result.data[0]), 'embedding': embedding})  # type: ignore
+        
+        invalidate_answer_cache(guild_id)
+        local_index_add(guild_id, [row for row in inserted if row.get('embedding') is not None])
+        return True
+    except Exception as e:
+        print(f'Error adding document: {e}')
+        return False
+
+
+def _sync_extract_pdf(file_bytes: bytes) -> Optional[str]:
+    """Synchronous PDF text extraction (CPU-bound, run in an executor)."""
+    reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
+    
+    text_content = []
+    for page in reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            text_content.append(page_text)
+    
+    return '\n\n'.join(text_content) if text_content else None
+
+
+async def extract_text_from_pdf(file_bytes: bytes) -> Optional[str]:
+    """Extract text content from a PDF file."""
+    if not pdf_available:
+        return None
+    
+    try:
+        # Parsing large PDFs takes seconds of CPU; keep it off the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, _sync_extract_pdf, file_bytes)
+    except Exception as e:
+        print(f'Error extracting PDF text: {e}')
+        return None
+
+
+async def download_attachment(url: str) -> Optional[bytes]:
+    """Download file content from a Discord attachment URL."""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return await response.read()
+    except Exception as e:
+        print(f'Error downloading attachment: {e}')
+    return None
+
+
+# Explicit projections: never pull the 384-float embedding unless the caller searches with it
+KNOWLEDGE_CHUNK_COLUMNS = 'id, guild_id, source_id, title, filename, content, chunk_index, metadata, created_at'
+KNOWLEDGE_SOURCE_COLUMNS = 'id, guild_id, title, filename, chunk_count, char_count, created_at'
+
+
+async def get_knowledge_document(guild_id: str, doc_id: str) -> Optional[Dict[str, Any]]:
+    """Get a single document chunk from the knowledge base by ID."""
+    if not supabase:
+        return None
+    
+    try:
+        result = supabase.table('knowledge_documents').select(KNOWLEDGE_CHUNK_COLUMNS).eq('guild_id', guild_id).eq('id', doc_id).single().execute()
+        if result.data and isinstance(result.data, dict):
+            return dict(result.data)  # type: ignore
+    except Exception as e:
+        print(f'Error fetching document: {e}')
+    return None
+
+
+async def get_knowledge_documents(guild_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    """Get all documents for a guild."""
+    if not supabase:
+        return []
+    
+    try:
+        result = supabase.table('knowledge_documents').select('id, title, filename, created_at, chunk_index, metadata').eq('guild_id', guild_id).order('created_at', desc=True).limit(limit).execute()
+        if result.data and isinstance(result.data, list):
+            return [dict(row) for row in result.data]  # type: ignore
+    except Exception as e:
+        print(f'Error fetching documents: {e}')
+    return []
+
+
+async def list_knowledge_sources(guild_id: str, limit: int = 20,
+                                 before: Optional[Tuple[str, str]] = None) -> List[Dict[str, Any]]:
+    """List a guild's documents newest first. `before` is the (created_at, id) of the last row of the previous page."""
+    if not supabase:
+        return []
+    
+    params: Dict[str, Any] = {'p_guild_id': guild_id, 'p_limit': limit}
+    if before:
+        params['p_before_created_at'], params['p_before_id'] = before
+    try:
+        result = supabase.rpc('list_knowledge_sources', params).execute()
+        if result.data and isinstance(result.data, list):
+            return [dict(row) for row in result.data]  # type: ignore
+    except Exception as e:
+        print(f'Error listing knowledge sources: {e}')
+    return []
+
+
+async def find_knowledge_source(guild_id: str, title: str) -> Optional[Dict[str, Any]]:
+    """Find the newest document whose title contains `title` (served by the trigram index)."""
+    if not supabase:
+        return None
+    
+    result = supabase.table('knowledge_sources').select(KNOWLEDGE_SOURCE_COLUMNS).eq('guild_id', guild_id).ilike('title', f'%{title}%').order('created_at', desc=True).limit(1).execute()
+    if result.data and isinstance(result.data, list):
+        return dict(result.data[0])  # type: ignore
+    return None
+
+
+async def knowledge_title_taken(guild_id: str, title: str) -> bool:
+    """Whether the guild already has a document with exactly this title."""
+    if not supabase:
+        return False
+    
+    result = supabase.table('knowledge_sources').select('id').eq('guild_id', guild_id).eq('title', title).limit(1).execute()
+    return bool(result.data)
+
+
+def duplicate_title_message(title: str) -> str:
+    """Reply for an upload whose title is already in use (titles are unique per guild)."""
+    return f"❌ A document titled **{title}** already exists. Delete it first or choose another title."
+
+
+async def get_knowledge_source_content(source_id: str) -> List[str]:
+    """Get the text of a document's chunks in order."""
+    if not supabase:
+        return []
+    
+    result = supabase.table('knowledge_documents').select('content').eq('source_id', source_id).order('chunk_index').execute()
+    if result.data and isinstance(result.data, list):
+        return [str(dict(row).get('content', '')) for row in result.data]  # type: ignore
+    return []
+
+
+async def process_knowledge_upload(guild_id: str, title: str, url: str, filename: str) -> str:
+    """Download, extract and index an uploaded file. Returns the message to show the user."""
+    if await knowledge_title_taken(guild_id, title):
+        return duplicate_title_message(title)
+    
+    file_bytes = await download_attachment(url)
+    if not file_bytes:
+        return "❌ Failed to download file."
+    
+    # Extract text content
+    content = None
+    if filename.lower().endswith('.pdf'):
+        if not pdf_available:
+            return "❌ PDF support is not installed. Please upload a TXT file instead."
+        content = await extract_text_from_pdf(file_bytes)
+        if not content:
+            return "❌ Failed to extract text from PDF. The file may be image-based or corrupted."
+    else:
+        # TXT or MD file
+        try:
+            content = file_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            try:
+                content = file_bytes.decode('latin-1')
+            except:
+                return "❌ Failed to read file. Unsupported encoding."
+    
+    if not content or len(content.strip()) == 0:
+        return "❌ File appears to be empty."
+    
+    # Add to knowledge base
+    success = await add_document_to_knowledge_base(guild_id, title, content, filename=filename)
+    
+    if success:
+        return (
+            f"✅ Uploaded **{filename}** as **{title}**\n"
+            f"📄 {len(content):,} characters extracted"
+        )
+    return "❌ Failed to add document to knowledge base."
+
+
+async def run_research(guild_id: str, guild_name: Optional[str], topic: str) -> Tuple[Optional[str], Optional[discord.Embed]]:
+    """Research a topic with web search and an AI summary. Returns (error message, result embed)."""
+    if not web_search_available:
+        return "❌ Web search is not available. Install duckduckgo-search package.", None
+    
+    if not hf_available:
+        return "❌ AI is not configured. Set HF_API_KEY in environment.", None
+    
+    # Get web search results
+    results = await web_search(topic, max_results=5)
+    
+    if not results:
+        return f"No web results found for: **{topic}**", None
+    
+    # Build context from search results
+    search_context = f"Web search results for '{topic}':\n\n"
+    for i, r in enumerate(results, 1):
+        search_context += f"{i}. {r['title']}\n   {r['snippet']}\n   Source: {r['url']}\n\n"
+    
+    # Get guild config for system instructions
+    config = await fetch_bot_config(guild_id, guild_name)
+    
+    # Ask AI to summarize
+    messages = [
+        {'role': 'system', 'content': f"{config['system_instructions']}\n\nYou are researching a topic. Use the provided web search results to give a helpful, accurate summary. Cite sources when relevant."},
+        {'role': 'user', 'content': f"Research topic: {topic}\n\n{search_context}\n\nPlease provide a helpful summary of what you found about this topic."}
+    ]
+    
+    summary = await hf_chat(messages, backend=config.get('llm_backend'))
+    
+    # Create embed
+    embed = discord.Embed(
+        title=f'📚 Research: {topic}',
+        description=summary[:4000] if len(summary) > 4000 else summary,
+        color=discord.Color.green()
+    )
+    
+    # Add sources
+    sources = '\n'.join([f"• [{r['title'][:50]}...]({r['url']})" for r in results[:3]])
+    embed.add_field(name='Sources', value=sources, inline=False)
+    
+    return None, embed
+
+
+async def reindex_knowledge_base(guild_id: str) -> int:
+    """Recompute embeddings for every knowledge chunk in a guild. Returns the number updated."""
+    if not supabase or not embedding_available:
+        return 0
+    
+    updated = 0
+    page_size = 100
+    offset = 0
+    while True:
+        result = supabase.table('knowledge_documents').select('id, content').eq('guild_id', guild_id).order('id').range(offset, offset + page_size - 1).execute()
+        rows: List[Dict[str, Any]] = [dict(row) for row in result.data] if result.data else []  # type: ignore
+        for row in rows:
+            embedding = await hf_embed(str(row.get('content', '')))
+            if embedding is not None:
+                supabase.table('knowledge_documents').update({'embedding': embedding.tolist()}).eq('id', row['id']).execute()
+                updated += 1
+        if len(rows) < page_size:
+            drop_local_index(guild_id)
+            invalidate_answer_cache(guild_id)
+            return updated
+        offset += page_size
+
+
+# Job queue (gateway/worker split)
+# Jobs are rows in a bot_jobs table: Postgres (claimed with FOR UPDATE SKIP LOCKED) or a local
+# SQLite file (claimed inside BEGIN IMMEDIATE). Results reach Discord through the interaction
+# webhook, which workers can call without a gateway connection.
+_db_pool: Optional[Any] = None
+_db_pool_lock = asyncio.Lock()
+
+
+def _encode_vector(value: Any) -> bytes:
+    """pgvector binary format: uint16 dimensions, uint16 unused, then big-endian float32s."""
+    vector = np.asarray(value, dtype='>f4')
+    return struct.pack('>HH', len(vector), 0) + vector.tobytes()
+
+
+def _decode_vector(data: bytes) -> 'np.ndarray':
+    dim = struct.unpack_from('>H', data)[0]
+    return np.frombuffer(data, dtype='>f4', count=dim, offset=4).astype(np.float32)
+
+
+async def _init_db_connection(conn: Any):
+    """Exchange pgvector columns as binary float32 arrays on every pooled connection."""
+    schema = await conn.fetchval("SELECT typnamespace::regnamespace::text FROM pg_type WHERE typname = 'vector'")
+    if schema:
+        await conn.set_type_codec('vector', schema=schema, encoder=_encode_vector, decoder=_decode_vector,
+                                  format='binary')
+
+
+async def get_db_pool() -> Any:
+    """Return the shared asyncpg pool, creating it on first use."""
+    global _db_pool
+    async with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=DB_POOL_SIZE,
+                                                 init=_init_db_connection)
+    return _db_pool
+
+
+def direct_db() -> bool:
+    """Whether hot paths go straight to Postgres instead of through PostgREST."""
+    return DIRECT_DB and bool(DATABASE_URL) and asyncpg_available
+
+
+async def db_search_documents(function: str, guild_id: str, query_embedding: 'np.ndarray',
+                              match_threshold: float, match_count: int) -> List[Dict[str, Any]]:
+    """Call a search_documents* function directly; rows have the same shape as the RPC's JSON."""
+    sql = f'SELECT * FROM {function}(p_guild_id => $1, query_embedding => $2, match_threshold => $3, match_count => $4'
+    args: List[Any] = [guild_id, query_embedding, match_threshold, match_count]
+    if function != 'search_documents':
+        sql += ', p_candidates => $5'
+        args.append(EMBEDDING_CANDIDATES)
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(sql + ')', *args)
+    return [{**dict(row), 'id': str(row['id'])} for row in rows]
+
+
+async def db_insert_chunks(docs: List[Dict[str, Any]], embeddings: List[Optional['np.ndarray']]) -> List[Dict[str, Any]]:
+    """COPY knowledge chunks in one transaction; returns them with their ids, source_id and embedding."""
+    ids = [uuid.uuid4() for _ in docs]
+    columns = ['id', 'guild_id', 'title', 'filename', 'content', 'chunk_index', 'metadata', 'embedding']
+    records = [(chunk_id, d['guild_id'], d['title'], d['filename'], d['content'], d['chunk_index'],
+                json.dumps(d['metadata']), embedding) for chunk_id, d, embedding in zip(ids, docs, embeddings)]
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table('knowledge_documents', records=records, columns=columns)
+            # source_id is set by the link_knowledge_document_source trigger
+            rows = await conn.fetch('SELECT id, source_id FROM knowledge_documents WHERE id = ANY($1::uuid[])', ids)
+    source_ids = {row['id']: row['source_id'] for row in rows}
+    return [{**d, 'id': str(chunk_id), 'embedding': embedding,
+             'source_id': str(source_ids[chunk_id]) if source_ids.get(chunk_id) else None}
+            for chunk_id, d, embedding in zip(ids, docs, embeddings)]
+
+
+async def db_get_reply_context(guild_id: str, channel_id: str, query_embedding: Optional['np.ndarray'],
+                               match_count: int) -> Dict[str, Any]:
+    """Call get_reply_context directly; returns its JSON object (config, memory, chunks)."""
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        context = await conn.fetchval(
+            '''SELECT get_reply_context(p_guild_id => $1, p_channel_id => $2, query_embedding => $3,
+                   match_count => $4, match_threshold => $5, p_search_mode => $6, p_candidates => $7)''',
+            guild_id, channel_id, query_embedding, match_count, KNOWLEDGE_MATCH_THRESHOLD,
+            EMBEDDING_INDEX, EMBEDDING_CANDIDATES
+        )
+    return json.loads(context)
+
+
+async def db_record_exchange(guild_id: str, channel_id: str, user_id: str, username: str,
+                             content: str, bot_response: Optional[str]) -> Dict[str, Any]:
+    """Call record_exchange directly; returns the channel's memory row after the update."""
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow('SELECT * FROM record_exchange($1, $2, $3, $4, $5, $6)',
+                                  guild_id, channel_id, user_id, username, content, bot_response)
+    return dict(row)
+
+
+def jobs_enabled() -> bool:
+    """Whether heavy work should be queued for worker processes instead of run inline."""
+    return BOT_ROLE == 'gateway'
+
+
+def _sqlite_jobs() -> sqlite3.Connection:
+    """Open the local SQLite job queue, creating the table on first use."""
+    conn = sqlite3.connect(JOB_QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bot_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        run_after REAL NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )''')
+    return conn
+
+
+def _sqlite_enqueue(job_type: str, payload: str) -> int:
+    now = time.time()
+    with contextlib.closing(_sqlite_jobs()) as conn:
+        cursor = conn.execute(
+            'INSERT INTO bot_jobs (job_type, payload, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (job_type, payload, now, now, now)
+        )
+        return int(cursor.lastrowid or 0)
+
+
+def _sqlite_claim(limit: int) -> List[Dict[str, Any]]:
+    now = time.time()
+    with contextlib.closing(_sqlite_jobs()) as conn:
+        conn.execute('BEGIN IMMEDIATE')  # takes the write lock, so concurrent workers can't claim the same rows
+        try:
+            rows = conn.execute(
+                '''SELECT id, job_type, payload, attempts FROM bot_jobs
+                   WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND updated_at < ?)
+                   ORDER BY id LIMIT ?''',
+                (now, now - JOB_STALE_AFTER, limit)
+            ).fetchall()
+            for row in rows:
+                conn.execute("UPDATE bot_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?", (now, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    return [{'id': r[0], 'job_type': r[1], 'payload': json.loads(r[2]), 'attempts': r[3] + 1} for r in rows]
+
+
+def _sqlite_finish(job_id: int, error: Optional[str], attempts: int):
+    now = time.time()
+    with contextlib.closing(_sqlite_jobs()) as conn:
+        if error is None:
+            conn.execute('DELETE FROM bot_jobs WHERE id = ?', (job_id,))
+        elif attempts >= JOB_MAX_ATTEMPTS:
+            conn.execute("UPDATE bot_jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?", (error, now, job_id))
+        else:
+            conn.execute(
+                "UPDATE bot_jobs SET status = 'queued', last_error = ?, run_after = ?, updated_at = ? WHERE id = ?",
+                (error, now + 30 * attempts, now, job_id)
+            )
+
+
+def _sqlite_heartbeat(job_id: int):
+    with contextlib.closing(_sqlite_jobs()) as conn:
+        conn.execute("UPDATE bot_jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+
+async def enqueue_job(job_type: str, payload: Dict[str, Any]) -> int:
+    """Add a job to the queue and wake any idle workers."""
+    if JOB_QUEUE == 'postgres':
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            job_id = await conn.fetchval(
+                'INSERT INTO bot_jobs (job_type, payload) VALUES ($1, $2::jsonb) RETURNING id',
+                job_type, json.dumps(payload)
+            )
+            await conn.execute('SELECT pg_notify($1, $2)', JOB_NOTIFY_CHANNEL, str(job_id))
+    else:
+        loop = asyncio.get_event_loop()
+        job_id = await loop.run_in_executor(None, _sqlite_enqueue, job_type, json.dumps(payload))
+    incr_metric(f'jobs.queued.{job_type}')
+    return int(job_id)
+
+
+async def claim_jobs(limit: int) -> List[Dict[str, Any]]:
+    """Atomically claim up to `limit` runnable jobs for this worker."""
+    if JOB_QUEUE == 'postgres':
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                '''UPDATE bot_jobs SET status = 'running', attempts = attempts + 1, updated_at = NOW()
+                   WHERE id IN (
+                       SELECT id FROM bot_jobs
+                       WHERE (status = 'queued' AND run_after <= NOW())
+                          OR (status = 'running' AND updated_at < NOW() - make_interval(secs => $2))
+                       ORDER BY id
+                       FOR UPDATE SKIP LOCKED
+                       LIMIT $1
+                   )
+                   RETURNING id, job_type, payload, attempts''',
+                limit, JOB_STALE_AFTER
+            )
+        return [{'id': r['id'], 'job_type': r['job_type'], 'payload': json.loads(r['payload']), 'attempts': r['attempts']} for r in rows]
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _sqlite_claim, limit)
+
+
+async def finish_job(job: Dict[str, Any], error: Optional[str] = None):
+    """Delete a completed job, or record the error and retry with backoff until attempts run out."""
+    if JOB_QUEUE == 'postgres':
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            if error is None:
+                await conn.execute('DELETE FROM bot_jobs WHERE id = $1', job['id'])
+            elif job['attempts'] >= JOB_MAX_ATTEMPTS:
+                await conn.execute("UPDATE bot_jobs SET status = 'failed', last_error = $2, updated_at = NOW() WHERE id = $1", job['id'], error)
+            else:
+                await conn.execute(
+                    '''UPDATE bot_jobs SET status = 'queued', last_error = $2, updated_at = NOW(),
+                       run_after = NOW() + make_interval(secs => $3) WHERE id = $1''',
+                    job['id'], error, 30 * job['attempts']
+                )
+    else:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, _sqlite_finish, job['id'], error, job['attempts'])
+
+
+async def heartbeat_job(job: Dict[str, Any]):
+    """Refresh a running job's updated_at until cancelled, so other workers don't reclaim it.
+
+    Jobs are reclaimed after JOB_STALE_AFTER seconds without a heartbeat (their worker died),
+    however long they have been running.
+    """
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            if JOB_QUEUE == 'postgres':
+                pool = await get_db_pool()
+                async with pool.acquire() as conn:
+                    await conn.execute("UPDATE bot_jobs SET updated_at = NOW() WHERE id = $1 AND status = 'running'", job['id'])
+            else:
+                await asyncio.get_event_loop().run_in_executor(None, _sqlite_heartbeat, job['id'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Job {job['id']} heartbeat error: {e}")
+
+
+def interaction_target(interaction: discord.Interaction) -> Dict[str, str]:
+    """Webhook credentials a worker needs to answer an interaction (valid for 15 minutes)."""
+    return {'application_id': str(interaction.application_id), 'token': interaction.token}
+
+
+async def edit_interaction_response(target: Dict[str, str], content: Optional[str] = None, embed: Optional[discord.Embed] = None):
+    """Edit an interaction's original response through its webhook, without a gateway connection."""
+    url = f"https://discord.com/api/v10/webhooks/{target['application_id']}/{target['token']}/messages/@original"
+    body: Dict[str, Any] = {'content': content or ''}
+    if embed is not None:
+        body['embeds'] = [embed.to_dict()]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.patch(url, json=body) as response:
+                if response.status >= 400:
+                    print(f'Interaction update failed: HTTP {response.status}')
     except Exception as e:
-        print(f'Embedding error: {e}')
-        return None
+        print(f'Interaction update error: {e}')
 
 
-async def search_knowledge_base(guild_id: str, query: str, match_count: int = 3) -> List[Dict[str, Any]]:
-    """Search knowledge base for relevant documents using semantic search (per-guild)."""
-    if not supabase or not embedding_available:
-        return []
+async def _job_knowledge_upload(payload: Dict[str, Any]):
+    target = payload['interaction']
+    await edit_interaction_response(target, f"⚙️ Processing **{payload['filename']}**...")
+    result = await process_knowledge_upload(payload['guild_id'], payload['title'], payload['url'], payload['filename'])
+    await edit_interaction_response(target, result)
 
-    # Generate embedding for the query
-    query_embedding = await hf_embed(query)
-    if not query_embedding:
-        return []
 
-    try:
-        # 1. Lower threshold, increase matches
-        result = supabase.rpc('search_documents', {
-            'p_guild_id': guild_id,
-            'query_embedding': query_embedding,
-            'match_threshold': 0.35,  # Lowered for more recall
-            'match_count': 8  # Get more, will re-rank
-        }).execute()
-
-        # Convert all keys to str if bytes (Supabase may return bytes keys)
-        def decode_dict(d):
-            if isinstance(d, dict):
-                return {k.decode() if isinstance(k, bytes) else k: v for k, v in d.items()}
-            return d
-        docs = [decode_dict(row) for row in result.data if isinstance(row, dict)] if result.data and isinstance(result.data, list) else []
-        if not docs:
-            return []
+async def _job_research(payload: Dict[str, Any]):
+    error, embed = await run_research(payload['guild_id'], payload.get('guild_name'), payload['topic'])
+    await edit_interaction_response(payload['interaction'], error, embed)
 
-        # 5. Semantic re-ranking (cosine similarity)
-        def cosine_similarity(a, b):
-            import numpy as np
-            a = np.array(a)
-            b = np.array(b)
-            return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
 
-        for doc in docs:
-            if not isinstance(doc, dict):
-                continue
-            doc_emb = doc.get('embedding')
-            if doc_emb:
-                try:
-                    doc['semantic_score'] = cosine_similarity(query_embedding, doc_emb)
-                except Exception:
-                    doc['semantic_score'] = doc.get('similarity', 0)
-            else:
-                doc['semantic_score'] = doc.get('similarity', 0)
+async def _job_update_memory(payload: Dict[str, Any]):
+    await update_conversation_memory(payload['guild_id'], payload['channel_id'], payload['new_message'], payload['bot_response'])
 
-        # Sort by semantic_score (desc)
-        docs = [d for d in docs if isinstance(d, dict)]
-        def safe_score(d):
-            try:
-                return float(d.get('semantic_score', 0))
-            except Exception:
-                return 0.0
-        docs.sort(key=safe_score, reverse=True)
-
-        # 6. Highlight matched content (find best matching sentence)
-        import re
-        def best_snippet(text, query):
-            # Find the sentence with the most query word overlap
-            sentences = re.split(r'(?<=[.!?])\s+', text)
-            query_words = set(re.findall(r'\w+', query.lower()))
-            best = ''
-            best_score = 0
-            for sent in sentences:
-                sent_words = set(re.findall(r'\w+', sent.lower()))
-                score = len(query_words & sent_words)
-                if score > best_score:
-                    best = sent
-                    best_score = score
-            return best.strip() if best else (sentences[0].strip() if sentences else text[:200])
-
-        # 7. Add source metadata and highlight
-        improved = []
-        for doc in docs[:5]:  # Return top 5
-            if not isinstance(doc, dict):
-                continue
-            content = doc.get('content', '')
-            snippet = best_snippet(content, query)
-            improved.append({
-                'title': doc.get('title', 'Untitled'),
-                'filename': doc.get('filename', ''),
-                'created_at': doc.get('created_at', ''),
-                'similarity': doc.get('similarity', 0),
-                'semantic_score': doc.get('semantic_score', 0),
-                'snippet': snippet,
-                'content': content,
-            })
-        return improved
-    except Exception as e:
-        print(f'Knowledge search error: {e}')
-    return []
 
+async def _job_summarize_memory(payload: Dict[str, Any]):
+    await refresh_conversation_summary(payload['guild_id'], payload['channel_id'], payload['summary'],
+                                       payload['new_message'], payload['bot_response'])
 
-async def web_search(query: str, max_results: int = 5) -> List[Dict[str, str]]:
-    """Search the web using DuckDuckGo and return results."""
-    if not web_search_available:
-        return []
-    
+
+async def _job_reindex_knowledge(payload: Dict[str, Any]):
+    target = payload['interaction']
+    await edit_interaction_response(target, "⚙️ Re-embedding knowledge base...")
+    count = await reindex_knowledge_base(payload['guild_id'])
+    await edit_interaction_response(target, f"✅ Re-embedded {count} knowledge chunk(s).")
+
+
+JOB_HANDLERS = {
+    'knowledge_upload': _job_knowledge_upload,
+    'research': _job_research,
+    'update_memory': _job_update_memory,
+    'summarize_memory': _job_summarize_memory,
+    'reindex_knowledge': _job_reindex_knowledge,
+}
+
+
+async def execute_job(job: Dict[str, Any]):
+    """Run one claimed job and record its outcome."""
+    handler = JOB_HANDLERS.get(job['job_type'])
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=max_results))
-            return [
-                {
-                    'title': r.get('title', ''),
-                    'url': r.get('href', ''),
-                    'snippet': r.get('body', '')
-                }
-                for r in results
-            ]
+        if handler is None:
+            raise ValueError(f"Unknown job type: {job['job_type']}")
+        with trace_span(f"job.{job['job_type']}", guild_id=job['payload'].get('guild_id')):
+            heartbeat = asyncio.create_task(heartbeat_job(job))
+            try:
+                await handler(job['payload'])
+            finally:
+                heartbeat.cancel()
+        await finish_job(job)
+        incr_metric(f"jobs.done.{job['job_type']}")
     except Exception as e:
-        print(f'Web search error: {e}')
-        return []
+        print(f"Job {job['id']} ({job['job_type']}) failed: {e}")
+        await finish_job(job, str(e))
+        incr_metric(f"jobs.failed.{job['job_type']}")
+        if job['attempts'] >= JOB_MAX_ATTEMPTS and 'interaction' in job['payload']:
+            await edit_interaction_response(job['payload']['interaction'], f"❌ Error: {e}")
 
 
-async def web_search_with_summary(query: str, max_results: int = 5) -> str:
-    """Search the web and return a formatted summary for the AI to use."""
-    results = await web_search(query, max_results)
+async def run_job_worker():
+    """Consume the job queue until cancelled. Run more worker processes to scale out."""
+    await init_clients()
+    await check_hf_api()
+    print(f'Job worker started: queue={JOB_QUEUE}, concurrency={JOB_WORKER_CONCURRENCY}')
     
-    if not results:
-        return "No web search results found."
+    wake = asyncio.Event()
+    listener = None
+    if JOB_QUEUE == 'postgres':
+        listener = await asyncpg.connect(DATABASE_URL)
+        await listener.add_listener(JOB_NOTIFY_CHANNEL, lambda *args: wake.set())
     
-    summary_parts = [f"Web search results for '{query}':\n"]
-    for i, r in enumerate(results, 1):
-        summary_parts.append(f"{i}. **{r['title']}**")
-        summary_parts.append(f"   URL: {r['url']}")
-        summary_parts.append(f"   {r['snippet']}\n")
+    background = [asyncio.create_task(embedding_backfill_loop()), asyncio.create_task(health_probe_loop()),
+                  asyncio.create_task(messages_partition_loop())]
+    if DATABASE_URL and asyncpg_available:
+        background.append(asyncio.create_task(db_notification_listener()))
+        background.append(asyncio.create_task(message_retention_loop()))
+        background.append(asyncio.create_task(maintain_embedding_index()))
     
-    return '\n'.join(summary_parts)
+    running: set = set()
+    
+    def on_done(task: asyncio.Task):
+        running.discard(task)
+        wake.set()
+    
+    try:
+        while True:
+            free = JOB_WORKER_CONCURRENCY - len(running)
+            if free > 0:
+                try:
+                    jobs = await claim_jobs(free)
+                except Exception as e:
+                    print(f'Job queue error: {e}')
+                    jobs = []
+                for job in jobs:
+                    task = asyncio.create_task(execute_job(job))
+                    running.add(task)
+                    task.add_done_callback(on_done)
+                if len(jobs) == free:
+                    continue  # queue may have more work; claim again right away
+            wake.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wake.wait(), JOB_POLL_INTERVAL)
+    finally:
+        for task in background:
+            task.cancel()
+        if listener is not None:
+            await listener.close()
+        await close_chat_backends()
 
 
-async def add_document_to_knowledge_base(guild_id: str, title: str, content: str, filename: Optional[str] = None) -> bool:
-    """Add a document to the knowledge base with embedding (per-guild)."""
-    if not supabase:
-        return False
-    
-    # Remove null bytes (\u0000) from content
-    content = content.replace('\u0000', '').replace('\x00', '')
+# Bot setup with intents
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
 
-    # Split content into chunks if too long (max ~500 tokens per chunk)
-    max_chunk_size = 2000  # characters
-    chunks = []
 
-    if len(content) > max_chunk_size:
-        # Simple chunking by paragraphs
-        paragraphs = content.split('\n\n')
-        current_chunk = ""
+def get_shard_ids(shard_count: int, worker_count: int, worker_index: int) -> List[int]:
+    """Return the contiguous range of shard IDs owned by one worker process.
 
-        for para in paragraphs:
-            if len(current_chunk) + len(para) < max_chunk_size:
-                current_chunk += para + "\n\n"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = para + "\n\n"
+    The first `shard_count % worker_count` workers get one extra shard, so every worker gets at
+    least one whenever shard_count >= worker_count.
+    """
+    base, extra = divmod(shard_count, worker_count)
+    start = worker_index * base + min(worker_index, extra)
+    return list(range(start, start + base + (1 if worker_index < extra else 0)))
 
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-    else:
-        chunks = [content]
-    
-    try:
-        for i, chunk in enumerate(chunks):
-            # Generate embedding for the chunk
-            embedding = await hf_embed(chunk) if embedding_available else None
-            
-            doc_data: Dict[str, Any] = {
-                'guild_id': guild_id,
-                'title': f"{title}" if len(chunks) == 1 else f"{title} (Part {i+1})",
-                'filename': filename,
-                'content': chunk,
-                'chunk_index': i,
-                'metadata': {'total_chunks': len(chunks)}
-            }
-            
-            if embedding:
-                doc_data['embedding'] = embedding
-            
-            supabase.table('knowledge_documents').insert(doc_data).execute()
-        
+
+class BotCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        """Hold slash commands that arrive before the clients are ready."""
+        await clients_ready.wait()
         return True
-    except Exception as e:
-        print(f'Error adding document: {e}')
-        return False
 
 
-async def extract_text_from_pdf(file_bytes: bytes) -> Optional[str]:
-    """Extract text content from a PDF file."""
-    if not pdf_available:
+def gateway_cache_options() -> Dict[str, Any]:
+    """discord.py cache settings for GATEWAY_PROFILE."""
+    if GATEWAY_PROFILE == 'lean':
+        print('Gateway profile: lean (no member chunking, member or message cache)')
+        return {'member_cache_flags': discord.MemberCacheFlags.none(), 'chunk_guilds_at_startup': False,
+                'max_messages': None}
+    if GATEWAY_PROFILE != 'default':
+        print(f'Unknown GATEWAY_PROFILE={GATEWAY_PROFILE!r}, using default')
+    return {}
+
+
+def create_bot() -> commands.Bot:
+    """Build the bot, using AutoShardedBot when sharding is configured."""
+    options = dict(command_prefix='!', intents=intents, tree_cls=BotCommandTree, **gateway_cache_options())
+    if SHARD_COUNT == 'auto':
+        if BOT_WORKERS > 1:
+            # Every worker would connect to every shard, so each message would get a reply per worker
+            print(f'Error: SHARD_COUNT=auto needs BOT_WORKERS=1; set SHARD_COUNT to a number to run {BOT_WORKERS} workers.')
+            sys.exit(1)
+        print('Sharding: automatic shard count')
+        return commands.AutoShardedBot(**options)
+
+    shard_count = int(SHARD_COUNT) if SHARD_COUNT else (BOT_WORKERS if BOT_WORKERS > 1 else 0)
+    if not shard_count:
+        return commands.Bot(**options)
+
+    worker_index = int(WORKER_INDEX or 0)
+    if shard_count < BOT_WORKERS:
+        print(f'Error: SHARD_COUNT ({shard_count}) must be at least BOT_WORKERS ({BOT_WORKERS}).')
+        sys.exit(1)
+    shard_ids = get_shard_ids(shard_count, BOT_WORKERS, worker_index)
+    print(f'Sharding: worker {worker_index + 1}/{BOT_WORKERS} owns shards {shard_ids} of {shard_count}')
+    return commands.AutoShardedBot(shard_count=shard_count, shard_ids=shard_ids, **options)
+
+
+bot = create_bot()
+
+# Process-local counters, reported by !metrics (per-shard keys end in .shard.<id>)
+metrics: Counter = Counter()
+
+
+def incr_metric(name: str, value: int = 1, shard_id: Optional[int] = None):
+    """Increment a counter, and its per-shard variant when a shard is given."""
+    metrics[name] += value
+    if shard_id is not None:
+        metrics[f'{name}.shard.{shard_id}'] += value
+
+# Cache for bot configuration per guild with timestamps
+guild_config_cache: Dict[str, Dict[str, Any]] = {}  # guild_id -> config
+guild_config_cache_time: Dict[str, float] = {}  # guild_id -> timestamp
+CONFIG_CACHE_TTL = 60  # seconds - refresh config every minute
+
+# Role cache per guild
+role_cache: Dict[str, Dict[str, str]] = {}  # guild_id -> {user_id -> role}
+
+
+def invalidate_guild_cache(guild_id: str, table: str = 'bot_config'):
+    """Drop cached rows for a guild after the underlying table changed."""
+    if table == 'bot_config':
+        guild_config_cache.pop(guild_id, None)
+        guild_config_cache_time.pop(guild_id, None)
+    elif table == 'user_roles':
+        role_cache.pop(guild_id, None)
+    elif table == 'knowledge_sources':
+        invalidate_answer_cache(guild_id)
+    incr_metric('cache.invalidations')
+
+
+# Warm-state snapshot
+# state.json holds the config and role caches and the answer caches' text and timestamps;
+# answers.npy holds the answers' question embeddings, stacked in the same order.
+def warm_state_path() -> str:
+    """Snapshot directory of this process (one per worker when BOT_WORKERS > 1)."""
+    return os.path.join(WARM_STATE_DIR, f'worker-{WORKER_INDEX}') if WORKER_INDEX is not None else WARM_STATE_DIR
+
+
+def collect_warm_state() -> Tuple[Dict[str, Any], Optional['np.ndarray']]:
+    """Copy the caches into (JSON-serializable state, answer embeddings). Run on the event loop."""
+    now = time.time()
+    answers: List[Dict[str, Any]] = []
+    vectors: List['np.ndarray'] = []
+    for guild_id, cache in answer_caches.items():
+        live = np.flatnonzero(cache.created[:cache.size] >= now - ANSWER_CACHE_TTL)
+        if not live.size:
+            continue
+        vectors.append(cache.vectors[live])
+        answers.append({
+            'guild_id': guild_id, 'instructions': cache.instructions,
+            'answers': [cache.answers[i] for i in live], 'generation_ms': cache.generation_ms[live].tolist(),
+            'created': cache.created[live].tolist(), 'last_used': cache.last_used[live].tolist(),
+        })
+    state = {
+        'format': WARM_STATE_FORMAT,
+        'saved_at': datetime.now(timezone.utc).isoformat(),
+        'embed_dimensions': EMBED_DIMENSIONS,
+        'configs': {guild_id: dict(config) for guild_id, config in guild_config_cache.items()},
+        'roles': {guild_id: dict(roles) for guild_id, roles in role_cache.items() if roles},
+        'answers': answers,
+    }
+    return state, np.vstack(vectors) if vectors else None
+
+
+def write_warm_state(state: Dict[str, Any], vectors: Optional['np.ndarray']):
+    """Write a snapshot to warm_state_path(). Blocking; run in an executor."""
+    path = warm_state_path()
+    os.makedirs(path, exist_ok=True)
+    if vectors is not None:
+        np.save(os.path.join(path, 'answers.npy.tmp.npy'), vectors)
+        os.replace(os.path.join(path, 'answers.npy.tmp.npy'), os.path.join(path, 'answers.npy'))
+    state['answer_rows'] = 0 if vectors is None else len(vectors)
+    # Written last: read_warm_state() ignores answers.npy unless its row count matches
+    with open(os.path.join(path, 'state.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(os.path.join(path, 'state.json.tmp'), os.path.join(path, 'state.json'))
+
+
+def read_warm_state() -> Optional[Tuple[Dict[str, Any], Optional['np.ndarray']]]:
+    """Load the snapshot (answer embeddings memory-mapped), or None. Blocking; run in an executor."""
+    path = warm_state_path()
+    try:
+        with open(os.path.join(path, 'state.json'), encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
         return None
+    if state.get('format') != WARM_STATE_FORMAT:
+        return None
+    vectors = None
+    if state.get('answer_rows') and state.get('embed_dimensions') == EMBED_DIMENSIONS:
+        try:
+            vectors = np.load(os.path.join(path, 'answers.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            vectors = None
+        if vectors is not None and vectors.shape != (state['answer_rows'], EMBED_DIMENSIONS):
+            vectors = None
+    return state, vectors
+
+
+def save_warm_state():
+    """Snapshot the caches now. Blocking; used at shutdown, when the event loop has stopped."""
+    try:
+        write_warm_state(*collect_warm_state())
+        print(f'Saved warm state to {warm_state_path()}')
+    except Exception as e:
+        print(f'Error saving warm state: {e}')
+
+
+async def warm_state_loop():
+    """Background task that snapshots the caches every WARM_STATE_INTERVAL seconds."""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(WARM_STATE_INTERVAL)
+        try:
+            state, vectors = collect_warm_state()
+            await loop.run_in_executor(None, write_warm_state, state, vectors)
+            incr_metric('warm_state.saves')
+        except Exception as e:
+            print(f'Error saving warm state: {e}')
+
+
+async def restore_warm_state():
+    """Load the last snapshot before the clients are ready.
+
+    Configs are used straight away (as stale as the config cache TTL already allows); roles and
+    cached answers only once revalidate_warm_state() has checked them against the database.
+    """
+    try:
+        loaded = await asyncio.get_event_loop().run_in_executor(None, read_warm_state)
+    except Exception as e:
+        print(f'Error reading warm state: {e}')
+        return
+    if loaded is None:
+        return
+    state, vectors = loaded
+    now = time.time()
+    configs: Dict[str, Dict[str, Any]] = {}
+    for guild_id, config in state.get('configs', {}).items():
+        if guild_id not in guild_config_cache:
+            guild_config_cache[guild_id] = configs[guild_id] = config
+            guild_config_cache_time[guild_id] = now
+    
+    answers: Dict[str, AnswerCache] = {}
+    offset = 0
+    for entry in state.get('answers', []):
+        if vectors is None:
+            break  # embeddings missing or from another model
+        cache = AnswerCache(entry['instructions'])
+        rows = len(entry['answers'])
+        cache.size = min(rows, len(cache.answers))
+        cache.vectors[:cache.size] = vectors[offset:offset + cache.size]
+        cache.answers[:cache.size] = entry['answers'][:cache.size]
+        cache.generation_ms[:cache.size] = entry['generation_ms'][:cache.size]
+        cache.created[:cache.size] = entry['created'][:cache.size]
+        cache.last_used[:cache.size] = entry['last_used'][:cache.size]
+        answers[entry['guild_id']] = cache
+        offset += rows
     
+    roles = state.get('roles', {})
+    incr_metric('warm_state.restored.configs', len(configs))
+    print(f"Restored warm state from {state.get('saved_at')}: {len(configs)} config(s), "
+          f"{sum(len(r) for r in roles.values())} role(s) and {sum(c.size for c in answers.values())} "
+          f"answer(s) pending revalidation")
+    asyncio.create_task(revalidate_warm_state(str(state.get('saved_at', '')), configs, roles, answers))
+
+
+async def revalidate_warm_state(saved_at: str, configs: Dict[str, Dict[str, Any]],
+                                roles: Dict[str, Dict[str, str]], answers: Dict[str, 'AnswerCache']):
+    """Check restored cache entries against the database in batched queries, dropping stale ones.
+
+    A config is kept if its bot_config row's updated_at hasn't changed, roles are re-read for the
+    cached users, and a guild's answers are dropped if a knowledge source was added after the
+    snapshot (deletions are caught by invalidation or ANSWER_CACHE_TTL, as while running).
+    """
+    await clients_ready.wait()
+    if not supabase:
+        return
+    stale: Counter = Counter()
     try:
-        pdf_file = io.BytesIO(file_bytes)
-        reader = PdfReader(pdf_file)
+        config_ids = list(configs)
+        versions: Dict[str, Any] = {}
+        for i in range(0, len(config_ids), 200):
+            result = await db_call(supabase.table('bot_config').select('guild_id, updated_at').in_('guild_id', config_ids[i:i + 200]).execute)
+            versions.update((str(row['guild_id']), row.get('updated_at')) for row in result.data or [])  # type: ignore
+        now = time.time()
+        for guild_id, config in configs.items():
+            if guild_config_cache.get(guild_id) is not config:
+                continue  # refetched or invalidated since the restore
+            if versions.get(guild_id) != config.get('updated_at'):
+                invalidate_guild_cache(guild_id)
+                stale['configs'] += 1
+            else:
+                # Confirmed current; spread the next refreshes so they don't all expire together
+                guild_config_cache_time[guild_id] = now - random.uniform(0, CONFIG_CACHE_TTL / 2)
         
-        text_content = []
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text_content.append(page_text)
+        # Only the cached users' rows, 200 cached pairs per query and paged, since PostgREST
+        # caps a response at 1000 rows and a guild can have many more members than that
+        role_pairs = [(guild_id, user_id) for guild_id, users in roles.items() for user_id in users]
+        current_roles: Dict[Tuple[str, str], str] = {}
+        for i in range(0, len(role_pairs), 200):
+            batch = role_pairs[i:i + 200]
+            guild_ids = sorted({guild_id for guild_id, _ in batch})
+            user_ids = sorted({user_id for _, user_id in batch})
+            offset = 0
+            while True:
+                query = supabase.table('user_roles').select('guild_id, user_id, role').in_('guild_id', guild_ids).in_('user_id', user_ids)
+                result = await db_call(query.order('id').range(offset, offset + 999).execute)
+                rows = result.data or []
+                current_roles.update(((str(row['guild_id']), str(row['user_id'])), str(row['role']))
+                                     for row in rows)  # type: ignore
+                if len(rows) < 1000:
+                    break
+                offset += 1000
+        restored_roles = 0
+        for guild_id, users in roles.items():
+            for user_id in users:
+                role = current_roles.get((guild_id, user_id))
+                if role is None:
+                    stale['roles'] += 1
+                    continue
+                role_cache.setdefault(guild_id, {}).setdefault(user_id, role)
+                restored_roles += 1
         
-        return '\n\n'.join(text_content) if text_content else None
+        answer_ids = list(answers)
+        for i in range(0, len(answer_ids), 200):
+            result = await db_call(supabase.table('knowledge_sources').select('guild_id').in_('guild_id', answer_ids[i:i + 200]).gt('created_at', saved_at).execute)
+            for row in result.data or []:
+                if answers.pop(str(row['guild_id']), None) is not None:  # type: ignore
+                    stale['answers'] += 1
+        for guild_id, cache in answers.items():
+            if guild_id not in answer_caches and len(answer_caches) < ANSWER_CACHE_MAX_GUILDS:
+                answer_caches[guild_id] = cache
     except Exception as e:
-        print(f'Error extracting PDF text: {e}')
-        return None
+        print(f'Error revalidating warm state, dropping restored roles and answers: {e!r}')
+        return
+    incr_metric('warm_state.restored.roles', restored_roles)
+    incr_metric('warm_state.restored.answers', sum(c.size for c in answers.values()))
+    for kind, count in stale.items():
+        incr_metric(f'warm_state.stale.{kind}', count)
+    print(f"Warm state revalidated: {stale['configs']} stale config(s), {stale['roles']} stale role(s), "
+          f"{stale['answers']} guild answer cache(s) dropped")
 
 
-async def download_attachment(url: str) -> Optional[bytes]:
-    """Download file content from a Discord attachment URL."""
+def _on_backfill_notify(connection: Any, pid: int, channel: str, payload: str):
+    """asyncpg listener: a knowledge row was inserted without an embedding."""
+    backfill_wake.set()
+
+
+def _on_cache_notify(connection: Any, pid: int, channel: str, payload: str):
+    """asyncpg listener for cache invalidation notifications from any process or the dashboard."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return await response.read()
+        event = json.loads(payload)
+        if event.get('guild_id'):
+            invalidate_guild_cache(str(event['guild_id']), str(event.get('table', 'bot_config')))
     except Exception as e:
-        print(f'Error downloading attachment: {e}')
-    return None
+        print(f'Cache notification error: {e}')
 
 
-async def get_knowledge_document(guild_id: str, doc_id: str) -> Optional[Dict[str, Any]]:
-    """Get a single document from the knowledge base by ID."""
-    if not supabase:
-        return None
+async def db_notification_listener():
+    """Background task that LISTENs for cache invalidations and backfill work, reconnecting on failure."""
+    while True:
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener(CACHE_NOTIFY_CHANNEL, _on_cache_notify)
+            await conn.add_listener(BACKFILL_NOTIFY_CHANNEL, _on_backfill_notify)
+            print(f'Listening for notifications on {CACHE_NOTIFY_CHANNEL}, {BACKFILL_NOTIFY_CHANNEL}')
+            try:
+                while True:
+                    await asyncio.sleep(30)
+                    await conn.execute('SELECT 1')  # keepalive; raises if the connection dropped
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'Notification listener error: {e}')
+        await asyncio.sleep(5)
+
+
+# Set when new unembedded knowledge rows may exist (NOTIFY from Postgres, or a local insert)
+backfill_wake = asyncio.Event()
+
+
+async def backfill_embeddings_once() -> int:
+    """Claim one batch of knowledge chunks without embeddings, embed them and write them back.
+
+    Rows are claimed with FOR UPDATE SKIP LOCKED inside claim_unembedded_documents, so several
+    processes can backfill concurrently. Returns the number of rows embedded.
+    """
+    if not supabase or not embedding_available:
+        return 0
+    if breaker_open('supabase') or breaker_open('embed'):
+        return 0  # don't claim rows that can't be embedded or written back yet
     
-    try:
-        result = supabase.table('knowledge_documents').select('*').eq('guild_id', guild_id).eq('id', doc_id).single().execute()
-        if result.data and isinstance(result.data, dict):
-            return dict(result.data)  # type: ignore
-    except Exception as e:
-        print(f'Error fetching document: {e}')
-    return None
+    result = await db_call(supabase.rpc('claim_unembedded_documents', {'batch_size': EMBEDDING_BACKFILL_BATCH}).execute)
+    rows: List[Dict[str, Any]] = [dict(row) for row in result.data] if result.data else []  # type: ignore
+    if not rows:
+        return 0
+    
+    embeddings = await hf_embed_batch([str(row.get('content', '')) for row in rows])
+    ids: List[str] = []
+    vectors: List[str] = []
+    for row, embedding in zip(rows, embeddings):
+        if embedding is not None:
+            ids.append(str(row['id']))
+            vectors.append(json.dumps(embedding.tolist(), separators=(',', ':')))
+    
+    if ids:
+        await db_call(supabase.rpc('set_document_embeddings', {'p_ids': ids, 'p_embeddings': vectors}).execute)
+        incr_metric('embeddings.backfilled', len(ids))
+    return len(ids)
 
 
-async def get_knowledge_documents(guild_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-    """Get all documents for a guild."""
-    if not supabase:
-        return []
+async def embedding_backfill_loop():
+    """Background task that keeps knowledge_documents embedded, woken by NOTIFY or polling."""
+    while True:
+        try:
+            while await backfill_embeddings_once() > 0:
+                pass  # keep draining the backlog
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'Embedding backfill error: {e}')
+        
+        backfill_wake.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(backfill_wake.wait(), EMBEDDING_BACKFILL_INTERVAL)
+
+
+async def get_embedding_backlog(guild_id: Optional[str] = None) -> Optional[int]:
+    """Count knowledge chunks still waiting for an embedding (optionally for one guild)."""
+    if not supabase or breaker_open('supabase'):
+        return None
     
     try:
-        result = supabase.table('knowledge_documents').select('id, title, filename, created_at, chunk_index, metadata').eq('guild_id', guild_id).order('created_at', desc=True).limit(limit).execute()
-        if result.data and isinstance(result.data, list):
-            return [dict(row) for row in result.data]  # type: ignore
+        query = supabase.table('knowledge_documents').select('id', count='exact').is_('embedding', 'null')  # type: ignore[arg-type]
+        if guild_id:
+            query = query.eq('guild_id', guild_id)
+        result = await db_call(query.limit(1).execute)
+        return getattr(result, 'count', None)
     except Exception as e:
-        print(f'Error fetching documents: {e}')
-    return []
+        print(f'Error counting embedding backlog: {e}')
+        return None
 
 
-# Bot setup with intents
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
+async def _archive_rows(conn: Any, query: str, args: Tuple[Any, ...], path: str, append: bool = False) -> int:
+    """Stream single-column JSON rows from a SELECT into a gzip JSONL file. Returns the row count.
+
+    Must run inside a transaction (asyncpg cursors require one).
+    """
+    loop = asyncio.get_event_loop()
+    count = 0
+    batch: List[str] = []
+    with gzip.open(path, 'at' if append else 'wt', encoding='utf-8') as f:
+        async for record in conn.cursor(query, *args, prefetch=1000):
+            batch.append(record[0])
+            if len(batch) >= 1000:
+                await loop.run_in_executor(None, f.write, '\n'.join(batch) + '\n')
+                count += len(batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(None, f.write, '\n'.join(batch) + '\n')
+            count += len(batch)
+    return count
+
+
+async def archive_expired_partitions(conn: Any, cutoff: datetime) -> int:
+    """Detach, archive and drop monthly messages partitions that end before `cutoff`."""
+    partitions = await conn.fetch(
+        '''SELECT relname, relispartition FROM pg_class
+           WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace AND relname LIKE 'messages\\_p%' '''
+    )
+    dropped = 0
+    for partition in sorted(partitions, key=lambda r: r['relname']):
+        name = partition['relname']
+        match = MESSAGES_PARTITION_PATTERN.match(name)
+        if not match:
+            continue
+        year, month = int(match.group(1)), int(match.group(2))
+        partition_end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+        if partition_end > cutoff:
+            continue
+        
+        # Detach first so new queries stop scanning it; a failed export leaves it detached for the next run
+        if partition['relispartition']:
+            await conn.execute(f'ALTER TABLE messages DETACH PARTITION "{name}"')
+        path = os.path.join(MESSAGE_ARCHIVE_DIR, f'{name}.jsonl.gz')
+        async with conn.transaction():
+            count = await _archive_rows(conn, f'SELECT row_to_json(m)::text FROM "{name}" m', (), path)
+        await conn.execute(f'DROP TABLE "{name}"')
+        print(f'Message retention: archived {count} row(s) from {name} to {path}')
+        incr_metric('messages.archived', count)
+        dropped += 1
+    return dropped
+
+
+async def purge_guild_messages(conn: Any, guild_id: str, cutoff: datetime) -> int:
+    """Archive and delete one guild's messages older than `cutoff`, in batches."""
+    path = os.path.join(MESSAGE_ARCHIVE_DIR, f'messages_guild_{guild_id}.jsonl.gz')
+    loop = asyncio.get_event_loop()
+    total = 0
+    while True:
+        # Delete and archive in one transaction, so rows are never lost if the write fails
+        async with conn.transaction():
+            rows = await conn.fetch(
+                '''WITH expired AS (
+                       SELECT id, created_at FROM messages
+                       WHERE guild_id = $1 AND created_at < $2
+                       LIMIT 5000
+                   )
+                   DELETE FROM messages m USING expired e
+                   WHERE m.id = e.id AND m.created_at = e.created_at
+                   RETURNING row_to_json(m)::text''',
+                guild_id, cutoff
+            )
+            if rows:
+                lines = '\n'.join(r[0] for r in rows) + '\n'
+                with gzip.open(path, 'at', encoding='utf-8') as f:
+                    await loop.run_in_executor(None, f.write, lines)
+        total += len(rows)
+        if len(rows) < 5000:
+            break
+    if total:
+        incr_metric('messages.archived', total)
+    return total
+
+
+async def run_message_retention():
+    """Archive history past each guild's retention window.
+
+    Whole monthly partitions are dropped once they are older than the longest retention of any
+    guild (only when MESSAGE_RETENTION_DAYS gives every guild a window); guilds with a shorter
+    window have their older rows deleted individually. Nothing is deleted without MESSAGE_ARCHIVE_DIR.
+    """
+    if not MESSAGE_ARCHIVE_DIR:
+        return
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        # Only one process across all workers runs retention at a time
+        if not await conn.fetchval('SELECT pg_try_advisory_lock(hashtext($1))', 'dasai_message_retention'):
+            return
+        try:
+            rows = await conn.fetch('SELECT guild_id, message_retention_days FROM bot_config')
+            retention = {r['guild_id']: r['message_retention_days'] or MESSAGE_RETENTION_DAYS for r in rows}
+            retention = {guild_id: days for guild_id, days in retention.items() if days > 0}
+            if not retention and MESSAGE_RETENTION_DAYS <= 0:
+                return
+            os.makedirs(MESSAGE_ARCHIVE_DIR, exist_ok=True)
+            now = datetime.now(timezone.utc)
+            
+            # Without a default window, guilds that keep everything share every partition
+            longest = None
+            if MESSAGE_RETENTION_DAYS > 0:
+                longest = max(list(retention.values()) + [MESSAGE_RETENTION_DAYS])
+                await archive_expired_partitions(conn, now - timedelta(days=longest))
+            for guild_id, days in retention.items():
+                if longest is None or days < longest:
+                    purged = await purge_guild_messages(conn, guild_id, now - timedelta(days=days))
+                    if purged:
+                        print(f'Message retention: archived {purged} message(s) for guild {guild_id}')
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock(hashtext($1))', 'dasai_message_retention')
+
+
+async def ensure_embedding_index():
+    """Build the ANN index for EMBEDDING_INDEX without blocking writes, then drop the other layouts' indexes.
+
+    The build runs with CREATE INDEX CONCURRENTLY, so existing rows are converted in the
+    background while the bot keeps serving (searches use the previous index until it is done).
+    """
+    _, index_name, index_definition = EMBEDDING_INDEXES[EMBEDDING_INDEX]
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        if not await conn.fetchval('SELECT pg_try_advisory_lock(hashtext($1))', 'dasai_embedding_index'):
+            return
+        try:
+            valid = await conn.fetchval(
+                'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = $1',
+                index_name
+            )
+            if valid is False:
+                # Left behind by an interrupted concurrent build
+                await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}')
+            if not valid:
+                print(f'Building embedding index {index_name} in the background...')
+                start = time.monotonic()
+                await conn.execute('SET statement_timeout = 0')
+                try:
+                    await conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON knowledge_documents {index_definition}')
+                finally:
+                    await conn.execute('RESET statement_timeout')
+                print(f'Embedding index {index_name} built in {time.monotonic() - start:.1f}s')
+            
+            # Only the configured layout's index is kept warm in shared buffers
+            for mode, (_, other_index, _) in EMBEDDING_INDEXES.items():
+                if mode != EMBEDDING_INDEX:
+                    await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {other_index}')
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock(hashtext($1))', 'dasai_embedding_index')
 
-bot = commands.Bot(command_prefix='!', intents=intents)
 
-# Cache for bot configuration per guild with timestamps
-guild_config_cache: Dict[str, Dict[str, Any]] = {}  # guild_id -> config
-guild_config_cache_time: Dict[str, float] = {}  # guild_id -> timestamp
-CONFIG_CACHE_TTL = 60  # seconds - refresh config every minute
+async def maintain_embedding_index():
+    """Background task wrapper for ensure_embedding_index()."""
+    try:
+        await ensure_embedding_index()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f'Embedding index maintenance error: {e}')
 
-# Role cache per guild
-role_cache: Dict[str, Dict[str, str]] = {}  # guild_id -> {user_id -> role}
 
-import time
+async def messages_partition_loop():
+    """Background task that keeps the next months' messages partitions created.
+
+    Runs in every process through the Supabase RPC, so it needs neither DATABASE_URL nor retention;
+    without it, rows land in messages_default once the partitions created by schema.sql run out.
+    """
+    await clients_ready.wait()
+    while True:
+        if supabase is not None:
+            try:
+                loop = asyncio.get_event_loop()
+                result = await loop.run_in_executor(db_executor, supabase.rpc('ensure_messages_partitions', {}).execute)
+                if result.data:
+                    print(f'Created {result.data} messages partition(s)')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'Messages partition maintenance error: {e}')
+        await asyncio.sleep(MESSAGES_PARTITION_INTERVAL)
+
+
+async def message_retention_loop():
+    """Background task that runs message retention periodically."""
+    await asyncio.sleep(60)  # let startup finish first
+    while True:
+        try:
+            await run_message_retention()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'Message retention error: {e}')
+        await asyncio.sleep(MESSAGE_RETENTION_INTERVAL)
 
 
 def get_default_config() -> Dict[str, Any]:
@@ -445,10 +3330,117 @@ def get_default_config() -> Dict[str, Any]:
     return {
         'system_instructions': 'You are a helpful AI assistant for a Discord server. Be friendly, concise, and helpful.',
         'allowed_channels': [],
-        'bot_name': 'DasAI Assistant'
+        'bot_name': 'DasAI Assistant',
+        # AI replies per minute (0 = unlimited); must match the bot_config column defaults
+        'guild_rate_limit': 0,
+        'channel_rate_limit': 0,
+        'user_rate_limit': 0,
+        'llm_backend': None,  # chat backend tried first; None follows LLM_BACKENDS
+        'answer_cache': False  # reuse answers to similar questions (semantic answer cache)
     }
 
 
+# Token buckets for rate limiting: (scope, id) -> [tokens, last refill timestamp]
+# Each bucket holds up to `limit` tokens and refills at limit/60 tokens per second
+rate_buckets: Dict[Tuple[str, str], List[float]] = {}
+RATE_BUCKET_MAX = 50000  # prune idle buckets beyond this many
+RATE_LIMIT_NOTICE_INTERVAL = 60  # seconds between ⏳ reactions for the same exhausted bucket (and load-shedding notices per channel)
+rate_limit_notices: Dict[Tuple[str, str], float] = {}  # (scope, id) -> when a notice was last sent
+
+
+def _bucket_tokens(key: Tuple[str, str], limit: int, now: float) -> List[float]:
+    """Return the refilled bucket for a key, creating a full one if needed."""
+    bucket = rate_buckets.get(key)
+    if bucket is None:
+        bucket = rate_buckets[key] = [float(limit), now]
+    else:
+        bucket[0] = min(float(limit), bucket[0] + (now - bucket[1]) * limit / 60.0)
+        bucket[1] = now
+    return bucket
+
+
+def _prune_rate_buckets(now: float):
+    """Drop buckets idle long enough to have refilled completely."""
+    for key in [k for k, b in rate_buckets.items() if now - b[1] > 60]:
+        del rate_buckets[key]
+    for key in [k for k, t in rate_limit_notices.items() if now - t > RATE_LIMIT_NOTICE_INTERVAL]:
+        del rate_limit_notices[key]
+
+
+def check_rate_limit(config: Dict[str, Any], guild_id: str, channel_id: str, user_id: str) -> Optional[Tuple[str, str]]:
+    """Take one token from the user, channel and guild buckets.
+
+    Returns the (scope, id) of the bucket that is out of tokens (nothing is consumed in that
+    case), or None if allowed.
+    """
+    now = time.monotonic()
+    if len(rate_buckets) > RATE_BUCKET_MAX:
+        _prune_rate_buckets(now)
+    
+    scopes = (
+        ('user', f'{guild_id}:{user_id}', int(config.get('user_rate_limit') or 0)),
+        ('channel', channel_id, int(config.get('channel_rate_limit') or 0)),
+        ('guild', guild_id, int(config.get('guild_rate_limit') or 0)),
+    )
+    buckets = []
+    for scope, key, limit in scopes:
+        if limit <= 0:
+            continue
+        bucket = _bucket_tokens((scope, key), limit, now)
+        if bucket[0] < 1:
+            return scope, key
+        buckets.append(bucket)
+    for bucket in buckets:
+        bucket[0] -= 1
+    return None
+
+
+def rate_limit_notice_due(bucket: Tuple[str, str]) -> bool:
+    """Whether to tell the user a message was throttled (⏳, or the load-shedding notice): once per
+    RATE_LIMIT_NOTICE_INTERVAL per bucket, so a flood of messages doesn't turn into a flood of Discord API calls."""
+    now = time.monotonic()
+    if now - rate_limit_notices.get(bucket, float('-inf')) < RATE_LIMIT_NOTICE_INTERVAL:
+        return False
+    rate_limit_notices[bucket] = now
+    return True
+
+
+# Load shedding levels, applied in order as chat completions pile up
+SHED_NONE = 0      # full reply
+SHED_NO_WEB = 1    # skip web search
+SHED_NO_RAG = 2    # also skip knowledge base retrieval
+SHED_SHORT = 3     # also cap max_tokens
+SHED_REFUSE = 4    # refuse the request
+SHED_NOTICE = "⚠️ I'm handling a lot of requests right now. Please try again in a moment."
+
+
+def get_shed_level() -> int:
+    """Map the number of in-flight chat completions to a degradation level."""
+    load = inflight_chat_calls / max(MAX_INFLIGHT_REPLIES, 1)
+    if load < 0.5:
+        return SHED_NONE
+    if load < 0.75:
+        return SHED_NO_WEB
+    if load < 1.0:
+        return SHED_NO_RAG
+    if load < 1.5:
+        return SHED_SHORT
+    return SHED_REFUSE
+
+
+async def resolve_member(guild: Optional[discord.Guild], user_id: int) -> Optional[discord.Member]:
+    """Guild member from the cache, or from the API when it isn't cached (GATEWAY_PROFILE=lean)."""
+    if guild is None:
+        return None
+    member = guild.get_member(user_id)
+    if member is not None:
+        return member
+    try:
+        return await guild.fetch_member(user_id)
+    except discord.NotFound:
+        return None
+
+
 async def get_user_role(guild_id: str, user_id: str) -> Optional[str]:
     """Get a user's role from the database."""
     if not supabase:
@@ -565,6 +3557,25 @@ async def get_guild_roles(guild_id: str) -> List[Dict[str, Any]]:
         return []
 
 
+def cache_bot_config(guild_id: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize a bot_config row and store it in the config cache."""
+    defaults = get_default_config()
+    guild_config_cache[guild_id] = {
+        'system_instructions': str(config.get('system_instructions', '')),
+        'allowed_channels': list(config.get('allowed_channels') or []),
+        'bot_name': str(config.get('bot_name', 'DasAI Assistant')),
+        'guild_rate_limit': int(config.get('guild_rate_limit', defaults['guild_rate_limit'])),
+        'channel_rate_limit': int(config.get('channel_rate_limit', defaults['channel_rate_limit'])),
+        'user_rate_limit': int(config.get('user_rate_limit', defaults['user_rate_limit'])),
+        'llm_backend': config.get('llm_backend'),
+        'answer_cache': bool(config.get('answer_cache', False)),
+        'updated_at': config.get('updated_at')  # row version, for revalidating a restored snapshot
+    }
+    guild_config_cache_time[guild_id] = time.time()
+    return guild_config_cache[guild_id]
+
+
+@traced()
 async def fetch_bot_config(guild_id: str, guild_name: Optional[str] = None) -> Dict[str, Any]:
     """Fetch bot configuration for a specific guild from Supabase."""
     if not supabase:
@@ -576,18 +3587,14 @@ async def fetch_bot_config(guild_id: str, guild_name: Optional[str] = None) -> D
         cache_age = current_time - guild_config_cache_time.get(guild_id, 0)
         if cache_age < CONFIG_CACHE_TTL:
             return guild_config_cache[guild_id]
+    if breaker_open('supabase'):
+        # Database failing: keep using the stale config rather than waiting on it
+        return guild_config_cache.get(guild_id) or get_default_config()
     
     try:
-        result = supabase.table('bot_config').select('*').eq('guild_id', guild_id).limit(1).execute()
+        result = await db_call(supabase.table('bot_config').select('*').eq('guild_id', guild_id).limit(1).execute)
         if result.data:
-            config: Dict[str, Any] = dict(result.data[0])  # type: ignore
-            guild_config_cache[guild_id] = {
-                'system_instructions': str(config.get('system_instructions', '')),
-                'allowed_channels': list(config.get('allowed_channels', [])),
-                'bot_name': str(config.get('bot_name', 'DasAI Assistant'))
-            }
-            guild_config_cache_time[guild_id] = current_time
-            return guild_config_cache[guild_id]
+            return cache_bot_config(guild_id, dict(result.data[0]))  # type: ignore
         else:
             # Create default config for this guild
             default_config = get_default_config()
@@ -607,22 +3614,90 @@ async def fetch_bot_config(guild_id: str, guild_name: Optional[str] = None) -> D
     return get_default_config()
 
 
+@traced()
+async def fetch_conversation_memory(guild_id: str, channel_id: str) -> Optional[Dict[str, Any]]:
+    """A channel's conversation_memory row (summary, message_count), or None."""
+    if direct_db():
+        async def select() -> Any:
+            pool = await get_db_pool()
+            async with pool.acquire() as conn:
+                return await conn.fetchrow(
+                    'SELECT summary, message_count FROM conversation_memory WHERE guild_id = $1 AND channel_id = $2',
+                    guild_id, channel_id
+                )
+        row = await guarded('supabase', select, DB_TIMEOUT)
+        return dict(row) if row else None
+    result = await db_call(supabase.table('conversation_memory').select('summary, message_count').eq('guild_id', guild_id).eq('channel_id', channel_id).limit(1).execute)
+    return dict(result.data[0]) if result.data else None  # type: ignore
+
+
+async def upsert_conversation_memory(guild_id: str, channel_id: str, summary: str, message_count: int):
+    """Insert or replace a channel's conversation summary."""
+    if direct_db():
+        async def upsert():
+            pool = await get_db_pool()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    '''INSERT INTO conversation_memory (guild_id, channel_id, summary, message_count)
+                       VALUES ($1, $2, $3, $4)
+                       ON CONFLICT (guild_id, channel_id)
+                       DO UPDATE SET summary = EXCLUDED.summary, message_count = EXCLUDED.message_count, updated_at = NOW()''',
+                    guild_id, channel_id, summary, message_count
+                )
+        await guarded('supabase', upsert, DB_TIMEOUT)
+        return
+    await db_call(supabase.table('conversation_memory').upsert({
+        'guild_id': guild_id,
+        'channel_id': channel_id,
+        'summary': summary,
+        'message_count': message_count
+    }, on_conflict='guild_id,channel_id').execute)
+
+
+async def set_conversation_summary(guild_id: str, channel_id: str, summary: str):
+    """Replace a channel's summary, leaving message_count to record_exchange."""
+    if direct_db():
+        async def update():
+            pool = await get_db_pool()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    'UPDATE conversation_memory SET summary = $3, updated_at = NOW() WHERE guild_id = $1 AND channel_id = $2',
+                    guild_id, channel_id, summary
+                )
+        await guarded('supabase', update, DB_TIMEOUT)
+        return
+    await db_call(supabase.table('conversation_memory').update({'summary': summary}).eq('guild_id', guild_id).eq('channel_id', channel_id).execute)
+
+
 async def get_conversation_memory(guild_id: str, channel_id: str) -> str:
     """Get conversation summary for a channel in a guild."""
     if not supabase:
         return ''
     
     try:
-        result = supabase.table('conversation_memory').select('summary').eq('guild_id', guild_id).eq('channel_id', channel_id).limit(1).execute()
-        if result.data:
-            row: Dict[str, Any] = dict(result.data[0])  # type: ignore
+        row = await fetch_conversation_memory(guild_id, channel_id)
+        if row:
             return str(row.get('summary', ''))
     except Exception as e:
         print(f'Error fetching memory: {e}')
     
-    return ''
+    return ''
+
+
+async def summarize_exchange(current_summary: str, new_message: str, bot_response: str) -> str:
+    """Fold the latest exchange into a channel's running summary."""
+    summary_prompt = f"""Previous summary: {current_summary}
+
+Recent exchange:
+User: {new_message}
+Assistant: {bot_response}
+
+Create a brief updated summary of the conversation so far (max 200 words):"""
+    
+    return await hf_chat([{'role': 'user', 'content': summary_prompt}])
 
 
+@traced()
 async def update_conversation_memory(guild_id: str, channel_id: str, new_message: str, bot_response: str):
     """Update conversation memory with new exchange."""
     if not supabase or not hf_available:
@@ -630,58 +3705,146 @@ async def update_conversation_memory(guild_id: str, channel_id: str, new_message
     
     try:
         # Get existing memory
-        existing = supabase.table('conversation_memory').select('*').eq('guild_id', guild_id).eq('channel_id', channel_id).limit(1).execute()
+        row = await fetch_conversation_memory(guild_id, channel_id)
         
         current_summary: str = ''
         message_count: int = 0
         
-        if existing.data:
-            row: Dict[str, Any] = dict(existing.data[0])  # type: ignore
+        if row:
             current_summary = str(row.get('summary', ''))
-            message_count = int(row.get('message_count', 0))
+            message_count = int(row.get('message_count') or 0)
         
         # Generate updated summary every 5 messages
         if message_count % 5 == 0 and message_count > 0:
-            summary_prompt = f"""Previous summary: {current_summary}
-
-Recent exchange:
-User: {new_message}
-Assistant: {bot_response}
-
-Create a brief updated summary of the conversation so far (max 200 words):"""
-            
-            current_summary = await hf_chat([{'role': 'user', 'content': summary_prompt}])
+            current_summary = await summarize_exchange(current_summary, new_message, bot_response)
         
         # Upsert memory
-        supabase.table('conversation_memory').upsert({
-            'guild_id': guild_id,
-            'channel_id': channel_id,
-            'summary': current_summary,
-            'message_count': message_count + 1
-        }, on_conflict='guild_id,channel_id').execute()
+        await upsert_conversation_memory(guild_id, channel_id, current_summary, message_count + 1)
         
     except Exception as e:
         print(f'Error updating memory: {e}')
 
 
+@traced()
 async def save_message(guild_id: str, channel_id: str, user_id: str, username: str, content: str, bot_response: Optional[str] = None):
     """Save message to database."""
     if not supabase:
         return
     
     try:
-        supabase.table('messages').insert({
+        await db_call(supabase.table('messages').insert({
             'guild_id': guild_id,
             'channel_id': channel_id,
             'user_id': user_id,
             'username': username,
             'content': content,
             'bot_response': bot_response
-        }).execute()
+        }).execute)
     except Exception as e:
         print(f'Error saving message: {e}')
 
 
+@traced()
+async def fetch_reply_context(guild_id: str, channel_id: str, query: str,
+                              query_embedding: Optional['np.ndarray']) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """Conversation summary and knowledge results for a reply from one get_reply_context call.
+
+    Knowledge is searched when `query_embedding` is given. The guild's config in the same response
+    refreshes the config cache, so active guilds don't re-read bot_config when it expires.
+    Returns None if the call failed (e.g. the function isn't in the schema yet).
+    """
+    local_index = get_local_index(guild_id) if LOCAL_VECTOR_INDEX and query_embedding is not None else None
+    match_count = knowledge_candidate_count() if query_embedding is not None and local_index is None else 0
+    context: Any = None
+    if direct_db():
+        try:
+            with trace_span('postgres.query', db_function='get_reply_context'):
+                context = await guarded('supabase', lambda: db_get_reply_context(
+                    guild_id, channel_id, query_embedding if match_count else None, match_count
+                ), DB_TIMEOUT)
+        except Exception as e:
+            print(f'Direct get_reply_context failed, using PostgREST: {e}')
+            incr_metric('db.direct_errors')
+    if context is None:
+        try:
+            with trace_span('supabase.rpc', db_function='get_reply_context'):
+                result = await db_call(supabase.rpc('get_reply_context', {
+                    'p_guild_id': guild_id,
+                    'p_channel_id': channel_id,
+                    'query_embedding': query_embedding.tolist() if match_count else None,
+                    'match_count': match_count,
+                    'match_threshold': KNOWLEDGE_MATCH_THRESHOLD,
+                    'p_search_mode': EMBEDDING_INDEX,
+                    'p_candidates': EMBEDDING_CANDIDATES
+                }).execute)
+            context = result.data
+        except Exception as e:
+            print(f'get_reply_context failed, using separate queries: {e}')
+            incr_metric('db.reply_rpc_errors')
+            return None
+
+    if context.get('config'):
+        cache_bot_config(guild_id, context['config'])
+    memory = str((context.get('memory') or {}).get('summary') or '')
+    rows: Any = context.get('chunks') or []
+    if local_index is not None:
+        with trace_span('local_index.search', chunks=local_index.size):
+            rows = local_index.search(query_embedding, knowledge_candidate_count(), KNOWLEDGE_MATCH_THRESHOLD)
+        incr_metric('rag.local_index_searches')
+    elif match_count:
+        incr_metric('rag.db_searches')
+    docs = await rank_knowledge_results(query, rows, 5) if rows else []
+    return memory, docs
+
+
+@traced()
+async def record_exchange(guild_id: str, channel_id: str, user_id: str, username: str, content: str,
+                          bot_response: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Save a message and count it in the channel's memory with one record_exchange call.
+
+    Returns the memory row after the update (summary, message_count), or None if the call failed.
+    """
+    if direct_db():
+        try:
+            with trace_span('postgres.query', db_function='record_exchange'):
+                return await guarded('supabase', lambda: db_record_exchange(
+                    guild_id, channel_id, user_id, username, content, bot_response
+                ), DB_TIMEOUT)
+        except Exception as e:
+            print(f'Direct record_exchange failed, using PostgREST: {e}')
+            incr_metric('db.direct_errors')
+    try:
+        with trace_span('supabase.rpc', db_function='record_exchange'):
+            result = await db_call(supabase.rpc('record_exchange', {
+                'p_guild_id': guild_id,
+                'p_channel_id': channel_id,
+                'p_user_id': user_id,
+                'p_username': username,
+                'p_content': content,
+                'p_bot_response': bot_response
+            }).execute)
+        return dict(result.data[0]) if result.data else None  # type: ignore
+    except Exception as e:
+        print(f'record_exchange failed, using separate queries: {e}')
+        incr_metric('db.reply_rpc_errors')
+        return None
+
+
+@traced()
+async def refresh_conversation_summary(guild_id: str, channel_id: str, current_summary: str,
+                                       new_message: str, bot_response: str):
+    """Regenerate a channel's summary after record_exchange counted the exchange."""
+    if not supabase or not hf_available:
+        return
+    
+    try:
+        summary = await summarize_exchange(current_summary, new_message, bot_response)
+        await set_conversation_summary(guild_id, channel_id, summary)
+    except Exception as e:
+        print(f'Error updating memory: {e}')
+
+
+@traced()
 async def should_web_search(query: str) -> bool:
     """Determine if a query would benefit from web search using AI classification."""
     query_lower = query.lower()
@@ -697,7 +3860,7 @@ async def should_web_search(query: str) -> bool:
             return True
     
     # Use AI to classify if the query needs web search
-    if hf_available and hf_client is not None:
+    if hf_available:
         try:
             classification_prompt = """You are a classifier that determines if a user query requires real-time web search.
 
@@ -722,23 +3885,16 @@ async def should_web_search(query: str) -> bool:
 
                                         Answer (YES or NO):"""
 
-            client = hf_client  # Local variable for lambda capture
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: client.chat_completion(
-                    messages=[{'role': 'user', 'content': classification_prompt}],
-                    model=HF_MODEL,
-                    max_tokens=5,
-                    temperature=0.1
-                )
+            response = await llm_chat(
+                [{'role': 'user', 'content': classification_prompt}],
+                max_tokens=5,
+                temperature=0.1
             )
             
-            if response and response.choices:
-                content = response.choices[0].message.content
-                if content:
-                    answer = content.strip().upper()
-                    return answer.startswith('YES')
+            content = response['content']
+            if content:
+                answer = content.strip().upper()
+                return answer.startswith('YES')
         except Exception as e:
             print(f'Web search classification error: {e}')
             # Fall back to keyword matching on error
@@ -755,43 +3911,275 @@ async def should_web_search(query: str) -> bool:
     return False
 
 
-async def generate_ai_response(message: discord.Message, config: dict) -> str:
-    """Generate AI response using Hugging Face with RAG context and optional web search."""
+# Prompt assembly
+# Token counts come from HF_MODEL's own tokenizer, loaded once in the background (until then,
+# and if it can't be loaded, ~4 characters per token is assumed). Counts are memoised, since the
+# same system instructions and memory summaries are counted on every reply.
+prompt_tokenizer: Optional[Any] = None
+
+
+def _load_tokenizer() -> Any:
+    if TOKENIZER_PATH:
+        return tokenizers.Tokenizer.from_file(TOKENIZER_PATH)
+    return tokenizers.Tokenizer.from_pretrained(HF_MODEL, token=HF_API_KEY or None)
+
+
+async def load_tokenizer():
+    """Load the prompt tokenizer off the event loop."""
+    global prompt_tokenizer
+    if not tokenizers_available:
+        print('tokenizers not installed. Prompt token counts will be estimated.')
+        return
+    try:
+        loop = asyncio.get_event_loop()
+        prompt_tokenizer = await loop.run_in_executor(None, _load_tokenizer)
+        count_tokens.cache_clear()  # drop estimates made before the tokenizer was ready
+        print(f'Tokenizer loaded for {TOKENIZER_PATH or HF_MODEL}')
+    except Exception as e:
+        print(f'Error loading tokenizer, estimating prompt tokens instead: {e}')
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Number of tokens in `text` (without special tokens)."""
+    if prompt_tokenizer is None:
+        return (len(text) + 3) // 4
+    return len(prompt_tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` to at most `max_tokens` tokens, marking the cut with an ellipsis."""
+    if max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+    if prompt_tokenizer is None:
+        return text[:max_tokens * 4 - 1] + '…'
+    offsets = prompt_tokenizer.encode(text, add_special_tokens=False).offsets
+    return text[:offsets[max_tokens - 2][1]] + '…' if max_tokens > 1 else '…'
+
+
+def build_prompt_sections(relevant_docs: List[Dict[str, Any]], web_results: List[Dict[str, str]],
+                          memory: Optional[str]) -> Dict[str, Tuple[str, List[str]]]:
+    """Context sources for assemble_prompt(): name -> (header, items best first)."""
+    sections: Dict[str, Tuple[str, List[str]]] = {}
+    if relevant_docs:
+        items = []
+        for doc in relevant_docs:
+            title = doc.get('title', 'Untitled')
+            similarity = doc.get('similarity', 0)
+            semantic_score = doc.get('semantic_score', 0)
+            filename = doc.get('filename', '')
+            created_at = doc.get('created_at', '')
+            snippet = doc.get('snippet', '')
+            # Show metadata, highlight snippet
+            item = f"[{title}] (relevance: {similarity:.0%}, semantic: {semantic_score:.2f})"
+            if filename:
+                item += f" | File: {filename}"
+            if created_at:
+                item += f" | Added: {created_at}"
+            items.append(item + f"\n➡️ {snippet}")
+        sections['knowledge'] = ("Use the following knowledge base context to help answer questions when relevant:\n📚 **Relevant Knowledge Base Context:**", items)
+    if web_results:
+        sections['web'] = (
+            "Use these web search results to provide accurate, up-to-date information. Cite sources when helpful:\n🔍 **Web Search Results:**",
+            [f"{i}. **{r['title']}**\n   {r['snippet']}\n   Source: {r['url']}" for i, r in enumerate(web_results, 1)]
+        )
+    if memory:
+        sections['memory'] = ("Conversation context:", [memory])
+    return sections
+
+
+def assemble_prompt(system_instructions: str, sections: Dict[str, Tuple[str, List[str]]],
+                    history: List[Dict[str, str]], user_message: Dict[str, str],
+                    budget: int = PROMPT_TOKEN_BUDGET,
+                    layout: Optional[str] = None) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+    """Build the chat messages for a reply within `budget` prompt tokens.
+
+    The system instructions and the user's message (capped at PROMPT_USER_MESSAGE_MAX) are
+    always kept. Then each source in PROMPT_SECTION_BUDGETS order takes its items, best first,
+    up to its own cap and the budget left; the first item that doesn't fit is trimmed and the
+    rest are dropped. `history` is oldest first and is filled from the newest message back.
+    Returns the messages and the token count of each part.
+
+    With the 'stable' layout, the prompt starts with exactly `system_instructions`, then the
+    history, then one user message holding the context (always knowledge, web, memory) followed
+    by the user's message; see PROMPT_LAYOUT.
+    """
+    unlimited = budget <= 0
+    layout = layout or PROMPT_LAYOUT
+    user_message = dict(user_message)
+    if not unlimited:
+        user_message['content'] = truncate_to_tokens(user_message['content'], PROMPT_USER_MESSAGE_MAX)
+    stats: Dict[str, int] = {
+        'system': count_tokens(system_instructions) + CHAT_MESSAGE_OVERHEAD,
+        'user': count_tokens(user_message['content']) + CHAT_MESSAGE_OVERHEAD,
+        'dropped': 0,
+    }
+    remaining = budget - stats['system'] - stats['user']
+    
+    chosen: Dict[str, List[Any]] = {}
+    for name, cap in PROMPT_SECTION_BUDGETS:
+        if name == 'history':
+            candidates: List[Any] = list(reversed(history))
+            cost = lambda m: count_tokens(m['content']) + CHAT_MESSAGE_OVERHEAD  # noqa: E731
+            header_cost = 0
+        elif name in sections:
+            header, candidates = sections[name]
+            cost = lambda item: count_tokens(item) + 1  # noqa: E731
+            header_cost = count_tokens(header) + 2
+        else:
+            continue
+        if not candidates:
+            continue
+        
+        available = float('inf') if unlimited else min(cap, remaining) - header_cost
+        used = 0
+        kept: List[Any] = []
+        for item in candidates:
+            item_cost = cost(item)
+            if used + item_cost <= available:
+                kept.append(item)
+                used += item_cost
+                continue
+            # Trim the first item that doesn't fit when there's room for a useful part of it
+            room = int(available - used) - (CHAT_MESSAGE_OVERHEAD if name == 'history' else 1)
+            if room >= 32:
+                if name == 'history':
+                    item = {**item, 'content': truncate_to_tokens(item['content'], room)}
+                else:
+                    item = truncate_to_tokens(item, room)
+                kept.append(item)
+                used += cost(item)
+            break
+        stats['dropped'] += len(candidates) - len(kept)
+        if kept:
+            chosen[name] = kept
+            stats[name] = used + header_cost
+            remaining -= used + header_cost
+    
+    context = ''.join(
+        f"{sections[name][0]}\n" + '\n'.join(chosen[name]) + '\n\n'
+        for name in ('knowledge', 'web', 'memory') if name in chosen
+    )
+    if layout == 'stable':
+        messages = [{'role': 'system', 'content': system_instructions}]
+        messages.extend(reversed(chosen.get('history', [])))
+        if context:
+            user_message['content'] = f"{context}Message:\n{user_message['content']}"
+            stats['user'] += count_tokens('Message:\n')
+    else:
+        system_prompt = system_instructions + (f"\n\n{context.rstrip()}" if context else '')
+        messages = [{'role': 'system', 'content': system_prompt}]
+        messages.extend(reversed(chosen.get('history', [])))
+    messages.append(user_message)
+    stats['total'] = sum(v for k, v in stats.items() if k != 'dropped')
+    return messages, stats
+
+
+# Oldest message of each channel's history window in the 'stable' layout
+history_anchors: 'OrderedDict[str, int]' = OrderedDict()
+
+
+def history_window(channel_id: str, messages: List[Tuple[int, Dict[str, str]]]) -> List[Dict[str, str]]:
+    """Pick the history to send from recent (message id, message) pairs, oldest first.
+
+    A sliding window of the last N messages changes the prompt right after the system
+    instructions on every reply. With the 'stable' layout the window instead starts at a
+    fixed message and grows until that message ages out of the fetched history or the window
+    outgrows the history token cap (assemble_prompt() would then drop its oldest messages, a
+    different prefix each reply). It then restarts at the newest messages filling half the cap,
+    so consecutive replies in a channel share their history prefix.
+    """
+    if PROMPT_LAYOUT != 'stable' or not messages:
+        return [m for _, m in messages]
+    cap = dict(PROMPT_SECTION_BUDGETS)['history'] if PROMPT_TOKEN_BUDGET > 0 else float('inf')
+    cost = lambda m: count_tokens(m['content']) + CHAT_MESSAGE_OVERHEAD  # noqa: E731
+    ids = [message_id for message_id, _ in messages]
+    anchor = history_anchors.get(channel_id)
+    if anchor not in ids or sum(cost(m) for message_id, m in messages if message_id >= anchor) > cap:
+        anchor, used = ids[-1], 0
+        for message_id, m in reversed(messages[-(PROMPT_HISTORY_MESSAGES // 2):]):
+            used += cost(m)
+            if used > cap / 2:
+                break
+            anchor = message_id
+        history_anchors[channel_id] = anchor
+    history_anchors.move_to_end(channel_id)
+    while len(history_anchors) > HISTORY_ANCHORS_MAX:
+        history_anchors.popitem(last=False)
+    return [m for message_id, m in messages if message_id >= anchor]
+
+
+def record_prompt_stats(stats: Dict[str, int]):
+    """Report one reply's prompt token counts to metrics and the current trace span."""
+    incr_metric('prompt.requests')
+    incr_metric('prompt.tokens', stats['total'])
+    if stats['dropped']:
+        incr_metric('prompt.trimmed')
+    span = _current_span.get()
+    if span is not None and span.get('sampled'):
+        span['attributes'].update({f'prompt.tokens.{k}': v for k, v in stats.items()})
+
+
+@traced()
+async def generate_ai_response(message: discord.Message, config: dict, shed_level: int = SHED_NONE,
+                               burst: Optional[List[discord.Message]] = None) -> str:
+    """Generate AI response using Hugging Face with RAG context and optional web search.
+
+    Under load (`shed_level`), web search, then RAG, are skipped and the reply is shortened.
+    `burst` is the run of channel messages (ending with `message`) to answer together.
+    """
     if not hf_available:
         return "AI is not configured. Please set HF_API_KEY."
+    if chat_breaker_open(config.get('llm_backend')):
+        incr_metric('replies.degraded.no_chat')
+        return DEGRADED_NOTICE
     
     guild_id = str(message.guild.id) if message.guild else ''
     channel_id = str(message.channel.id)
-    user_query = message.content
+    burst = burst or [message]
+    user_query = merge_burst(burst)
     
-    # Get conversation memory
-    memory = await get_conversation_memory(guild_id, channel_id)
+    # Serve repeated questions from the guild's answer cache (opt-in); the embedding is reused for RAG
+    query_embedding: Optional['np.ndarray'] = None
+    use_answer_cache = (config.get('answer_cache') and embedding_available and message.reference is None
+                        and len(burst) == 1 and len(user_query.split()) >= ANSWER_CACHE_MIN_WORDS)
+    if use_answer_cache:
+        query_embedding = await hf_embed(user_query)
+        if query_embedding is not None:
+            cached = answer_cache_lookup(guild_id, config['system_instructions'], query_embedding)
+            if cached is not None:
+                return cached
+    started = time.perf_counter()
     
-    # Search knowledge base for relevant context (RAG)
-    knowledge_context = ""
-    if embedding_available:
-        relevant_docs = await search_knowledge_base(guild_id, user_query, match_count=5)
-        if relevant_docs:
-            knowledge_context = "\n\n📚 **Relevant Knowledge Base Context:**\n"
-            for doc in relevant_docs:
-                title = doc.get('title', 'Untitled')
-                similarity = doc.get('similarity', 0)
-                semantic_score = doc.get('semantic_score', 0)
-                filename = doc.get('filename', '')
-                created_at = doc.get('created_at', '')
-                snippet = doc.get('snippet', '')
-                # Show metadata, highlight snippet
-                knowledge_context += f"\n[{title}] (relevance: {similarity:.0%}, semantic: {semantic_score:.2f})"
-                if filename:
-                    knowledge_context += f" | File: {filename}"
-                if created_at:
-                    knowledge_context += f" | Added: {created_at}"
-                knowledge_context += f"\n➡️ {snippet}\n"
+    # Conversation memory and knowledge base context (RAG), in one get_reply_context call if possible.
+    # Both are skipped while the database's circuit breaker is open, RAG also while the embedding one is.
+    db_ok = not breaker_open('supabase')
+    use_rag = embedding_available and shed_level < SHED_NO_RAG and db_ok and not breaker_open('embed')
+    if not use_rag and embedding_available and shed_level < SHED_NO_RAG:
+        incr_metric('replies.degraded.no_rag')
+    context = None
+    if REPLY_CONTEXT_RPC and supabase and db_ok:
+        if use_rag and query_embedding is None:
+            query_embedding = await hf_embed(user_query)
+        context = await fetch_reply_context(guild_id, channel_id, user_query, query_embedding if use_rag else None)
+    memory = ''
+    relevant_docs: List[Dict[str, Any]] = []
+    if context is not None:
+        memory, relevant_docs = context
+    elif not breaker_open('supabase'):
+        memory = await get_conversation_memory(guild_id, channel_id)
+        if use_rag:
+            relevant_docs = await search_knowledge_base(guild_id, user_query, match_count=5, query_embedding=query_embedding)
+    else:
+        incr_metric('replies.degraded.no_db')
     
     # Check if we should do a web search
-    web_context = ""
+    web_results: List[Dict[str, str]] = []
     searched_web = False
-    if web_search_available and await should_web_search(user_query):
+    if (web_search_available and shed_level < SHED_NO_WEB and not breaker_open('search')
+            and await should_web_search(user_query)):
         searched_web = True
         # Extract the search query (remove "search:" prefix if present)
         search_query = user_query
@@ -801,45 +4189,43 @@ async def generate_ai_response(message: discord.Message, config: dict) -> str:
                 break
         
         web_results = await web_search(search_query, max_results=4)
-        if web_results:
-            web_context = "\n\n🔍 **Web Search Results:**\n"
-            for i, r in enumerate(web_results, 1):
-                web_context += f"{i}. **{r['title']}**\n   {r['snippet']}\n   Source: {r['url']}\n\n"
-    
-    # Build system prompt
-    system_prompt = config['system_instructions']
-    
-    if knowledge_context:
-        system_prompt += f"\n\nUse the following knowledge base context to help answer questions when relevant:{knowledge_context}"
-    
-    if web_context:
-        system_prompt += f"\n\nUse these web search results to provide accurate, up-to-date information. Cite sources when helpful:{web_context}"
-    
-    if memory:
-        system_prompt += f"\n\nConversation context:\n{memory}"
     
     # Get recent messages for immediate context
     recent_messages = []
+    burst_ids = {m.id for m in burst}
     try:
-        async for msg in message.channel.history(limit=10):
-            if msg.id != message.id:
+        async for msg in message.channel.history(limit=PROMPT_HISTORY_MESSAGES + len(burst) - 1):
+            if msg.id not in burst_ids:
                 role = 'assistant' if msg.author == bot.user else 'user'
-                recent_messages.append({
+                recent_messages.append((msg.id, {
                     'role': role,
                     'content': f"{msg.author.display_name}: {msg.content}" if role == 'user' else msg.content
-                })
+                }))
         recent_messages.reverse()
     except Exception as e:
         print(f'Error fetching history: {e}')
     
-    # Build messages array
-    messages = [
-        {'role': 'system', 'content': system_prompt}
-    ]
-    messages.extend(recent_messages[-6:])  # Last 6 messages for context
-    messages.append({'role': 'user', 'content': f"{message.author.display_name}: {user_query}"})
+    # Build messages array within the prompt token budget
+    with trace_span('prompt.assemble'):
+        messages, prompt_stats = assemble_prompt(
+            config['system_instructions'],
+            build_prompt_sections(relevant_docs, web_results, memory),
+            history_window(channel_id, recent_messages),
+            # merge_burst() already names the speakers when there are several
+            {'role': 'user', 'content': user_query if len({m.author.id for m in burst}) > 1
+             else f"{message.author.display_name}: {user_query}"}
+        )
+        record_prompt_stats(prompt_stats)
+    
+    response = await cascade_chat(messages, user_query, bool(relevant_docs or web_results),
+                                  max_tokens=SHED_MAX_TOKENS if shed_level >= SHED_SHORT else 1000,
+                                  backend=config.get('llm_backend'), guild_id=guild_id)
     
-    response = await hf_chat(messages)
+    # Web results and answers shortened under load aren't worth repeating
+    if (use_answer_cache and query_embedding is not None and not searched_web and shed_level < SHED_SHORT
+            and not response.startswith(('Error', 'AI is not configured', 'No response generated'))):
+        answer_cache_store(guild_id, config['system_instructions'], query_embedding, response,
+                           (time.perf_counter() - started) * 1000)
     
     # Add indicator if web search was used
     if searched_web and web_results:
@@ -848,25 +4234,85 @@ async def generate_ai_response(message: discord.Message, config: dict) -> str:
     return response
 
 
+@bot.event
+async def setup_hook():
+    """Called once before the bot connects. Nothing here is awaited, so the gateway connection
+    starts while the clients are built; handlers wait for clients_ready."""
+    asyncio.create_task(start_services())
+
+
+async def start_services():
+    """Restore the warm state and create the clients, then start the background tasks."""
+    if WARM_STATE_DIR:
+        await restore_warm_state()
+    await init_clients()
+    if TRACE_EXPORTER != 'none':
+        asyncio.create_task(trace_flush_loop())
+        print(f'Tracing enabled: exporter={TRACE_EXPORTER}, sample rate={TRACE_SAMPLE_RATE}')
+    if DATABASE_URL and asyncpg_available:
+        asyncio.create_task(db_notification_listener())
+    asyncio.create_task(readiness_loop())
+    asyncio.create_task(messages_partition_loop())
+    asyncio.create_task(load_tokenizer())
+    if WARM_STATE_DIR:
+        asyncio.create_task(warm_state_loop())
+    if RERANK_MODEL:
+        asyncio.create_task(load_reranker())
+    if LOCAL_VECTOR_INDEX:
+        asyncio.create_task(local_index_reconcile_loop())
+        print(f'Local vector index enabled: dir={LOCAL_INDEX_DIR}, hnswlib={"yes" if hnswlib_available else "no"}')
+    if BOT_ROLE == 'all':
+        asyncio.create_task(embedding_backfill_loop())
+        if DATABASE_URL and asyncpg_available:
+            asyncio.create_task(message_retention_loop())
+            asyncio.create_task(maintain_embedding_index())
+
+
+def command_tree_hash() -> str:
+    """Hash of the application command definitions as they would be sent to Discord."""
+    commands_payload = sorted((cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()),
+                              key=lambda c: (c.get('type', 1), c['name']))
+    data = json.dumps({'application_id': bot.application_id, 'commands': commands_payload}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+async def sync_command_tree():
+    """Sync slash commands with Discord only if they changed since the last sync recorded on disk."""
+    tree_hash = command_tree_hash()
+    with contextlib.suppress(FileNotFoundError):
+        with open(COMMAND_TREE_HASH_PATH, encoding='utf-8') as f:
+            if f.read().strip() == tree_hash:
+                print('Slash commands unchanged, skipping sync')
+                return
+    try:
+        synced = await bot.tree.sync()
+        print(f'Synced {len(synced)} command(s)')
+    except Exception as e:
+        print(f'Failed to sync commands: {e}')
+        return
+    with open(COMMAND_TREE_HASH_PATH, 'w', encoding='utf-8') as f:
+        f.write(tree_hash)
+
+
+# Set after the first on_ready; later ones are gateway reconnects
+bot_initialized = False
+
+
 @bot.event
 async def on_ready():
-    """Called when the bot is ready and connected."""
+    """Called when the bot is ready and connected, including after every gateway reconnect."""
+    global bot_initialized
     print(f'{bot.user} has connected to Discord!')
     print(f'Bot is in {len(bot.guilds)} guild(s)')
-    
-    # Check Hugging Face API connection
-    await check_hf_api()
+    if bot_initialized:
+        return
+    bot_initialized = True
     
     # List connected guilds
     for guild in bot.guilds:
         print(f'  - {guild.name} (ID: {guild.id})')
     
-    # Sync slash commands
-    try:
-        synced = await bot.tree.sync()
-        print(f'Synced {len(synced)} command(s)')
-    except Exception as e:
-        print(f'Failed to sync commands: {e}')
+    await sync_command_tree()
 
 
 @bot.event
@@ -880,6 +4326,8 @@ async def on_message(message: discord.Message):
     if not message.guild:
         return
     
+    await clients_ready.wait()
+    
     # Process commands first
     await bot.process_commands(message)
     
@@ -901,9 +4349,52 @@ async def on_message(message: discord.Message):
     if not (is_allowed or is_mentioned):
         return
     
+    # Per-user/channel/guild token buckets
+    limited = check_rate_limit(config, guild_id, channel_id, str(message.author.id))
+    if limited:
+        incr_metric(f'replies.rate_limited.{limited[0]}')
+        if rate_limit_notice_due(limited):
+            try:
+                await message.add_reaction('⏳')
+            except Exception as e:
+                print(f'Error adding reaction: {e}')
+        return
+    
+    incr_metric('messages.answered', shard_id=message.guild.shard_id)
+    
     # Generate and send response
+    with trace_span('on_message', guild_id=guild_id, channel_id=channel_id, message_id=str(message.id)):
+        if COALESCE_WINDOW > 0:
+            await coalesced_reply(message, config)
+        else:
+            await reply_to_message(message, config)
+
+
+async def reply_to_message(message: discord.Message, config: Dict[str, Any],
+                           burst: Optional[List[discord.Message]] = None,
+                           on_generated: Optional[Callable[[], None]] = None):
+    """Generate, send and record the AI reply to a message (or to a burst of messages ending with it).
+
+    `on_generated` is called once the reply is generated, before anything is sent.
+    """
+    guild_id = str(message.guild.id) if message.guild else ''
+    channel_id = str(message.channel.id)
+    content = merge_burst(burst) if burst else message.content
+
+    shed_level = get_shed_level()
+    if shed_level == SHED_REFUSE:
+        incr_metric('replies.shed.refused')
+        # One notice per channel per cooldown: replying to every refused message adds API calls under overload
+        if rate_limit_notice_due(('shed', channel_id)):
+            await message.reply(SHED_NOTICE, mention_author=False)
+        return
+    if shed_level > SHED_NONE:
+        incr_metric(f'replies.shed.level{shed_level}')
+
     async with message.channel.typing():
-        response = await generate_ai_response(message, config)
+        response = await generate_ai_response(message, config, shed_level, burst)
+        if on_generated is not None:
+            on_generated()
         
         # Split long responses
         if len(response) > 2000:
@@ -913,18 +4404,137 @@ async def on_message(message: discord.Message):
         else:
             await message.reply(response, mention_author=False)
         
-        # Save to database
+        if breaker_open('supabase'):
+            incr_metric('replies.unrecorded')
+            return
+        
+        # Save to database and count the exchange in one record_exchange call if possible
+        recorded = None
+        if REPLY_CONTEXT_RPC and supabase:
+            recorded = await record_exchange(
+                guild_id,
+                channel_id,
+                str(message.author.id),
+                message.author.display_name,
+                content,
+                response
+            )
+        if recorded is not None:
+            # Same cadence as update_conversation_memory: a new summary every 5 messages
+            previous_count = int(recorded.get('message_count') or 1) - 1
+            if previous_count > 0 and previous_count % 5 == 0:
+                if jobs_enabled():
+                    await enqueue_job('summarize_memory', {
+                        'guild_id': guild_id,
+                        'channel_id': channel_id,
+                        'summary': str(recorded.get('summary') or ''),
+                        'new_message': content,
+                        'bot_response': response,
+                    })
+                else:
+                    await refresh_conversation_summary(guild_id, channel_id, str(recorded.get('summary') or ''),
+                                                       content, response)
+            return
+        
         await save_message(
             guild_id,
             channel_id,
             str(message.author.id),
             message.author.display_name,
-            message.content,
+            content,
             response
         )
         
-        # Update memory
-        await update_conversation_memory(guild_id, channel_id, message.content, response)
+        # Update memory (summaries are generated by a worker when the job queue is enabled)
+        if jobs_enabled():
+            await enqueue_job('update_memory', {
+                'guild_id': guild_id,
+                'channel_id': channel_id,
+                'new_message': content,
+                'bot_response': response,
+            })
+        else:
+            await update_conversation_memory(guild_id, channel_id, content, response)
+
+
+def merge_burst(burst: List[discord.Message]) -> str:
+    """One query from a run of messages: their lines, prefixed with the author when there are several."""
+    if len({m.author.id for m in burst}) == 1:
+        return '\n'.join(m.content for m in burst)
+    return '\n'.join(f'{m.author.display_name}: {m.content}' for m in burst)
+
+
+class ChannelBurst:
+    """Messages in one channel waiting to be answered together, and the generation answering them."""
+    
+    def __init__(self, message: discord.Message):
+        self.messages = [message]
+        self.first_at = asyncio.get_event_loop().time()
+        self.arrived = asyncio.Event()
+        self.generation: Optional['asyncio.Future[None]'] = None
+    
+    def accepts(self) -> bool:
+        """Whether a new message may still join (bounded so a busy channel still gets answers)."""
+        return (len(self.messages) < COALESCE_MAX_MESSAGES
+                and asyncio.get_event_loop().time() - self.first_at < COALESCE_MAX_WAIT)
+    
+    def add(self, message: discord.Message):
+        """Join the burst, cancelling a generation that wouldn't cover this message."""
+        self.messages.append(message)
+        self.arrived.set()
+        incr_metric('coalesce.merged')
+        if self.generation is not None and not self.generation.done():
+            self.generation.cancel()
+            incr_metric('coalesce.cancelled')
+    
+    async def settle(self):
+        """Wait until no message has joined for COALESCE_WINDOW seconds, or the burst is full."""
+        while self.accepts():
+            self.arrived.clear()
+            remaining = self.first_at + COALESCE_MAX_WAIT - asyncio.get_event_loop().time()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), min(COALESCE_WINDOW, remaining))
+            except asyncio.TimeoutError:
+                return
+
+
+channel_bursts: Dict[str, ChannelBurst] = {}  # channel_id -> burst still taking messages
+
+
+async def coalesced_reply(message: discord.Message, config: Dict[str, Any]):
+    """Answer a message together with the rest of its channel's burst (see COALESCE_WINDOW).
+
+    The burst's first message leads it: it waits for the channel to go quiet, then generates one
+    reply to the last message. Later messages join the burst and return at once; one that arrives
+    mid-generation cancels it, and the leader starts over with every message so far. Once the
+    reply is generated the burst closes, and new messages start the next one.
+    """
+    channel_id = str(message.channel.id)
+    burst = channel_bursts.get(channel_id)
+    if burst is not None and burst.accepts():
+        burst.add(message)
+        return
+    burst = channel_bursts[channel_id] = ChannelBurst(message)
+    
+    def close():
+        if channel_bursts.get(channel_id) is burst:
+            del channel_bursts[channel_id]
+    
+    try:
+        while True:
+            await burst.settle()
+            generation = burst.generation = asyncio.ensure_future(
+                reply_to_message(burst.messages[-1], config, list(burst.messages), on_generated=close))
+            try:
+                await asyncio.wait({generation})
+            finally:
+                if not generation.done():
+                    generation.cancel()  # the leader itself was cancelled
+            if not generation.cancelled():
+                generation.result()
+                return
+    finally:
+        close()
 
 
 @bot.event
@@ -967,7 +4577,55 @@ async def status(ctx):
     embed.add_field(name='Embed Model', value=HF_EMBED_MODEL if embedding_available else 'Not available', inline=True)
     embed.add_field(name='Database', value='✅ Connected' if supabase else '❌ Not configured', inline=True)
     embed.add_field(name='Hugging Face', value='✅ Connected' if hf_available else '❌ Not available', inline=True)
+    now = time.time()
+    chain = backend_chain(config.get('llm_backend'))
+    embed.add_field(name='Chat Backends', value=' → '.join(
+        f"{'⚠️' if b.failed_until > now else '✅'} {b.name}" for b in chain
+    ) or 'None configured', inline=True)
     embed.add_field(name='RAG/Embeddings', value='✅ Enabled' if embedding_available else '❌ Disabled', inline=True)
+    breaker_lines = []
+    for name, breaker in sorted(breakers.items()):
+        if breaker.state == 'closed':
+            breaker_lines.append(f'✅ {name}')
+        elif breaker.is_open():
+            remaining = BREAKER_COOLDOWN - (time.monotonic() - breaker.opened_at)
+            breaker_lines.append(f'❌ {name}: open' + (f', retry in {remaining:.0f}s' if remaining > 0 else ''))
+        else:
+            breaker_lines.append(f'⚠️ {name}: half-open')
+    if breaker_lines:
+        embed.add_field(name='Circuit Breakers', value='\n'.join(breaker_lines)[:1024], inline=False)
+    backlog = await get_embedding_backlog(guild_id)
+    if backlog is not None:
+        backfilled = metrics.get('embeddings.backfilled', 0)
+        embed.add_field(name='Embedding Backlog', value=f'{backlog} pending ({backfilled} backfilled)', inline=True)
+    if ctx.guild and bot.shard_count:
+        embed.add_field(name='Shard', value=f'{ctx.guild.shard_id} of {bot.shard_count}', inline=True)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='metrics')
+@commands.has_permissions(administrator=True)
+async def show_metrics(ctx):
+    """Show per-shard health and this process's counters."""
+    embed = discord.Embed(title='📈 DasAI Metrics', color=discord.Color.blue())
+
+    shard_lines = []
+    for shard_id, latency in (bot.latencies if bot.shard_count else [(0, bot.latency)]):
+        guild_count = sum(1 for g in bot.guilds if g.shard_id == shard_id)
+        answered = metrics.get(f'messages.answered.shard.{shard_id}', 0)
+        shard_lines.append(f'Shard {shard_id}: {round(latency * 1000)}ms, {guild_count} guild(s), {answered} answered')
+    embed.add_field(name='Shards', value='\n'.join(shard_lines) or 'None', inline=False)
+
+    latency_lines = []
+    for name, hedger in sorted(hedgers.items()):
+        p50, p95 = hedger.latency.percentile(50), hedger.latency.percentile(95)
+        if p50 is not None and p95 is not None:
+            latency_lines.append(f'{name}: p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms ({hedger.latency.count()} calls)')
+    if latency_lines:
+        embed.add_field(name='Upstream Latency', value='\n'.join(latency_lines)[:1024], inline=False)
+
+    counters = '\n'.join(f'{name}: {value}' for name, value in sorted(metrics.items()) if '.shard.' not in name)
+    embed.add_field(name='Counters', value=counters[:1024] or 'None', inline=False)
     await ctx.send(embed=embed)
 
 
@@ -983,10 +4641,7 @@ async def config_refresh(interaction: discord.Interaction):
         return
     
     # Clear cache for this guild
-    if guild_id in guild_config_cache:
-        del guild_config_cache[guild_id]
-    if guild_id in guild_config_cache_time:
-        del guild_config_cache_time[guild_id]
+    invalidate_guild_cache(guild_id)
     
     # Fetch fresh config
     config = await fetch_bot_config(guild_id, interaction.guild.name if interaction.guild else None)
@@ -1022,26 +4677,19 @@ async def ask(interaction: discord.Interaction, question: str):
         return
     
     # Search knowledge base for relevant context (per-guild)
-    knowledge_context = ""
+    sections: Dict[str, Tuple[str, List[str]]] = {}
     if embedding_available:
         relevant_docs = await search_knowledge_base(guild_id, question, match_count=3)
         if relevant_docs:
-            knowledge_context = "\n\nRelevant Knowledge:\n"
-            for doc in relevant_docs:
-                title = doc.get('title', 'Untitled')
-                content = doc.get('content', '')[:500]
-                knowledge_context += f"[{title}]: {content}\n"
-    
-    system_prompt = config['system_instructions']
-    if knowledge_context:
-        system_prompt += f"\n\nUse this context to help answer:{knowledge_context}"
+            sections['knowledge'] = (
+                "Use this context to help answer:\nRelevant Knowledge:",
+                [f"[{doc.get('title', 'Untitled')}]: {doc.get('content', '')[:500]}" for doc in relevant_docs]
+            )
     
-    messages = [
-        {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': question}
-    ]
+    messages, prompt_stats = assemble_prompt(config['system_instructions'], sections, [], {'role': 'user', 'content': question})
+    record_prompt_stats(prompt_stats)
     
-    answer = await hf_chat(messages)
+    answer = await hf_chat(messages, backend=config.get('llm_backend'))
     
     if len(answer) > 2000:
         answer = answer[:1997] + '...'
@@ -1088,51 +4736,24 @@ async def research(interaction: discord.Interaction, topic: str):
     """Research a topic by searching the web and providing an AI-powered summary."""
     await interaction.response.defer()
     
-    if not web_search_available:
-        await interaction.followup.send("❌ Web search is not available. Install duckduckgo-search package.")
-        return
-    
-    if not hf_available:
-        await interaction.followup.send("❌ AI is not configured. Set HF_API_KEY in environment.")
-        return
-    
-    # Get web search results
-    results = await web_search(topic, max_results=5)
-    
-    if not results:
-        await interaction.followup.send(f"No web results found for: **{topic}**")
-        return
-    
-    # Build context from search results
-    search_context = f"Web search results for '{topic}':\n\n"
-    for i, r in enumerate(results, 1):
-        search_context += f"{i}. {r['title']}\n   {r['snippet']}\n   Source: {r['url']}\n\n"
-    
-    # Get guild config for system instructions
     guild_id = str(interaction.guild_id) if interaction.guild_id else ''
     guild_name = interaction.guild.name if interaction.guild else None
-    config = await fetch_bot_config(guild_id, guild_name)
-    
-    # Ask AI to summarize
-    messages = [
-        {'role': 'system', 'content': f"{config['system_instructions']}\n\nYou are researching a topic. Use the provided web search results to give a helpful, accurate summary. Cite sources when relevant."},
-        {'role': 'user', 'content': f"Research topic: {topic}\n\n{search_context}\n\nPlease provide a helpful summary of what you found about this topic."}
-    ]
-    
-    summary = await hf_chat(messages)
-    
-    # Create embed
-    embed = discord.Embed(
-        title=f'📚 Research: {topic}',
-        description=summary[:4000] if len(summary) > 4000 else summary,
-        color=discord.Color.green()
-    )
     
-    # Add sources
-    sources = '\n'.join([f"• [{r['title'][:50]}...]({r['url']})" for r in results[:3]])
-    embed.add_field(name='Sources', value=sources, inline=False)
+    if jobs_enabled():
+        await enqueue_job('research', {
+            'guild_id': guild_id,
+            'guild_name': guild_name,
+            'topic': topic,
+            'interaction': interaction_target(interaction),
+        })
+        await interaction.edit_original_response(content=f"⏳ Researching **{topic}**...")
+        return
     
-    await interaction.followup.send(embed=embed)
+    error, embed = await run_research(guild_id, guild_name, topic)
+    if embed is not None:
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.followup.send(error)
 
 
 @bot.tree.command(name='memory_reset', description='Reset the conversation memory for this channel')
@@ -1155,12 +4776,7 @@ async def memory_reset(interaction: discord.Interaction):
     channel_id = str(interaction.channel_id)
     try:
         # Upsert an empty memory for this channel
-        supabase.table('conversation_memory').upsert({
-            'guild_id': guild_id,
-            'channel_id': channel_id,
-            'summary': '',
-            'message_count': 0
-        }, on_conflict='guild_id,channel_id').execute()
+        await upsert_conversation_memory(guild_id, channel_id, '', 0)
 
         await interaction.followup.send("✅ Conversation memory reset for this channel.")
     except Exception as e:
@@ -1273,8 +4889,7 @@ async def setup_reset(interaction: discord.Interaction):
         supabase.table('user_roles').delete().eq('guild_id', guild_id).execute()
         
         # Clear role cache for this guild
-        if guild_id in role_cache:
-            del role_cache[guild_id]
+        invalidate_guild_cache(guild_id, 'user_roles')
         
         await interaction.followup.send("✅ Server setup has been reset. Run `/setup` to register a new Team Lead.")
     except Exception as e:
@@ -1288,7 +4903,7 @@ async def setup_reset(interaction: discord.Interaction):
     app_commands.Choice(name='Team Lead', value='team_lead'),
     app_commands.Choice(name='Member', value='member')
 ])
-async def role_assign(interaction: discord.Interaction, user: discord.Member, role: app_commands.Choice[str]):
+async def role_assign(interaction: discord.Interaction, user: discord.User, role: app_commands.Choice[str]):
     """Assign a role to a user. Team Lead only."""
     await interaction.response.defer()
 
@@ -1304,8 +4919,13 @@ async def role_assign(interaction: discord.Interaction, user: discord.Member, ro
         await interaction.followup.send("❌ Only Team Leads can assign roles.")
         return
 
-    target_id = str(user.id)
-    target_name = user.display_name
+    # Resolved from the interaction when Discord includes the member, otherwise fetched
+    member = user if isinstance(user, discord.Member) else await resolve_member(interaction.guild, user.id)
+    if member is None:
+        await interaction.followup.send("❌ That user isn't a member of this server.")
+        return
+    target_id = str(member.id)
+    target_name = member.display_name
 
     success = await set_user_role(guild_id, target_id, target_name, role.value)
     
@@ -1400,6 +5020,10 @@ async def knowledge_add(interaction: discord.Interaction, title: str, content: s
     
     guild_id = str(interaction.guild_id) if interaction.guild_id else ''
     
+    if await knowledge_title_taken(guild_id, title):
+        await interaction.followup.send(duplicate_title_message(title))
+        return
+    
     if not embedding_available:
         await interaction.followup.send("⚠️ Embeddings not available. Document will be added without semantic search capability.")
     
@@ -1446,6 +5070,45 @@ async def knowledge_search(interaction: discord.Interaction, query: str):
     await interaction.followup.send(embed=embed)
 
 
+KNOWLEDGE_LIST_PAGE_SIZE = 20
+
+
+def knowledge_list_embed(docs: List[Dict[str, Any]], page: int) -> discord.Embed:
+    """Build one page of the /knowledge_list embed."""
+    embed = discord.Embed(
+        title='📚 Knowledge Base Documents',
+        color=discord.Color.blue()
+    )
+    for doc in docs:
+        doc_title = str(doc.get('title', 'Untitled'))
+        doc_id = str(doc.get('id', ''))[:8]
+        chunks = int(doc.get('chunk_count') or 0)
+        embed.add_field(name=doc_title, value=f"ID: {doc_id}... · {chunks} chunk{'s' if chunks != 1 else ''}", inline=False)
+    embed.set_footer(text=f'Page {page}')
+    return embed
+
+
+class KnowledgeListView(discord.ui.View):
+    """Next-page button for /knowledge_list; pages by keyset (created_at, id) rather than offset."""
+
+    def __init__(self, guild_id: str, last_doc: Dict[str, Any], page: int = 1):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.cursor = (str(last_doc['created_at']), str(last_doc['id']))
+        self.page = page
+
+    @discord.ui.button(label='Next page', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        docs = await list_knowledge_sources(self.guild_id, KNOWLEDGE_LIST_PAGE_SIZE, before=self.cursor)
+        if not docs:
+            await interaction.response.edit_message(view=None)
+            return
+        self.page += 1
+        self.cursor = (str(docs[-1]['created_at']), str(docs[-1]['id']))
+        has_more = len(docs) == KNOWLEDGE_LIST_PAGE_SIZE
+        await interaction.response.edit_message(embed=knowledge_list_embed(docs, self.page), view=self if has_more else None)
+
+
 @bot.tree.command(name='knowledge_list', description='List all documents in the knowledge base')
 async def knowledge_list(interaction: discord.Interaction):
     """List all documents in the knowledge base."""
@@ -1458,24 +5121,17 @@ async def knowledge_list(interaction: discord.Interaction):
     guild_id = str(interaction.guild_id) if interaction.guild_id else ''
     
     try:
-        result = supabase.table('knowledge_documents').select('id, title, created_at').eq('guild_id', guild_id).order('created_at', desc=True).limit(20).execute()
+        docs = await list_knowledge_sources(guild_id, KNOWLEDGE_LIST_PAGE_SIZE)
         
-        if not result.data:
+        if not docs:
             await interaction.followup.send("📚 Knowledge base is empty.")
             return
         
-        embed = discord.Embed(
-            title='📚 Knowledge Base Documents',
-            color=discord.Color.blue()
-        )
-        
-        for row in result.data:
-            doc: Dict[str, Any] = dict(row)  # type: ignore
-            doc_title = str(doc.get('title', 'Untitled'))
-            doc_id = str(doc.get('id', ''))[:8]
-            embed.add_field(name=doc_title, value=f"ID: {doc_id}...", inline=False)
-        
-        await interaction.followup.send(embed=embed)
+        embed = knowledge_list_embed(docs, 1)
+        if len(docs) == KNOWLEDGE_LIST_PAGE_SIZE:
+            await interaction.followup.send(embed=embed, view=KnowledgeListView(guild_id, docs[-1]))
+        else:
+            await interaction.followup.send(embed=embed)
     except Exception as e:
         await interaction.followup.send(f"❌ Error: {e}")
 
@@ -1499,10 +5155,13 @@ async def knowledge_delete(interaction: discord.Interaction, title: str):
         return
     
     try:
-        result = supabase.table('knowledge_documents').delete().eq('guild_id', guild_id).ilike('title', f'%{title}%').execute()
+        # Deleting the source rows cascades to their chunks
+        result = supabase.table('knowledge_sources').delete().eq('guild_id', guild_id).ilike('title', f'%{title}%').execute()
         
         if result.data:
             count = len(result.data)
+            local_index_remove_sources(guild_id, [str(dict(row)['id']) for row in result.data])  # type: ignore
+            invalidate_answer_cache(guild_id)
             await interaction.followup.send(f"✅ Deleted {count} document(s) matching: **{title}**")
         else:
             await interaction.followup.send(f"❌ No documents found matching: **{title}**")
@@ -1533,48 +5192,51 @@ async def knowledge_upload(interaction: discord.Interaction, title: str, file: d
         await interaction.followup.send("❌ File too large. Maximum size is 10MB.")
         return
     
-    # Download the file
-    file_bytes = await download_attachment(file.url)
-    if not file_bytes:
-        await interaction.followup.send("❌ Failed to download file.")
+    if await knowledge_title_taken(guild_id, title):
+        await interaction.followup.send(duplicate_title_message(title))
         return
     
-    # Extract text content
-    content = None
-    if filename.endswith('.pdf'):
-        if not pdf_available:
-            await interaction.followup.send("❌ PDF support is not installed. Please upload a TXT file instead.")
-            return
-        content = await extract_text_from_pdf(file_bytes)
-        if not content:
-            await interaction.followup.send("❌ Failed to extract text from PDF. The file may be image-based or corrupted.")
-            return
-    else:
-        # TXT or MD file
-        try:
-            content = file_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                content = file_bytes.decode('latin-1')
-            except:
-                await interaction.followup.send("❌ Failed to read file. Unsupported encoding.")
-                return
+    if jobs_enabled():
+        await enqueue_job('knowledge_upload', {
+            'guild_id': guild_id,
+            'title': title,
+            'url': file.url,
+            'filename': file.filename,
+            'interaction': interaction_target(interaction),
+        })
+        await interaction.edit_original_response(content=f"⏳ Queued **{file.filename}** for processing...")
+        return
     
-    if not content or len(content.strip()) == 0:
-        await interaction.followup.send("❌ File appears to be empty.")
+    await interaction.followup.send(await process_knowledge_upload(guild_id, title, file.url, file.filename))
+
+
+@bot.tree.command(name='knowledge_reindex', description='Recompute embeddings for the knowledge base (Team Lead only)')
+async def knowledge_reindex(interaction: discord.Interaction):
+    """Re-embed every knowledge chunk in this server, e.g. after changing HF_EMBED_MODEL. Team Lead only."""
+    await interaction.response.defer()
+    
+    if not supabase:
+        await interaction.followup.send("❌ Database not configured.")
         return
     
-    # Add to knowledge base
-    success = await add_document_to_knowledge_base(guild_id, title, content, filename=file.filename)
+    guild_id = str(interaction.guild_id) if interaction.guild_id else ''
+    user_id = str(interaction.user.id)
     
-    if success:
-        char_count = len(content)
-        await interaction.followup.send(
-            f"✅ Uploaded **{file.filename}** as **{title}**\n"
-            f"📄 {char_count:,} characters extracted"
-        )
-    else:
-        await interaction.followup.send("❌ Failed to add document to knowledge base.")
+    if not await is_team_lead(guild_id, user_id):
+        await interaction.followup.send("❌ Only Team Leads can reindex the knowledge base.")
+        return
+    
+    if jobs_enabled():
+        await enqueue_job('reindex_knowledge', {'guild_id': guild_id, 'interaction': interaction_target(interaction)})
+        await interaction.edit_original_response(content="⏳ Reindex queued...")
+        return
+    
+    if not embedding_available:
+        await interaction.followup.send("❌ Embeddings not available. Set HF_API_KEY to enable RAG.")
+        return
+    
+    count = await reindex_knowledge_base(guild_id)
+    await interaction.followup.send(f"✅ Re-embedded {count} knowledge chunk(s).")
 
 
 @bot.tree.command(name='knowledge_view', description='View a document from the knowledge base')
@@ -1591,17 +5253,17 @@ async def knowledge_view(interaction: discord.Interaction, title: str):
     
     try:
         # Search for document by title
-        result = supabase.table('knowledge_documents').select('*').eq('guild_id', guild_id).ilike('title', f'%{title}%').order('chunk_index').execute()
+        source = await find_knowledge_source(guild_id, title)
+        chunks = await get_knowledge_source_content(str(source['id'])) if source else []
         
-        if not result.data or not isinstance(result.data, list):
+        if not source or not chunks:
             await interaction.followup.send(f"❌ No document found matching: **{title}**")
             return
         
         # Combine all chunks
-        docs: List[Dict[str, Any]] = [dict(row) for row in result.data]  # type: ignore
-        full_content = '\n\n'.join(str(doc.get('content', '')) for doc in docs)
-        doc_title = str(docs[0].get('title', 'Untitled'))
-        doc_filename = str(docs[0].get('filename', ''))
+        full_content = '\n\n'.join(chunks)
+        doc_title = str(source.get('title') or 'Untitled')
+        doc_filename = str(source.get('filename') or '')
         
         # Create embed
         embed = discord.Embed(
@@ -1612,7 +5274,7 @@ async def knowledge_view(interaction: discord.Interaction, title: str):
         if doc_filename:
             embed.add_field(name='Source File', value=doc_filename, inline=True)
         
-        embed.add_field(name='Chunks', value=str(len(docs)), inline=True)
+        embed.add_field(name='Chunks', value=str(len(chunks)), inline=True)
         embed.add_field(name='Characters', value=f'{len(full_content):,}', inline=True)
         
         # Truncate content for Discord (max 4096 for embed description)
@@ -1644,10 +5306,49 @@ async def on_command_error(ctx, error):
         print(f'Error: {error}')
 
 
+def run_workers(count: int) -> int:
+    """Launch `count` bot processes, one per shard range, and supervise them.
+
+    If any worker exits, the rest are stopped and its exit code is returned so the
+    platform's restart policy restarts the whole group.
+    """
+    processes = []
+    for index in range(count):
+        env = dict(os.environ, WORKER_INDEX=str(index), BOT_WORKERS=str(count))
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    print(f'Launched {count} worker process(es)')
+
+    try:
+        while True:
+            for process in processes:
+                code = process.poll()
+                if code is not None:
+                    print(f'Worker {processes.index(process)} exited with code {code}; stopping all workers')
+                    return code or 1
+            time.sleep(1)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
 # Run the bot
 if __name__ == '__main__':
-    if TOKEN is None:
+    if BOT_ROLE == 'worker':
+        asyncio.run(run_job_worker())
+    elif TOKEN is None:
         print('Error: DISCORD_TOKEN not found in environment variables.')
         print('Please create a .env file with your bot token.')
+    elif BOT_WORKERS > 1 and WORKER_INDEX is None:
+        sys.exit(run_workers(BOT_WORKERS))
     else:
+        # Railway and the worker launcher stop processes with SIGTERM; shut down cleanly as on Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
         bot.run(TOKEN)
+        if WARM_STATE_DIR:
+            save_warm_state()
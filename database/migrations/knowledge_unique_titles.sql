@@ -0,0 +1,37 @@
+-- Stop same-title uploads from merging into one knowledge document
+-- Run once in the Supabase SQL Editor on installs that already have knowledge_sources.
+--
+-- The first chunk of an upload now fails with unique_violation when its title is taken;
+-- later chunks of the same upload still attach to the source the first chunk created.
+
+CREATE OR REPLACE FUNCTION link_knowledge_source()
+RETURNS TRIGGER AS $$
+DECLARE
+    source_title TEXT := regexp_replace(NEW.title, ' \(Part \d+\)$', '');
+BEGIN
+    IF COALESCE(NEW.chunk_index, 0) = 0 THEN
+        INSERT INTO knowledge_sources (guild_id, title, filename, chunk_count, char_count)
+        VALUES (NEW.guild_id, source_title, NEW.filename, 1, length(NEW.content))
+        ON CONFLICT (guild_id, title) DO NOTHING
+        RETURNING id INTO NEW.source_id;
+        IF NEW.source_id IS NULL THEN
+            RAISE EXCEPTION 'knowledge document "%" already exists', source_title
+                USING ERRCODE = 'unique_violation';
+        END IF;
+        RETURN NEW;
+    END IF;
+
+    UPDATE knowledge_sources
+    SET chunk_count = chunk_count + 1,
+        char_count = char_count + length(NEW.content),
+        filename = COALESCE(filename, NEW.filename)
+    WHERE guild_id = NEW.guild_id AND title = source_title
+    RETURNING id INTO NEW.source_id;
+    IF NEW.source_id IS NULL THEN
+        INSERT INTO knowledge_sources (guild_id, title, filename, chunk_count, char_count)
+        VALUES (NEW.guild_id, source_title, NEW.filename, 1, length(NEW.content))
+        RETURNING id INTO NEW.source_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
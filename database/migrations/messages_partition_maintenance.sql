@@ -0,0 +1,49 @@
+-- Update ensure_messages_partitions on installs that already have a partitioned messages table
+-- Run once in the Supabase SQL Editor. The bot calls the function daily through the Supabase RPC,
+-- which needs SECURITY DEFINER, and the new version moves rows that landed in messages_default
+-- (because their month had no partition yet) into the partition it creates.
+
+-- Same definition as in schema.sql
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(p_from DATE DEFAULT CURRENT_DATE, p_months_ahead INT DEFAULT 2)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER  -- called by the bot through the service_role RPC, which doesn't own messages
+SET search_path = public
+AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_from)::date;
+    month_end DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+    partition_name TEXT;
+    created_count INTEGER := 0;
+BEGIN
+    -- Every bot process calls this periodically; serialize them
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_messages_partitions'));
+    WHILE month_start <= last_month LOOP
+        partition_name := format('messages_p%s', to_char(month_start, 'YYYY_MM'));
+        month_end := (month_start + INTERVAL '1 month')::date;
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Rows that landed in messages_default while the month had no partition would make
+            -- CREATE TABLE ... PARTITION OF fail, so move them into the new table before attaching it
+            EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            created_count := created_count + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created_count;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) TO service_role;
+
+SELECT ensure_messages_partitions(COALESCE((SELECT min(created_at) FROM messages_default), NOW())::date, 2);
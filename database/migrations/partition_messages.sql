@@ -0,0 +1,90 @@
+-- Migrate an existing unpartitioned messages table to monthly range partitions
+-- Run once in the Supabase SQL Editor on installs created before messages was partitioned.
+-- Takes an exclusive lock on messages while rows are copied; run it during a quiet period.
+
+BEGIN;
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+DROP INDEX IF EXISTS idx_messages_channel_id;
+DROP INDEX IF EXISTS idx_messages_guild_id;
+DROP INDEX IF EXISTS idx_messages_created_at;
+
+CREATE TABLE messages (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    guild_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    content TEXT NOT NULL,
+    bot_response TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+-- Same definition as in schema.sql
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(p_from DATE DEFAULT CURRENT_DATE, p_months_ahead INT DEFAULT 2)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER  -- called by the bot through the service_role RPC, which doesn't own messages
+SET search_path = public
+AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_from)::date;
+    month_end DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+    partition_name TEXT;
+    created_count INTEGER := 0;
+BEGIN
+    -- Every bot process calls this periodically; serialize them
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_messages_partitions'));
+    WHILE month_start <= last_month LOOP
+        partition_name := format('messages_p%s', to_char(month_start, 'YYYY_MM'));
+        month_end := (month_start + INTERVAL '1 month')::date;
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Rows that landed in messages_default while the month had no partition would make
+            -- CREATE TABLE ... PARTITION OF fail, so move them into the new table before attaching it
+            EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            created_count := created_count + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created_count;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) TO service_role;
+
+-- Partitions covering every existing row, plus the next two months
+SELECT ensure_messages_partitions(COALESCE((SELECT min(created_at) FROM messages_unpartitioned), NOW())::date, 2);
+
+INSERT INTO messages (id, guild_id, channel_id, user_id, username, content, bot_response, created_at)
+SELECT id, guild_id, channel_id, user_id, username, content, bot_response, COALESCE(created_at, NOW())
+FROM messages_unpartitioned;
+
+CREATE INDEX IF NOT EXISTS idx_messages_guild_channel_created ON messages(guild_id, channel_id, created_at DESC);
+
+ALTER TABLE messages ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Allow authenticated users full access to messages" ON messages
+    FOR ALL TO authenticated USING (true);
+
+CREATE POLICY "Allow service role full access to messages" ON messages
+    FOR ALL TO service_role USING (true);
+
+DROP TABLE messages_unpartitioned;
+
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS message_retention_days INTEGER CHECK (message_retention_days > 0);
+
+COMMIT;
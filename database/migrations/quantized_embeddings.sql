@@ -0,0 +1,18 @@
+-- Build the quantized embedding indexes used by EMBEDDING_INDEX=halfvec / EMBEDDING_INDEX=binary
+-- Only needed when the bot runs without DATABASE_URL; with it, the bot builds the index for its
+-- configured mode itself. Requires pgvector >= 0.7 and the search_documents_* functions from schema.sql.
+--
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction: run each statement on its own
+-- (e.g. with psql). Writes continue while the index builds; a failed build leaves an INVALID
+-- index that must be dropped before retrying.
+
+-- EMBEDDING_INDEX=halfvec
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_knowledge_embedding_halfvec ON knowledge_documents
+USING hnsw ((embedding::halfvec(384)) halfvec_cosine_ops);
+
+-- EMBEDDING_INDEX=binary
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_knowledge_embedding_binary ON knowledge_documents
+USING hnsw ((binary_quantize(embedding)::bit(384)) bit_hamming_ops);
+
+-- Once searches use a quantized index, the full-precision index only costs memory
+-- DROP INDEX CONCURRENTLY IF EXISTS idx_knowledge_embedding;
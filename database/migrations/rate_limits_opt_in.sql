@@ -0,0 +1,16 @@
+-- Make per-guild reply rate limits opt-in on installs that added them with limits on by default
+-- Run once in the Supabase SQL Editor. New guilds then start unlimited (0).
+--
+-- The UPDATE clears limits still at the old defaults (30 / 10 / 5 per minute). A guild that
+-- chose exactly those values is reset too; skip the UPDATE if that matters.
+
+BEGIN;
+
+ALTER TABLE bot_config ALTER COLUMN guild_rate_limit SET DEFAULT 0;
+ALTER TABLE bot_config ALTER COLUMN channel_rate_limit SET DEFAULT 0;
+ALTER TABLE bot_config ALTER COLUMN user_rate_limit SET DEFAULT 0;
+
+UPDATE bot_config SET guild_rate_limit = 0, channel_rate_limit = 0, user_rate_limit = 0
+WHERE guild_rate_limit = 30 AND channel_rate_limit = 10 AND user_rate_limit = 5;
+
+COMMIT;
@@ -48,16 +48,68 @@ CREATE TABLE IF NOT EXISTS conversation_memory (
 );
 
 -- Message History Table (for context)
+-- Range-partitioned by month on created_at so old months can be archived and dropped cheaply.
+-- Existing installs with an unpartitioned table: run database/migrations/partition_messages.sql
 CREATE TABLE IF NOT EXISTS messages (
-    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
     guild_id TEXT NOT NULL,
     channel_id TEXT NOT NULL,
     user_id TEXT NOT NULL,
     username TEXT NOT NULL,
     content TEXT NOT NULL,
     bot_response TEXT,
-    created_at TIMESTAMPTZ DEFAULT NOW()
-);
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Catches rows outside the monthly partitions (should stay empty)
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+-- Create monthly partitions (messages_pYYYY_MM) from p_from's month through p_months_ahead months from now.
+-- Every bot process calls this daily (through the Supabase RPC) so the next months always exist.
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(p_from DATE DEFAULT CURRENT_DATE, p_months_ahead INT DEFAULT 2)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER  -- called by the bot through the service_role RPC, which doesn't own messages
+SET search_path = public
+AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_from)::date;
+    month_end DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+    partition_name TEXT;
+    created_count INTEGER := 0;
+BEGIN
+    -- Every bot process calls this periodically; serialize them
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_messages_partitions'));
+    WHILE month_start <= last_month LOOP
+        partition_name := format('messages_p%s', to_char(month_start, 'YYYY_MM'));
+        month_end := (month_start + INTERVAL '1 month')::date;
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Rows that landed in messages_default while the month had no partition would make
+            -- CREATE TABLE ... PARTITION OF fail, so move them into the new table before attaching it
+            EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            created_count := created_count + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created_count;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION ensure_messages_partitions(DATE, INT) TO service_role;
+
+SELECT ensure_messages_partitions(CURRENT_DATE, 2);
 
 -- Knowledge Documents Table (RAG) - per-guild
 -- Uses sentence-transformers/all-MiniLM-L6-v2 from Hugging Face (384 dimensions)
@@ -112,9 +164,7 @@ END;
 $$;
 
 -- Indexes for performance
-CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages(channel_id);
-CREATE INDEX IF NOT EXISTS idx_messages_guild_id ON messages(guild_id);
-CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_guild_channel_created ON messages(guild_id, channel_id, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_conversation_memory_channel_id ON conversation_memory(channel_id);
 CREATE INDEX IF NOT EXISTS idx_conversation_memory_guild_id ON conversation_memory(guild_id);
 CREATE INDEX IF NOT EXISTS idx_bot_config_guild_id ON bot_config(guild_id);
@@ -190,3 +240,415 @@ CREATE TRIGGER update_conversation_memory_updated_at
 CREATE TRIGGER update_user_roles_updated_at
     BEFORE UPDATE ON user_roles
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Cache invalidation notifications
+-- Bot processes LISTEN on 'dasai_cache' (requires DATABASE_URL) and drop cached config/roles
+-- for the affected guild, so changes from the dashboard or another worker apply immediately
+CREATE OR REPLACE FUNCTION notify_cache_invalidation()
+RETURNS TRIGGER AS $$
+DECLARE
+    row_guild_id TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_guild_id := OLD.guild_id;
+    ELSE
+        row_guild_id := NEW.guild_id;
+    END IF;
+    PERFORM pg_notify('dasai_cache', json_build_object('table', TG_TABLE_NAME, 'guild_id', row_guild_id)::text);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER notify_bot_config_cache
+    AFTER INSERT OR UPDATE OR DELETE ON bot_config
+    FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation();
+
+CREATE TRIGGER notify_user_roles_cache
+    AFTER INSERT OR UPDATE OR DELETE ON user_roles
+    FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation();
+
+-- Background Job Queue (optional gateway/worker split, BOT_ROLE=gateway|worker)
+-- Workers claim rows with FOR UPDATE SKIP LOCKED; completed jobs are deleted, failed jobs kept with last_error
+CREATE TABLE IF NOT EXISTS bot_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TIMESTAMPTZ DEFAULT NOW(),
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_jobs_runnable ON bot_jobs(status, run_after);
+
+ALTER TABLE bot_jobs ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Allow service role full access to bot_jobs" ON bot_jobs
+    FOR ALL TO service_role USING (true);
+
+-- Per-guild rate limits for AI replies (replies per minute, 0 = unlimited)
+-- Enforced by in-memory token buckets in each bot process; editable from the admin dashboard
+-- Off by default: guilds opt in from the dashboard
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS guild_rate_limit INTEGER NOT NULL DEFAULT 0 CHECK (guild_rate_limit >= 0);
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS channel_rate_limit INTEGER NOT NULL DEFAULT 0 CHECK (channel_rate_limit >= 0);
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS user_rate_limit INTEGER NOT NULL DEFAULT 0 CHECK (user_rate_limit >= 0);
+
+-- Embedding backfill
+-- Rows inserted without an embedding (dashboard uploads, or while the embedding API was down)
+-- are claimed in batches by the bot's backfill worker, embedded, and written back
+ALTER TABLE knowledge_documents ADD COLUMN IF NOT EXISTS embedding_claimed_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_knowledge_unembedded ON knowledge_documents(created_at)
+WHERE embedding IS NULL;
+
+-- Claim up to batch_size unembedded rows; claims expire after 5 minutes in case a worker dies
+CREATE OR REPLACE FUNCTION claim_unembedded_documents(batch_size INT DEFAULT 32)
+RETURNS TABLE (
+    id UUID,
+    content TEXT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    UPDATE knowledge_documents kd
+    SET embedding_claimed_at = NOW()
+    WHERE kd.id IN (
+        SELECT k.id
+        FROM knowledge_documents k
+        WHERE k.embedding IS NULL
+            AND (k.embedding_claimed_at IS NULL OR k.embedding_claimed_at < NOW() - INTERVAL '5 minutes')
+        ORDER BY k.created_at
+        LIMIT batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING kd.id, kd.content;
+END;
+$$;
+
+-- Write a batch of embeddings back in one statement (vectors in pgvector text form, e.g. '[0.1,0.2]')
+CREATE OR REPLACE FUNCTION set_document_embeddings(p_ids UUID[], p_embeddings TEXT[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    updated_count INTEGER;
+BEGIN
+    UPDATE knowledge_documents kd
+    SET embedding = u.embedding::vector, embedding_claimed_at = NULL
+    FROM unnest(p_ids, p_embeddings) AS u(id, embedding)
+    WHERE kd.id = u.id;
+    GET DIAGNOSTICS updated_count = ROW_COUNT;
+    RETURN updated_count;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION notify_unembedded_document()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('dasai_backfill', NEW.guild_id);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER notify_knowledge_unembedded
+    AFTER INSERT ON knowledge_documents
+    FOR EACH ROW WHEN (NEW.embedding IS NULL)
+    EXECUTE FUNCTION notify_unembedded_document();
+
+-- Message retention (days of history kept per guild; NULL uses the bot's MESSAGE_RETENTION_DAYS)
+-- Expired rows are exported to compressed JSONL under MESSAGE_ARCHIVE_DIR before being dropped
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS message_retention_days INTEGER CHECK (message_retention_days > 0);
+
+-- Chat backend tried first for this guild ('hf' or 'openai'); NULL follows the bot's LLM_BACKENDS order
+-- The other configured backends remain as failover
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS llm_backend TEXT CHECK (llm_backend IN ('hf', 'openai'));
+
+-- Semantic answer cache (opt-in): reuse the bot's answer to an earlier, near-identical question
+ALTER TABLE bot_config ADD COLUMN IF NOT EXISTS answer_cache BOOLEAN NOT NULL DEFAULT false;
+
+-- Knowledge sources: one row per uploaded document, so listing, lookup and delete never touch
+-- chunk rows (or their embeddings). Maintained by triggers on knowledge_documents.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS knowledge_sources (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    guild_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    filename TEXT,
+    chunk_count INTEGER NOT NULL DEFAULT 0,
+    char_count BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    UNIQUE (guild_id, title)
+);
+
+CREATE INDEX IF NOT EXISTS idx_knowledge_sources_guild_created ON knowledge_sources(guild_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_knowledge_sources_title_trgm ON knowledge_sources USING gin (title gin_trgm_ops);
+
+ALTER TABLE knowledge_documents ADD COLUMN IF NOT EXISTS source_id UUID REFERENCES knowledge_sources(id) ON DELETE CASCADE;
+CREATE INDEX IF NOT EXISTS idx_knowledge_documents_source ON knowledge_documents(source_id, chunk_index);
+
+ALTER TABLE knowledge_sources ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Allow authenticated users full access to knowledge_sources" ON knowledge_sources
+    FOR ALL TO authenticated USING (true);
+
+CREATE POLICY "Allow service role full access to knowledge_sources" ON knowledge_sources
+    FOR ALL TO service_role USING (true);
+
+-- Chunks are titled "<title> (Part N)"; attach each new chunk to its document's source row.
+-- The first chunk (chunk_index 0) creates the source and fails if the title is already taken,
+-- so two uploads with the same title never merge into one document.
+CREATE OR REPLACE FUNCTION link_knowledge_source()
+RETURNS TRIGGER AS $$
+DECLARE
+    source_title TEXT := regexp_replace(NEW.title, ' \(Part \d+\)$', '');
+BEGIN
+    IF COALESCE(NEW.chunk_index, 0) = 0 THEN
+        INSERT INTO knowledge_sources (guild_id, title, filename, chunk_count, char_count)
+        VALUES (NEW.guild_id, source_title, NEW.filename, 1, length(NEW.content))
+        ON CONFLICT (guild_id, title) DO NOTHING
+        RETURNING id INTO NEW.source_id;
+        IF NEW.source_id IS NULL THEN
+            RAISE EXCEPTION 'knowledge document "%" already exists', source_title
+                USING ERRCODE = 'unique_violation';
+        END IF;
+        RETURN NEW;
+    END IF;
+
+    UPDATE knowledge_sources
+    SET chunk_count = chunk_count + 1,
+        char_count = char_count + length(NEW.content),
+        filename = COALESCE(filename, NEW.filename)
+    WHERE guild_id = NEW.guild_id AND title = source_title
+    RETURNING id INTO NEW.source_id;
+    IF NEW.source_id IS NULL THEN
+        INSERT INTO knowledge_sources (guild_id, title, filename, chunk_count, char_count)
+        VALUES (NEW.guild_id, source_title, NEW.filename, 1, length(NEW.content))
+        RETURNING id INTO NEW.source_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER link_knowledge_document_source
+    BEFORE INSERT ON knowledge_documents
+    FOR EACH ROW WHEN (NEW.source_id IS NULL)
+    EXECUTE FUNCTION link_knowledge_source();
+
+-- Keep counts right when individual chunks are deleted; drop sources left with no chunks
+CREATE OR REPLACE FUNCTION unlink_knowledge_source()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE knowledge_sources
+    SET chunk_count = chunk_count - 1, char_count = char_count - length(OLD.content)
+    WHERE id = OLD.source_id;
+    DELETE FROM knowledge_sources WHERE id = OLD.source_id AND chunk_count <= 0;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER unlink_knowledge_document_source
+    AFTER DELETE ON knowledge_documents
+    FOR EACH ROW WHEN (OLD.source_id IS NOT NULL)
+    EXECUTE FUNCTION unlink_knowledge_source();
+
+-- Backfill sources for chunks inserted before this table existed
+INSERT INTO knowledge_sources (guild_id, title, filename, chunk_count, char_count, created_at)
+SELECT guild_id, regexp_replace(title, ' \(Part \d+\)$', ''), max(filename), count(*), sum(length(content)), min(COALESCE(created_at, NOW()))
+FROM knowledge_documents
+WHERE source_id IS NULL
+GROUP BY 1, 2
+ON CONFLICT (guild_id, title) DO NOTHING;
+
+UPDATE knowledge_documents kd
+SET source_id = ks.id
+FROM knowledge_sources ks
+WHERE kd.source_id IS NULL
+    AND ks.guild_id = kd.guild_id
+    AND ks.title = regexp_replace(kd.title, ' \(Part \d+\)$', '');
+
+-- Keyset pagination over a guild's documents, newest first. Pass the last row's
+-- (created_at, id) to get the next page; cost stays flat however deep the page is.
+CREATE OR REPLACE FUNCTION list_knowledge_sources(
+    p_guild_id TEXT,
+    p_limit INT DEFAULT 20,
+    p_before_created_at TIMESTAMPTZ DEFAULT NULL,
+    p_before_id UUID DEFAULT NULL
+)
+RETURNS SETOF knowledge_sources
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT *
+    FROM knowledge_sources ks
+    WHERE ks.guild_id = p_guild_id
+        AND (p_before_created_at IS NULL OR (ks.created_at, ks.id) < (p_before_created_at, p_before_id))
+    ORDER BY ks.created_at DESC, ks.id DESC
+    LIMIT p_limit;
+$$;
+
+-- Any change to a guild's documents clears its cached answers in every bot process
+CREATE TRIGGER notify_knowledge_sources_cache
+    AFTER INSERT OR UPDATE OR DELETE ON knowledge_sources
+    FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation();
+
+-- Quantized embedding search (pgvector >= 0.7), selected with the bot's EMBEDDING_INDEX setting.
+-- Full float32 vectors stay in the table; only the ANN index is quantized (halfvec: half the size,
+-- binary: 1/32), so the index that has to live in shared buffers shrinks. Search is two-stage:
+-- the quantized index picks p_candidates rows, which are re-ranked by exact float cosine distance.
+-- The indexes themselves are built in the background by the bot (CREATE INDEX CONCURRENTLY),
+-- or by database/migrations/quantized_embeddings.sql.
+CREATE OR REPLACE FUNCTION search_documents_halfvec(
+    p_guild_id TEXT,
+    query_embedding vector(384),
+    match_threshold FLOAT DEFAULT 0.5,
+    match_count INT DEFAULT 5,
+    p_candidates INT DEFAULT 40
+)
+RETURNS TABLE (
+    id UUID,
+    title TEXT,
+    content TEXT,
+    similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM set_config('hnsw.ef_search', GREATEST(p_candidates, 40)::text, true);
+    RETURN QUERY
+    WITH candidates AS (
+        SELECT k.id
+        FROM knowledge_documents k
+        WHERE k.guild_id = p_guild_id
+            AND k.embedding IS NOT NULL
+        ORDER BY k.embedding::halfvec(384) <=> query_embedding::halfvec(384)
+        LIMIT p_candidates
+    )
+    SELECT
+        kd.id,
+        kd.title,
+        kd.content,
+        1 - (kd.embedding <=> query_embedding) AS similarity
+    FROM candidates c
+    JOIN knowledge_documents kd ON kd.id = c.id
+    WHERE 1 - (kd.embedding <=> query_embedding) > match_threshold
+    ORDER BY kd.embedding <=> query_embedding
+    LIMIT match_count;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION search_documents_binary(
+    p_guild_id TEXT,
+    query_embedding vector(384),
+    match_threshold FLOAT DEFAULT 0.5,
+    match_count INT DEFAULT 5,
+    p_candidates INT DEFAULT 40
+)
+RETURNS TABLE (
+    id UUID,
+    title TEXT,
+    content TEXT,
+    similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM set_config('hnsw.ef_search', GREATEST(p_candidates, 40)::text, true);
+    RETURN QUERY
+    WITH candidates AS (
+        SELECT k.id
+        FROM knowledge_documents k
+        WHERE k.guild_id = p_guild_id
+            AND k.embedding IS NOT NULL
+        ORDER BY binary_quantize(k.embedding)::bit(384) <~> binary_quantize(query_embedding)
+        LIMIT p_candidates
+    )
+    SELECT
+        kd.id,
+        kd.title,
+        kd.content,
+        1 - (kd.embedding <=> query_embedding) AS similarity
+    FROM candidates c
+    JOIN knowledge_documents kd ON kd.id = c.id
+    WHERE 1 - (kd.embedding <=> query_embedding) > match_threshold
+    ORDER BY kd.embedding <=> query_embedding
+    LIMIT match_count;
+END;
+$$;
+
+-- Reply round trips: everything the bot reads to answer a message in one call, and everything
+-- it writes afterwards in another, instead of one PostgREST request per table.
+-- get_reply_context returns {"config": bot_config row or null, "memory": {"summary", "message_count"}
+-- or null, "chunks": [{"id", "title", "content", "similarity"}, ...]}. Chunks are searched with the
+-- function for p_search_mode (the bot's EMBEDDING_INDEX); pass a NULL embedding or match_count 0
+-- to skip the search.
+CREATE OR REPLACE FUNCTION get_reply_context(
+    p_guild_id TEXT,
+    p_channel_id TEXT,
+    query_embedding vector(384) DEFAULT NULL,
+    match_count INT DEFAULT 5,
+    match_threshold FLOAT DEFAULT 0.35,
+    p_search_mode TEXT DEFAULT 'vector',
+    p_candidates INT DEFAULT 40
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_config JSONB;
+    v_memory JSONB;
+    v_chunks JSONB := '[]'::jsonb;
+BEGIN
+    SELECT to_jsonb(bc) INTO v_config
+    FROM bot_config bc
+    WHERE bc.guild_id = p_guild_id;
+
+    SELECT jsonb_build_object('summary', cm.summary, 'message_count', cm.message_count) INTO v_memory
+    FROM conversation_memory cm
+    WHERE cm.guild_id = p_guild_id AND cm.channel_id = p_channel_id;
+
+    IF query_embedding IS NOT NULL AND match_count > 0 THEN
+        IF p_search_mode = 'halfvec' THEN
+            SELECT COALESCE(jsonb_agg(to_jsonb(s) ORDER BY s.similarity DESC), '[]'::jsonb) INTO v_chunks
+            FROM search_documents_halfvec(p_guild_id, query_embedding, match_threshold, match_count, p_candidates) s;
+        ELSIF p_search_mode = 'binary' THEN
+            SELECT COALESCE(jsonb_agg(to_jsonb(s) ORDER BY s.similarity DESC), '[]'::jsonb) INTO v_chunks
+            FROM search_documents_binary(p_guild_id, query_embedding, match_threshold, match_count, p_candidates) s;
+        ELSE
+            SELECT COALESCE(jsonb_agg(to_jsonb(s) ORDER BY s.similarity DESC), '[]'::jsonb) INTO v_chunks
+            FROM search_documents(p_guild_id, query_embedding, match_threshold, match_count) s;
+        END IF;
+    END IF;
+
+    RETURN jsonb_build_object('config', v_config, 'memory', v_memory, 'chunks', v_chunks);
+END;
+$$;
+
+-- Store one exchange and bump the channel's memory counter in the same transaction.
+-- Returns the memory row after the update; the bot refreshes the summary every 5 messages.
+CREATE OR REPLACE FUNCTION record_exchange(
+    p_guild_id TEXT,
+    p_channel_id TEXT,
+    p_user_id TEXT,
+    p_username TEXT,
+    p_content TEXT,
+    p_bot_response TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    summary TEXT,
+    message_count INTEGER
+)
+LANGUAGE sql
+AS $$
+    INSERT INTO messages (guild_id, channel_id, user_id, username, content, bot_response)
+    VALUES (p_guild_id, p_channel_id, p_user_id, p_username, p_content, p_bot_response);
+
+    INSERT INTO conversation_memory AS cm (guild_id, channel_id, message_count)
+    VALUES (p_guild_id, p_channel_id, 1)
+    ON CONFLICT (guild_id, channel_id)
+    DO UPDATE SET message_count = COALESCE(cm.message_count, 0) + 1, updated_at = NOW()
+    RETURNING cm.summary, cm.message_count;
+$$;